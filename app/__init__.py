@@ -1,16 +1,24 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from werkzeug.middleware.proxy_fix import ProxyFix
 from config import Config
+from app.replica import RoutingSession, init_replica
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
     
+    # Client address and scheme from the proxy's headers (login throttling, external URLs)
+    hops = app.config.get('PROXY_HOPS', 0)
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    
     db.init_app(app)
+    init_replica(app)
     login_manager.init_app(app)
     
     login_manager.login_view = 'login'
@@ -18,17 +26,79 @@ def create_app(config_class=Config):
     login_manager.login_message_category = 'info'
     
     with app.app_context():
+        # Registered first so its after_request hook runs last, on the final body
+        from app.responses import init_compression
+        init_compression(app)
         from app import routes
+        from app.api import api
+        app.register_blueprint(api)
+        from app.metrics import init_metrics
+        init_metrics(app)
+        from app.profiling import init_profiler
+        init_profiler(app)
+        from app.assets import init_assets
+        init_assets(app)
+        from app.fragment_cache import init_fragment_cache
+        init_fragment_cache(app)
+        from app.idempotency import idempotency_field
+        app.jinja_env.globals['idempotency_field'] = idempotency_field
+        from app.branches import init_branches
+        init_branches(app)
         
         db.create_all()
         
+        from app.sessions import init_sessions
+        init_sessions(app)
+        from app.tasks import init_tasks
+        init_tasks(app)
+        
         # Run database migrations for existing tables
         run_migrations()
         
         create_default_users()
+        
+        # Default branch for existing rows, and job tables on branch databases
+        from app.branches import migrate_branches
+        migrate_branches()
     
     return app
 
+# Columns added after the first release: (table, column, SQL type)
+MIGRATION_COLUMNS = [
+    ('users', 'phone_number', 'VARCHAR(20)'),
+    ('archived_jobs', 'waiting_minutes', 'INTEGER'),
+    ('archived_jobs', 'washing_minutes', 'INTEGER'),
+    ('archived_jobs', 'detailing_minutes', 'INTEGER'),
+    ('archived_jobs', 'ready_minutes', 'INTEGER'),
+    ('cars', 'customer_id', 'INTEGER REFERENCES customers(id)'),
+    ('archived_jobs', 'customer_id', 'INTEGER REFERENCES customers(id)'),
+    ('cars', 'version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('cars', 'updated_at', 'TIMESTAMP'),
+    ('users', 'branch_id', 'INTEGER REFERENCES branches(id)'),
+    ('users', 'session_version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('services', 'branch_id', 'INTEGER REFERENCES branches(id)'),
+    ('cars', 'branch_id', 'INTEGER REFERENCES branches(id)'),
+    ('archived_jobs', 'branch_id', 'INTEGER REFERENCES branches(id)'),
+    ('cold_archive_files', 'branch_id', 'INTEGER REFERENCES branches(id)'),
+    ('daily_rollups', 'stage_sketches', 'TEXT'),
+]
+
+# Indexes on migrated columns (create_all only indexes new tables): (index, table, column(s))
+MIGRATION_INDEXES = [
+    ('ix_cars_customer_id', 'cars', 'customer_id'),
+    ('ix_archived_jobs_customer_id', 'archived_jobs', 'customer_id'),
+    ('ix_archived_jobs_time_in', 'archived_jobs', 'time_in'),
+    ('ix_cars_updated_at', 'cars', 'updated_at'),
+    # Branch-leading composites: every per-branch query filters on branch_id first
+    ('ix_cars_branch_status', 'cars', 'branch_id, status'),
+    ('ix_cars_branch_time_in', 'cars', 'branch_id, time_in'),
+    ('ix_archived_jobs_branch_time_in', 'archived_jobs', 'branch_id, time_in'),
+    ('ix_archived_jobs_branch_archived_at', 'archived_jobs', 'branch_id, archived_at'),
+    ('ix_users_branch_role', 'users', 'branch_id, role'),
+    ('ix_services_branch_id', 'services', 'branch_id'),
+    ('ix_cold_archive_files_branch_month', 'cold_archive_files', 'branch_id, month'),
+]
+
 def run_migrations():
     """Run database migrations for existing tables."""
     from sqlalchemy import text, inspect
@@ -38,22 +108,29 @@ def run_migrations():
     try:
         # Get the database inspector
         inspector = inspect(db.engine)
+        tables = inspector.get_table_names()
         
-        # Check if 'users' table exists
-        if 'users' in inspector.get_table_names():
+        for table, column, column_type in MIGRATION_COLUMNS:
+            if table not in tables:
+                print(f"[INFO] '{table}' table doesn't exist yet, will be created by create_all()")
+                continue
+            
             # Get existing columns
-            columns = [col['name'] for col in inspector.get_columns('users')]
+            columns = [col['name'] for col in inspector.get_columns(table)]
             
-            # Add phone_number column if it doesn't exist
-            if 'phone_number' not in columns:
-                print("Adding 'phone_number' column to 'users' table...")
-                db.session.execute(text("ALTER TABLE users ADD COLUMN phone_number VARCHAR(20)"))
+            # Add the column if it doesn't exist
+            if column not in columns:
+                print(f"Adding '{column}' column to '{table}' table...")
+                db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
                 db.session.commit()
-                print("[OK] Successfully added 'phone_number' column.")
+                print(f"[OK] Successfully added '{column}' column.")
             else:
-                print("[OK] Column 'phone_number' already exists.")
-        else:
-            print("[INFO] 'users' table doesn't exist yet, will be created by create_all()")
+                print(f"[OK] Column '{column}' already exists.")
+        
+        for index, table, column in MIGRATION_INDEXES:
+            if table in tables:
+                db.session.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON {table} ({column})"))
+                db.session.commit()
     
     except Exception as e:
         print(f"[ERROR] Migration error: {str(e)}")
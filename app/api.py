@@ -0,0 +1,400 @@
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from functools import wraps
+import sqlalchemy as sa
+from flask import Blueprint, g, jsonify, request
+from sqlalchemy.orm.exc import StaleDataError
+from app import db
+from app.models import ApiToken, Car, Service, User
+from app.idempotency import idempotent
+from app.ratelimit import login_allowed
+from app.replica import read_replica
+from app.branches import enter_branch
+from app.scheduler import scheduler
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+JOB_STATUSES = Car.STATUSES
+
+# Selectable job fields -> column; service_*/staff_* fields are looked up only when asked for
+JOB_FIELDS = {
+    'id': Car.id,
+    'plate_number': Car.plate_number,
+    'car_model': Car.car_model,
+    'customer_name': Car.customer_name,
+    'customer_phone': Car.customer_phone,
+    'status': Car.status,
+    'time_in': Car.time_in,
+    'time_out': Car.time_out,
+    'notes': Car.notes,
+    'version': Car.version,
+    'service_id': Car.service_id,
+    'service_name': Service.name,
+    'service_price': Service.price,
+    'staff_id': Car.assigned_user_id,
+    'staff_name': User.full_name,
+}
+# Fields read from services/users after the job query, by the job's service_id/staff_id
+# (no join: a branch's jobs may live in a different database from services and users)
+LOOKUP_FIELDS = {
+    'service_name': 'service_id',
+    'service_price': 'service_id',
+    'staff_name': 'staff_id',
+}
+DEFAULT_JOB_FIELDS = ('id', 'plate_number', 'car_model', 'status', 'service_name', 'staff_name',
+                      'time_in', 'time_out', 'version')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+TOKEN_TOUCH_SECONDS = 60  # last_used_at is refreshed at most this often per token
+
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+
+def _iso(value):
+    """Naive UTC datetimes as ISO 8601 with a Z suffix"""
+    if isinstance(value, datetime):
+        return value.isoformat() + 'Z'
+    return value
+
+
+def _conditional(payload):
+    """JSON response with an ETag; a matching If-None-Match gets an empty 304"""
+    response = jsonify(payload)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def token_required(f):
+    """
+    Decorator for API views: authenticate with 'Authorization: Bearer <token>'
+    The cookie session is never read or written, so API clients and browsers stay separate;
+    owners pick a branch with ?branch=<id> (default: the first branch)
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not token.strip():
+            response, status = api_error('Missing bearer token', 401)
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response, status
+
+        api_token = ApiToken.query.filter_by(token_hash=hash_token(token.strip()), revoked=False).first()
+        if api_token is None or not api_token.user.is_active:
+            response, status = api_error('Invalid or revoked token', 401)
+            response.headers['WWW-Authenticate'] = 'Bearer error="invalid_token"'
+            return response, status
+
+        now = datetime.utcnow()
+        if api_token.last_used_at is None or now - api_token.last_used_at > timedelta(seconds=TOKEN_TOUCH_SECONDS):
+            # Core update outside the session, so read-only requests stay eligible for the replica
+            table = ApiToken.__table__
+            with db.engine.begin() as connection:
+                connection.execute(sa.update(table).where(table.c.id == api_token.id).values(last_used_at=now))
+
+        g.api_user = api_token.user
+        g.api_token = api_token
+        enter_branch(api_token.user, request.args.get('branch', type=int))
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def admin_token_required(f):
+    """Decorator for API views that need an admin token (use under @token_required)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.api_user.role != 'admin':
+            return api_error('Admin access required', 403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def _parse_fields():
+    """
+    ?fields=id,status,... -> list of field names (id is always included for cursors)
+
+    Returns:
+        (fields, error message or None)
+    """
+    requested = request.args.get('fields')
+    if not requested:
+        return list(DEFAULT_JOB_FIELDS), None
+    fields = []
+    for name in requested.split(','):
+        name = name.strip()
+        if name not in JOB_FIELDS:
+            return None, f"Unknown field '{name}'. Available: {', '.join(JOB_FIELDS)}"
+        if name not in fields:
+            fields.append(name)
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+    return fields, None
+
+
+def _job_query(fields):
+    """SELECT of just the requested job columns, plus the ids service_*/staff_* fields are looked up by"""
+    columns = [name for name in fields if name not in LOOKUP_FIELDS]
+    for name in fields:
+        if name in LOOKUP_FIELDS and LOOKUP_FIELDS[name] not in columns:
+            columns.append(LOOKUP_FIELDS[name])
+    return sa.select(*[JOB_FIELDS[name].label(name) for name in columns])
+
+
+def _serialize(rows, fields):
+    """Job rows -> dicts of the requested fields, with one lookup query per service_*/staff_* field"""
+    lookups = {}
+    for name in fields:
+        if name in LOOKUP_FIELDS:
+            column = JOB_FIELDS[name]
+            ids = {getattr(row, LOOKUP_FIELDS[name]) for row in rows}
+            lookups[name] = dict(db.session.execute(
+                sa.select(column.class_.id, column).where(column.class_.id.in_(ids))
+            ).all()) if ids else {}
+    return [{
+        name: _iso(lookups[name].get(getattr(row, LOOKUP_FIELDS[name])) if name in lookups else getattr(row, name))
+        for name in fields
+    } for row in rows]
+
+
+def _visible_to(query):
+    """Staff tokens only see their own jobs"""
+    if g.api_user.role != 'admin':
+        query = query.where(Car.assigned_user_id == g.api_user.id)
+    return query
+
+
+# TOKENS
+
+@api.route('/tokens', methods=['POST'])
+def create_token():
+    """Exchange a username and password for a bearer token (shown once)"""
+    data = request.get_json(silent=True) or {}
+    username = (data.get('username') or '').strip()
+    password = data.get('password') or ''
+    if not username or not password:
+        return api_error('username and password are required', 400)
+    if not login_allowed(request.remote_addr, username):
+        response, status = api_error('Too many login attempts. Please wait a minute and try again.', 429)
+        response.headers['Retry-After'] = '60'
+        return response, status
+
+    user = User.query.filter_by(username=username).first()
+    if user is None or not user.check_password(password):
+        return api_error('Invalid username or password', 401)
+    if not user.is_active:
+        return api_error('Account is deactivated', 403)
+    if user.password_needs_rehash():
+        user.set_password(password)
+
+    token = secrets.token_urlsafe(32)
+    api_token = ApiToken(user_id=user.id, token_hash=hash_token(token),
+                         name=(data.get('name') or 'API client')[:100])
+    db.session.add(api_token)
+    db.session.commit()
+    print(f"[OK] API token {api_token.id} issued to {user.username}")
+
+    return jsonify({
+        'token': token,
+        'id': api_token.id,
+        'name': api_token.name,
+        'user': {'id': user.id, 'username': user.username, 'role': user.role}
+    }), 201
+
+
+@api.route('/tokens/current', methods=['DELETE'])
+@token_required
+def revoke_token():
+    """Revoke the token used for this request"""
+    g.api_token.revoked = True
+    db.session.commit()
+    return '', 204
+
+
+# JOBS
+
+@api.route('/jobs')
+@token_required
+def list_jobs():
+    """
+    Current jobs, newest first
+    Query: status (comma-separated), staff_id, date (YYYY-MM-DD, Kenya day of time_in),
+    fields (comma-separated), limit, after (cursor from the previous page)
+    """
+    fields, error = _parse_fields()
+    if error:
+        return api_error(error, 400)
+
+    query = _visible_to(_job_query(fields))
+
+    statuses = [s.strip() for s in request.args.get('status', '').split(',') if s.strip()]
+    if statuses:
+        unknown = [s for s in statuses if s not in JOB_STATUSES]
+        if unknown:
+            return api_error(f"Unknown status '{unknown[0]}'. Available: {', '.join(JOB_STATUSES)}", 400)
+        query = query.where(Car.status.in_(statuses))
+
+    staff_id = request.args.get('staff_id', type=int)
+    if staff_id is not None:
+        query = query.where(Car.assigned_user_id == staff_id)
+
+    day = request.args.get('date')
+    if day:
+        try:
+            start = datetime.strptime(day, '%Y-%m-%d') - timedelta(hours=3)  # Kenya midnight in UTC
+        except ValueError:
+            return api_error('date must be YYYY-MM-DD', 400)
+        query = query.where(Car.time_in >= start, Car.time_in < start + timedelta(days=1))
+
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.where(Car.id < after)
+
+    # Keyset pagination: one extra row tells us whether there is a next page
+    rows = db.session.execute(query.order_by(Car.id.desc()).limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return _conditional({
+        'jobs': _serialize(rows, fields),
+        'next_cursor': str(rows[-1].id) if has_more else None
+    })
+
+
+@api.route('/jobs/<int:job_id>')
+@token_required
+def get_job(job_id):
+    fields, error = _parse_fields()
+    if error:
+        return api_error(error, 400)
+
+    row = db.session.execute(_visible_to(_job_query(fields)).where(Car.id == job_id)).first()
+    if row is None:
+        return api_error('Job not found', 404)
+    return _conditional(_serialize([row], fields)[0])
+
+
+@api.route('/jobs/<int:job_id>/status', methods=['POST'])
+@token_required
+@idempotent
+def update_job_status(job_id):
+    """
+    Body: {"status": "...", "version": n}
+    A version that no longer matches (someone else changed the job) gets a 409
+    """
+    data = request.get_json(silent=True) or {}
+    new_status = data.get('status')
+    if new_status not in JOB_STATUSES:
+        return api_error(f"status must be one of: {', '.join(JOB_STATUSES)}", 400)
+
+    car = db.session.get(Car, job_id)
+    if car is None or (g.api_user.role != 'admin' and car.assigned_user_id != g.api_user.id):
+        return api_error('Job not found', 404)
+
+    conflict = f'Job for {car.plate_number} was just changed by someone else. Fetch it and try again.'
+    version = data.get('version')
+    if version is not None and str(version) != str(car.version):
+        return api_error(conflict, 409)
+
+    try:
+        car.set_status(new_status, changed_by=g.api_user)
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return api_error(conflict, 409)
+    scheduler.track(car)
+
+    fields = list(DEFAULT_JOB_FIELDS)
+    row = db.session.execute(_job_query(fields).where(Car.id == job_id)).first()
+    return jsonify(_serialize([row], fields)[0])
+
+
+# REFERENCE DATA
+
+@api.route('/services')
+@token_required
+def list_services():
+    rows = db.session.execute(
+        sa.select(Service.id, Service.name, Service.description, Service.price, Service.duration)
+        .where(Service.is_active == True)
+        .order_by(Service.name)
+    ).all()
+    return _conditional({'services': [
+        {'id': r.id, 'name': r.name, 'description': r.description, 'price': r.price, 'duration': r.duration}
+        for r in rows
+    ]})
+
+
+@api.route('/staff')
+@token_required
+def list_staff():
+    """Active staff with their number of unfinished jobs"""
+    rows = db.session.execute(
+        sa.select(User.id, User.username, User.full_name)
+        .where(User.role == 'staff', User.is_active == True)
+        .order_by(User.full_name)
+    ).all()
+    active_jobs = dict(db.session.execute(
+        sa.select(Car.assigned_user_id, sa.func.count(Car.id))
+        .where(Car.status != 'Completed')
+        .group_by(Car.assigned_user_id)
+    ).all())
+    return _conditional({'staff': [
+        {'id': r.id, 'username': r.username, 'full_name': r.full_name, 'active_jobs': active_jobs.get(r.id, 0)}
+        for r in rows
+    ]})
+
+
+@api.route('/stats')
+@token_required
+@admin_token_required
+@read_replica
+def stats():
+    """Today's totals (Kenya day) and the current job count per status"""
+    start = datetime.combine((datetime.utcnow() + timedelta(hours=3)).date(), datetime.min.time()) - timedelta(hours=3)
+    end = start + timedelta(days=1)
+
+    by_status = dict(db.session.execute(
+        sa.select(Car.status, sa.func.count(Car.id)).group_by(Car.status)
+    ).all())
+    jobs_in = db.session.execute(
+        sa.select(sa.func.count(Car.id)).where(Car.time_in >= start, Car.time_in < end)
+    ).scalar()
+    # Completed jobs per service, priced from services (possibly another database)
+    completed_by_service = db.session.execute(
+        sa.select(Car.service_id, sa.func.count(Car.id))
+        .where(Car.status == 'Completed', Car.time_out >= start, Car.time_out < end)
+        .group_by(Car.service_id)
+    ).all()
+    prices = dict(db.session.execute(
+        sa.select(Service.id, Service.price).where(Service.id.in_([service_id for service_id, _ in completed_by_service]))
+    ).all())
+    completed = sum(count for _, count in completed_by_service)
+    revenue = sum((prices.get(service_id) or 0) * count for service_id, count in completed_by_service)
+
+    return _conditional({
+        'branch': g.branch.code if g.branch else None,
+        'date': (start + timedelta(hours=3)).date().isoformat(),
+        'jobs_in': jobs_in,
+        'completed': completed,
+        'revenue': float(revenue),
+        'by_status': {status: by_status.get(status, 0) for status in JOB_STATUSES}
+    })
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return api_error('Not found', 404)
+
+
+@api.errorhandler(405)
+def method_not_allowed(error):
+    return api_error('Method not allowed', 405)
@@ -0,0 +1,54 @@
+import json
+import mimetypes
+import os
+from flask import request, send_from_directory
+
+# Built by build_assets.py: logical path -> content-hashed path under static/dist
+MANIFEST = os.path.join('dist', 'manifest.json')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def init_assets(app):
+    """
+    Serve fingerprinted assets when build_assets.py has been run
+    url_for('static', filename='css/style.css') then returns the hashed file, which is sent
+    precompressed (brotli/gzip) with a one-year immutable Cache-Control
+    """
+    manifest_path = os.path.join(app.static_folder, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        print("[*] Static assets not built, serving plain files (run python build_assets.py)")
+        return
+    app.extensions['assets'] = manifest
+
+    @app.url_defaults
+    def hashed_static_url(endpoint, values):
+        if endpoint == 'static':
+            hashed = manifest.get(values.get('filename'))
+            if hashed:
+                values['filename'] = 'dist/' + hashed
+
+    def static(filename):
+        if not filename.startswith('dist/'):
+            return app.send_static_file(filename)
+
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding, served = None, filename
+        for name, suffix in ENCODINGS:
+            if request.accept_encodings[name] and os.path.isfile(os.path.join(app.static_folder, filename + suffix)):
+                encoding, served = name, filename + suffix
+                break
+
+        response = send_from_directory(app.static_folder, served, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.view_functions['static'] = static
+    print(f"[OK] Serving {len(manifest)} fingerprinted static assets")
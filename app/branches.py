@@ -0,0 +1,273 @@
+"""
+Spot - Branches (multi-site partitioning)
+Every job row (cars, archived_jobs, rollups, cold files) belongs to one branch. A request
+works inside one branch: ORM queries get a `branch_id = ?` criteria added automatically,
+and a branch with a bind_key keeps its job tables in its own database (SQLALCHEMY_BINDS).
+Owners (admins without a branch) can switch branches and see cross-branch rollups.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+import sqlalchemy as sa
+from flask import g, has_app_context, session
+from flask_login import current_user
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.util import find_tables
+from app import db
+from app.models import Branch, BranchScoped, BranchShared, User, Car, ArchivedJob, ColdArchiveFile, DailyRollup
+from app.replica import RoutingSession
+
+# Tables that live in a branch's own database when it has a bind_key
+PARTITIONED_TABLES = ('cars', 'job_status_changes', 'archived_jobs', 'daily_rollups', 'cold_archive_files')
+
+BRANCH_CACHE_SECONDS = 60
+
+BranchInfo = namedtuple('BranchInfo', 'id code name bind_key is_active')
+
+_cache = {'branches': None, 'loaded_at': 0.0}
+_cache_lock = threading.Lock()
+
+
+# LOOKUP
+
+
+def all_branches():
+    """Active and inactive branches, lowest id (the default branch) first; cached per worker"""
+    with _cache_lock:
+        if _cache['branches'] is None or time.monotonic() - _cache['loaded_at'] > BRANCH_CACHE_SECONDS:
+            rows = db.session.execute(sa.select(
+                Branch.id, Branch.code, Branch.name, Branch.bind_key, Branch.is_active
+            ).order_by(Branch.id)).all()
+            _cache['branches'] = [BranchInfo(*row) for row in rows]
+            _cache['loaded_at'] = time.monotonic()
+        return _cache['branches']
+
+
+def invalidate_branches():
+    with _cache_lock:
+        _cache['branches'] = None
+
+
+def get_branch(branch_id):
+    for branch in all_branches():
+        if branch.id == branch_id:
+            return branch
+    return None
+
+
+def default_branch():
+    branches = all_branches()
+    return branches[0] if branches else None
+
+
+# REQUEST SCOPE
+
+
+def _activate(branch):
+    g.branch = branch
+    g.branch_id = branch.id if branch else None
+    g.branch_engine = db.engines[branch.bind_key] if branch and branch.bind_key else None
+
+
+def enter_branch(user, requested=None):
+    """
+    Scope the rest of the request to the user's branch
+    Staff and branch admins always get their own branch; owners get `requested`, the branch
+    picked with the branch switcher, or the default branch
+    """
+    if user.branch_id is not None:
+        branch = get_branch(user.branch_id)
+    else:
+        branch = get_branch(requested) or get_branch(session.get('branch_id')) or default_branch()
+    _activate(branch)
+    return branch
+
+
+@contextmanager
+def branch_scope(branch):
+    """Run queries against another branch, e.g. for cross-branch rollups"""
+    previous = (g.get('branch'), g.get('branch_id'), g.get('branch_engine'))
+    _activate(branch)
+    try:
+        yield branch
+    finally:
+        g.branch, g.branch_id, g.branch_engine = previous
+
+
+@contextmanager
+def unscoped():
+    """Queries that must see every branch, e.g. uniqueness checks on usernames"""
+    previous = g.get('branch_unscoped', False)
+    g.branch_unscoped = True
+    try:
+        yield
+    finally:
+        g.branch_unscoped = previous
+
+
+def partitioned(mapper=None, clause=None):
+    """Whether a statement (or a flush of `mapper`) touches a table kept in the branch database"""
+    if clause is not None:
+        tables = find_tables(clause, include_crud=True)
+        if tables:
+            return any(getattr(table, 'name', None) in PARTITIONED_TABLES for table in tables)
+    if mapper is not None:
+        return mapper.local_table.name in PARTITIONED_TABLES
+    return False
+
+
+def branch_engine():
+    """Engine holding the current branch's job tables, or None for the primary database"""
+    if not has_app_context():
+        return None
+    return g.get('branch_engine')
+
+
+@sa.event.listens_for(RoutingSession, 'do_orm_execute')
+def _scope_to_branch(orm_execute_state):
+    if not has_app_context() or g.get('branch_unscoped'):
+        return
+    branch_id = g.get('branch_id')
+    if branch_id is None or orm_execute_state.is_column_load or orm_execute_state.is_relationship_load:
+        return
+    if not (orm_execute_state.is_select or orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    orm_execute_state.statement = orm_execute_state.statement.options(
+        sa.orm.with_loader_criteria(BranchScoped, lambda cls: cls.branch_id == branch_id, include_aliases=True),
+        sa.orm.with_loader_criteria(BranchShared, lambda cls: sa.or_(cls.branch_id == branch_id,
+                                                                     cls.branch_id == None),
+                                    include_aliases=True)
+    )
+
+
+def init_branches(app):
+    """Scope every signed-in request to a branch and expose it to templates"""
+
+    @app.before_request
+    def scope_request():
+        if current_user.is_authenticated:
+            enter_branch(current_user)
+
+    @app.context_processor
+    def branch_context():
+        owner = current_user.is_authenticated and current_user.is_owner
+        return {
+            'current_branch': g.get('branch'),
+            'switchable_branches': [b for b in all_branches() if b.is_active] if owner else []
+        }
+
+
+class PerBranch:
+    """
+    One instance of a per-worker in-memory model (scheduler, forecaster) per branch;
+    attribute access goes to the current request's branch
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def for_branch(self, branch_id):
+        instance = self._instances.get(branch_id)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(branch_id)
+                if instance is None:
+                    instance = self._instances[branch_id] = self._factory(branch_id)
+        return instance
+
+    def __getattr__(self, name):
+        branch_id = g.get('branch_id') if has_app_context() else None
+        return getattr(self.for_branch(branch_id), name)
+
+
+# MIGRATION
+
+
+def migrate_branches():
+    """Create the default branch, assign existing rows to it and create tables on branch databases"""
+    from sqlalchemy.exc import SQLAlchemyError
+
+    try:
+        inspector = sa.inspect(db.engine)
+        # Rollups gained branch_id in their unique key: start them over (rebuilt from the archive on demand)
+        if 'branch_id' not in [column['name'] for column in inspector.get_columns('daily_rollups')]:
+            DailyRollup.__table__.drop(db.engine)
+            DailyRollup.__table__.create(db.engine)
+            print("[OK] Recreated daily rollups per branch")
+
+        default = Branch.query.order_by(Branch.id).first()
+        if default is None:
+            default = Branch(code='main', name='Main Branch', is_active=True)
+            db.session.add(default)
+            db.session.commit()
+            print(f"[OK] Created default branch '{default.code}'")
+
+        assigned = 0
+        for model in (Car, ArchivedJob, ColdArchiveFile):
+            assigned += model.query.filter(model.branch_id == None).update(
+                {model.branch_id: default.id}, synchronize_session=False)
+        assigned += User.query.filter(User.branch_id == None, User.role != 'admin').update(
+            {User.branch_id: default.id}, synchronize_session=False)
+        db.session.commit()
+        if assigned:
+            print(f"[OK] Assigned {assigned} existing rows to branch '{default.code}'")
+    except SQLAlchemyError as e:
+        print(f"[ERROR] Branch migration error: {str(e)}")
+        db.session.rollback()
+        return
+
+    try:
+        with db.engine.begin() as connection:
+            migrate_plate_index(connection)
+    except SQLAlchemyError as e:
+        print(f"[ERROR] Plate index migration error: {str(e)}")
+
+    for bind_key in sorted({branch.bind_key for branch in Branch.query.all() if branch.bind_key}):
+        create_branch_tables(bind_key)
+
+
+def migrate_plate_index(connection):
+    """Plates were unique per database and are now unique per branch: swap the unique index"""
+    for index in sa.inspect(connection).get_indexes('cars'):
+        if index['name'] == 'ix_cars_plate_number' and index['unique']:
+            connection.execute(sa.text("DROP INDEX ix_cars_plate_number"))
+            connection.execute(sa.text("CREATE INDEX ix_cars_plate_number ON cars (plate_number)"))
+            print("[OK] Made plate numbers unique per branch")
+    connection.execute(sa.text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_cars_branch_plate ON cars (branch_id, plate_number)"))
+
+
+def create_branch_tables(bind_key):
+    """
+    Create the partitioned tables in a branch database (and columns added to them since)
+    Foreign keys are left out: users, services and customers stay in the primary database
+    """
+    engine = db.engines.get(bind_key)
+    if engine is None:
+        print(f"[ERROR] Branch database '{bind_key}' is not configured in BRANCH_DATABASE_URLS")
+        return False
+    with engine.begin() as connection:
+        inspector = sa.inspect(connection)
+        existing = inspector.get_table_names()
+        for name in PARTITIONED_TABLES:
+            table = db.metadata.tables[name]
+            if name in existing:
+                # Nullable columns added since the table was created (MIGRATION_COLUMNS covers the primary)
+                present = {column['name'] for column in inspector.get_columns(name)}
+                for column in table.columns:
+                    if column.name not in present and column.nullable:
+                        connection.execute(sa.text(f"ALTER TABLE {name} ADD COLUMN {column.name} "
+                                                   f"{column.type.compile(dialect=connection.dialect)}"))
+                        print(f"[OK] Added '{column.name}' to '{name}' in branch database '{bind_key}'")
+                if name == 'cars':
+                    migrate_plate_index(connection)
+                continue
+            connection.execute(CreateTable(table, include_foreign_key_constraints=[]))
+            for index in table.indexes:
+                index.create(connection)
+            print(f"[OK] Created '{name}' in branch database '{bind_key}'")
+    return True
@@ -0,0 +1,421 @@
+"""
+Spot - Cold Storage for Archived Jobs
+Moves archived jobs older than ARCHIVE_HOT_MONTHS into monthly Parquet files per branch
+(cold_storage/archived_jobs/branch=N/month=YYYY-MM/part-*.parquet) listed in the cold_archive_files
+manifest, and answers analytics and search over hot rows + cold files together
+"""
+
+import os
+import threading
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models import ArchivedJob, ColdArchiveFile
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+COMPRESSION = 'zstd'
+ROW_GROUP_SIZE = 50000
+SEARCH_COLUMNS = ('plate_number', 'customer_name', 'customer_phone')
+
+
+def _column_type(column):
+    if isinstance(column.type, db.DateTime):
+        return pa.timestamp('us')
+    if isinstance(column.type, db.Float):
+        return pa.float64()
+    if isinstance(column.type, db.Integer):
+        return pa.int64()
+    return pa.string()
+
+
+def archive_schema():
+    """Arrow schema mirroring the archived_jobs table"""
+    return pa.schema([(column.name, _column_type(column)) for column in ArchivedJob.__table__.columns])
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt, months):
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def storage_configured():
+    return bool(current_app.config.get('COLD_STORAGE_DIR'))
+
+
+def storage_path(relative_path):
+    if not storage_configured():
+        raise RuntimeError('COLD_STORAGE_DIR is not set, cold archived jobs cannot be read or written')
+    return os.path.join(current_app.config['COLD_STORAGE_DIR'], relative_path)
+
+
+# TIERING
+
+
+def tier_archived_jobs(hot_months=None, now=None, progress=None):
+    """
+    Move archived jobs from months older than `hot_months` into Parquet, one month at a time
+    Each month is written to a temporary file, renamed into place, then recorded in the manifest
+    and deleted from archived_jobs in one transaction; a failed month leaves no manifest entry
+    `progress` (a background TaskProgress) is told the rows to move and each month moved
+    Refused unless COLD_STORAGE_DIR is set: the files are the only copy of the moved jobs, so
+    they must not land on an ephemeral filesystem by default
+
+    Returns:
+        List of ColdArchiveFile rows created
+    """
+    if not PYARROW_AVAILABLE:
+        raise RuntimeError('pyarrow is required for cold storage (pip install pyarrow)')
+    if not storage_configured():
+        raise RuntimeError('Set COLD_STORAGE_DIR to a persistent directory before moving archives to cold storage')
+
+    hot_months = current_app.config.get('ARCHIVE_HOT_MONTHS', 12) if hot_months is None else hot_months
+    cutoff = add_months(month_start(now or datetime.utcnow()), -hot_months)
+    schema = archive_schema()
+    table = ArchivedJob.__table__
+    created = []
+    if progress is not None:
+        progress.update(total=ArchivedJob.query.filter(ArchivedJob.time_in < cutoff).count())
+
+    while True:
+        oldest = db.session.query(ArchivedJob.branch_id, ArchivedJob.time_in).filter(
+            ArchivedJob.time_in < cutoff).order_by(ArchivedJob.time_in).first()
+        if oldest is None:
+            break
+        branch_id, oldest_time_in = oldest
+        month = month_start(oldest_time_in)
+        next_month = add_months(month, 1)
+
+        # Core select on the table: filter the branch explicitly
+        rows = db.session.execute(
+            db.select(table).where(table.c.branch_id == branch_id,
+                                   table.c.time_in >= month, table.c.time_in < next_month).order_by(table.c.id)
+        ).mappings().all()
+        data = pa.Table.from_pylist([dict(row) for row in rows], schema=schema)
+
+        relative_path = os.path.join('archived_jobs', f'branch={branch_id}', f'month={month:%Y-%m}',
+                                     f'part-{datetime.utcnow():%Y%m%d%H%M%S}-{rows[0]["id"]}.parquet')
+        path = storage_path(relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(data, path + '.tmp', compression=COMPRESSION, row_group_size=ROW_GROUP_SIZE)
+        os.replace(path + '.tmp', path)
+
+        try:
+            entry = ColdArchiveFile(
+                branch_id=branch_id,
+                month=month.date(),
+                path=relative_path,
+                row_count=len(rows),
+                size_bytes=os.path.getsize(path),
+                min_time_in=min(row['time_in'] for row in rows),
+                max_time_in=max(row['time_in'] for row in rows),
+                min_archived_at=min((row['archived_at'] for row in rows if row['archived_at']), default=None),
+                max_archived_at=max((row['archived_at'] for row in rows if row['archived_at']), default=None)
+            )
+            db.session.add(entry)
+            ArchivedJob.query.filter(
+                ArchivedJob.branch_id == branch_id,
+                ArchivedJob.time_in >= month,
+                ArchivedJob.time_in < next_month,
+                ArchivedJob.id <= rows[-1]['id']
+            ).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            os.remove(path)
+            raise
+
+        created.append(entry)
+        print(f"[OK] Moved {len(rows)} archived jobs from {month:%Y-%m} to {relative_path} "
+              f"({entry.size_bytes / 1024:.0f} KB)")
+        if progress is not None:
+            progress.advance(len(rows), f'Moved {month:%Y-%m}')
+
+    return created
+
+
+def clear_cold_storage():
+    """Delete every cold file and the manifest (caller commits)"""
+    for entry in ColdArchiveFile.query.all():
+        try:
+            os.remove(storage_path(entry.path))
+        except FileNotFoundError:
+            pass
+    ColdArchiveFile.query.delete()
+    _summary_cache.clear()
+
+
+# READING
+
+
+def _manifest():
+    return ColdArchiveFile.query.order_by(ColdArchiveFile.month.desc(), ColdArchiveFile.id.desc()).all()
+
+
+def cold_storage_summary():
+    """Files, rows, bytes and covered months of cold storage, from the manifest alone"""
+    files, rows, size, first, last = db.session.query(
+        db.func.count(ColdArchiveFile.id),
+        db.func.sum(ColdArchiveFile.row_count),
+        db.func.sum(ColdArchiveFile.size_bytes),
+        db.func.min(ColdArchiveFile.month),
+        db.func.max(ColdArchiveFile.month)
+    ).one()
+    return {'files': files, 'rows': rows or 0, 'size_bytes': size or 0, 'first_month': first, 'last_month': last}
+
+
+def _require_pyarrow(entries):
+    if entries and not PYARROW_AVAILABLE:
+        raise RuntimeError('pyarrow is required to read cold archived jobs (pip install pyarrow)')
+
+
+def _dataset(entries):
+    return ds.dataset([storage_path(entry.path) for entry in entries], format='parquet', schema=archive_schema())
+
+
+_summary_cache = {}
+_summary_lock = threading.Lock()
+
+
+def _file_summary(entry):
+    """
+    Per-service and per-staff aggregates of one cold file
+    Files never change once written, so summaries are cached per path
+    """
+    with _summary_lock:
+        cached = _summary_cache.get(entry.path)
+    if cached is not None:
+        return cached
+
+    data = pq.read_table(storage_path(entry.path),
+                         columns=['service_name', 'staff_name', 'service_price', 'duration_minutes'])
+    all_rows = pc.CountOptions(mode='all')
+    services = data.group_by('service_name').aggregate([
+        ('service_name', 'count', all_rows), ('service_price', 'sum'),
+        ('duration_minutes', 'sum'), ('duration_minutes', 'count'),
+        ('duration_minutes', 'min'), ('duration_minutes', 'max')
+    ]).to_pylist()
+    staff = data.group_by('staff_name').aggregate([
+        ('staff_name', 'count', all_rows), ('duration_minutes', 'sum'), ('duration_minutes', 'count')
+    ]).to_pylist()
+
+    summary = {
+        'services': {row['service_name']: (row['service_name_count'], row['service_price_sum'] or 0.0,
+                                           row['duration_minutes_sum'] or 0, row['duration_minutes_count'],
+                                           row['duration_minutes_min'], row['duration_minutes_max'])
+                     for row in services},
+        'staff': {row['staff_name']: (row['staff_name_count'], row['duration_minutes_sum'] or 0,
+                                      row['duration_minutes_count'])
+                  for row in staff if row['staff_name'] is not None},
+    }
+    with _summary_lock:
+        _summary_cache[entry.path] = summary
+    return summary
+
+
+def archive_totals():
+    """(job count, revenue) over hot rows and cold files"""
+    count = ArchivedJob.query.count()
+    revenue = db.session.query(db.func.sum(ArchivedJob.service_price)).scalar() or 0
+    entries = _manifest()
+    _require_pyarrow(entries)
+    for entry in entries:
+        count += entry.row_count
+        revenue += sum(stats[1] for stats in _file_summary(entry)['services'].values())
+    return count, revenue
+
+
+def archive_service_stats():
+    """
+    Per-service [name, jobs, revenue, duration sum, duration count, min, max] over hot and cold data
+    """
+    merged = {}
+    for row in db.session.query(
+        ArchivedJob.service_name,
+        db.func.count(ArchivedJob.id),
+        db.func.sum(ArchivedJob.service_price),
+        db.func.sum(ArchivedJob.duration_minutes),
+        db.func.count(ArchivedJob.duration_minutes),
+        db.func.min(ArchivedJob.duration_minutes),
+        db.func.max(ArchivedJob.duration_minutes)
+    ).group_by(ArchivedJob.service_name):
+        merged[row[0]] = [row[0], row[1], row[2] or 0.0, row[3] or 0, row[4], row[5], row[6]]
+
+    entries = _manifest()
+    _require_pyarrow(entries)
+    for entry in entries:
+        for name, (jobs, revenue, duration_sum, duration_count, low, high) in _file_summary(entry)['services'].items():
+            stats = merged.setdefault(name, [name, 0, 0.0, 0, 0, None, None])
+            stats[1] += jobs
+            stats[2] += revenue
+            stats[3] += duration_sum
+            stats[4] += duration_count
+            if low is not None:
+                stats[5] = low if stats[5] is None else min(stats[5], low)
+                stats[6] = high if stats[6] is None else max(stats[6], high)
+    return list(merged.values())
+
+
+def archive_staff_stats():
+    """Per-staff (name, jobs, average duration) over hot and cold data, busiest first"""
+    merged = {}
+    for name, jobs, duration_sum, duration_count in db.session.query(
+        ArchivedJob.staff_name,
+        db.func.count(ArchivedJob.id),
+        db.func.sum(ArchivedJob.duration_minutes),
+        db.func.count(ArchivedJob.duration_minutes)
+    ).filter(ArchivedJob.staff_name != None).group_by(ArchivedJob.staff_name):
+        merged[name] = [jobs, duration_sum or 0, duration_count]
+
+    entries = _manifest()
+    _require_pyarrow(entries)
+    for entry in entries:
+        for name, (jobs, duration_sum, duration_count) in _file_summary(entry)['staff'].items():
+            stats = merged.setdefault(name, [0, 0, 0])
+            stats[0] += jobs
+            stats[1] += duration_sum
+            stats[2] += duration_count
+
+    results = [(name, jobs, duration_sum / duration_count if duration_count else None)
+               for name, (jobs, duration_sum, duration_count) in merged.items()]
+    return sorted(results, key=lambda row: row[1], reverse=True)
+
+
+class ColdJob:
+    """Read-only stand-in for an ArchivedJob row that lives in a cold file"""
+    is_cold = True
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+class ArchivePage:
+    """Minimal Flask-SQLAlchemy style pagination over hot rows followed by cold rows"""
+
+    def __init__(self, page, per_page, total, items):
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self.items = items
+        self.pages = max(1, -(-total // per_page))
+        self.has_prev = page > 1
+        self.has_next = page < self.pages
+        self.prev_num = page - 1 if self.has_prev else None
+        self.next_num = page + 1 if self.has_next else None
+
+
+def _hot_match(search):
+    return db.or_(*[getattr(ArchivedJob, column).ilike(f'%{search}%') for column in SEARCH_COLUMNS])
+
+
+def _cold_match(search):
+    needle = search.lower()
+    condition = None
+    for column in SEARCH_COLUMNS:
+        match = pc.match_substring(pc.utf8_lower(pc.field(column)), needle)
+        condition = match if condition is None else condition | match
+    return condition
+
+
+def search_archived_jobs(search='', page=1, per_page=50):
+    """
+    Archived jobs newest first: hot rows from the database, then rows from cold files
+    A search matches plate, customer name or phone; cold files are scanned with only the
+    searched columns decoded, and unsearched pages only open the files they need
+
+    Returns:
+        ArchivePage
+    """
+    page = max(page, 1)
+    query = ArchivedJob.query
+    if search:
+        query = query.filter(_hot_match(search))
+
+    hot_total = query.count()
+    offset = (page - 1) * per_page
+    items = query.order_by(ArchivedJob.archived_at.desc()).offset(offset).limit(per_page).all() \
+        if offset < hot_total else []
+
+    entries = _manifest()
+    _require_pyarrow(entries)
+    if not entries:
+        return ArchivePage(page, per_page, hot_total, items)
+
+    # Cold rows needed for this page, counted from the start of cold data
+    cold_offset = max(0, offset - hot_total)
+    cold_limit = per_page - len(items)
+
+    if search:
+        dataset = _dataset(entries)
+        matching = dataset.to_table(columns=['id', 'archived_at'], filter=_cold_match(search))
+        cold_total = matching.num_rows
+        if cold_limit > 0 and cold_offset < cold_total:
+            order = pc.sort_indices(matching, sort_keys=[('archived_at', 'descending')])
+            wanted = matching.take(order[cold_offset:cold_offset + cold_limit])['id']
+            rows = dataset.to_table(filter=pc.field('id').isin(wanted)).sort_by([('archived_at', 'descending')])
+            items += [ColdJob(row) for row in rows.to_pylist()]
+        return ArchivePage(page, per_page, hot_total + cold_total, items)
+
+    cold_total = sum(entry.row_count for entry in entries)
+    skipped = 0
+    for entry in entries:
+        if cold_limit <= 0:
+            break
+        if skipped + entry.row_count <= cold_offset:
+            skipped += entry.row_count
+            continue
+        rows = pq.read_table(storage_path(entry.path)).sort_by([('archived_at', 'descending')])
+        start = max(0, cold_offset - skipped)
+        chunk = rows.slice(start, cold_limit).to_pylist()
+        items += [ColdJob(row) for row in chunk]
+        cold_limit -= len(chunk)
+        skipped += entry.row_count
+    return ArchivePage(page, per_page, hot_total + cold_total, items)
+
+
+def iter_archived_jobs(search='', batch_size=1000):
+    """
+    Every archived job matching `search`, newest first, in batches: hot rows are fetched
+    batch by batch from the database, then cold files are read one at a time, so memory
+    stays flat however many jobs match (used by the CSV export)
+
+    Yields:
+        lists of ArchivedJob / ColdJob
+    """
+    statement = db.select(ArchivedJob).order_by(ArchivedJob.archived_at.desc())
+    if search:
+        statement = statement.where(_hot_match(search))
+    for batch in db.session.scalars(statement.execution_options(yield_per=batch_size)).partitions():
+        yield batch
+
+    entries = _manifest()
+    _require_pyarrow(entries)
+    for entry in entries:
+        rows = pq.read_table(storage_path(entry.path), filters=_cold_match(search) if search else None)
+        for batch in rows.sort_by([('archived_at', 'descending')]).to_batches(max_chunksize=batch_size):
+            yield [ColdJob(row) for row in batch.to_pylist()]
+
+
+def iter_cold_jobs(columns, batch_size=1000):
+    """
+    Every job in cold storage with only `columns` decoded, one file at a time, in batches
+
+    Yields:
+        lists of ColdJob
+    """
+    entries = _manifest()
+    _require_pyarrow(entries)
+    for entry in entries:
+        for batch in pq.read_table(storage_path(entry.path), columns=list(columns)).to_batches(max_chunksize=batch_size):
+            yield [ColdJob(row) for row in batch.to_pylist()]
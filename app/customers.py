@@ -0,0 +1,331 @@
+from collections import defaultdict
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Customer, Car, ArchivedJob
+from app.utils import format_phone_number
+from app.branches import all_branches, branch_scope
+from app.cold_storage import iter_cold_jobs
+
+BACKFILL_CHUNK_SIZE = 20000
+IN_CHUNK_SIZE = 500  # bound parameters per IN (...) query
+
+
+def normalize_phone(phone):
+    """+254 form of a phone number, or None if it is blank"""
+    if not phone or not phone.strip():
+        return None
+    return format_phone_number(phone)
+
+
+def _prefix_range(column, prefix):
+    """`column LIKE 'prefix%'` written as a range so a plain B-tree index is used"""
+    return db.and_(column >= prefix, column < prefix + '\uffff')
+
+
+def search_customers(query, limit=8):
+    """
+    Prefix search by phone (any local format) or name, most frequent customers first
+
+    Args:
+        query: What has been typed so far, e.g. '0712', '+25471' or 'mary'
+        limit: Maximum results
+
+    Returns:
+        List of Customer objects
+    """
+    query = query.strip()
+    if len(query) < 2:
+        return []
+
+    digits = query.replace(' ', '').replace('-', '')
+    if digits.lstrip('+').isdigit():
+        # '2', '25' and '254' are the start of the country code, not a local number
+        bare = digits.lstrip('+')
+        prefix = '+' + bare if '254'.startswith(bare) or digits.startswith('+') else format_phone_number(digits)
+        condition = _prefix_range(Customer.phone, prefix)
+    else:
+        condition = _prefix_range(Customer.name_key, query.lower())
+
+    return Customer.query.filter(condition).order_by(Customer.visits.desc()).limit(limit).all()
+
+
+def _new_customer(phone, name):
+    name = (name or phone).strip()
+    return Customer(phone=phone, name=name, name_key=name.lower(), visits=0, total_spent=0.0)
+
+
+def _insert_customers(names):
+    """
+    Add customers for phones that had none at lookup time, inside a savepoint
+    Another request may add the same new phone in between (phone is unique): that
+    phone's insert fails alone and the row the other request committed is used
+
+    Args:
+        names: Dictionary of normalized phone -> name
+
+    Returns:
+        Dictionary of normalized phone -> Customer
+    """
+    created = {phone: _new_customer(phone, name) for phone, name in names.items()}
+    try:
+        with db.session.begin_nested():
+            db.session.add_all(created.values())
+        return created
+    except IntegrityError:
+        pass
+
+    # Some phone was taken concurrently: one savepoint per phone to find which
+    for phone, name in names.items():
+        try:
+            with db.session.begin_nested():
+                db.session.add(created[phone])
+        except IntegrityError:
+            created[phone] = Customer.query.filter_by(phone=phone).one()
+    return created
+
+
+def find_or_create_customer(name, phone, email=None, plate=None, car_model=None):
+    """
+    Customer for a phone number, created on first visit
+    Name, email and vehicle are refreshed to the latest values given (caller commits)
+
+    Returns:
+        Customer, or None if the phone is blank
+    """
+    normalized = normalize_phone(phone)
+    if normalized is None:
+        return None
+
+    customer = Customer.query.filter_by(phone=normalized).first()
+    if customer is None:
+        customer = _insert_customers({normalized: name})[normalized]
+
+    if name:
+        customer.name = name.strip()
+        customer.name_key = customer.name.lower()
+    if email:
+        customer.email = email
+    if plate:
+        customer.last_plate = plate
+    if car_model:
+        customer.last_car_model = car_model
+    db.session.flush()
+    return customer
+
+
+def find_or_create_customers(entries):
+    """
+    Batch version of find_or_create_customer: one IN query for all phones (caller commits)
+
+    Args:
+        entries: Iterable of (name, phone, email, plate, car_model)
+
+    Returns:
+        Dictionary of normalized phone -> Customer
+    """
+    entries = [(normalize_phone(phone), name, email, plate, car_model)
+               for name, phone, email, plate, car_model in entries]
+    phones = {phone for phone, *_ in entries if phone}
+
+    customers = {}
+    phone_list = list(phones)
+    for offset in range(0, len(phone_list), IN_CHUNK_SIZE):
+        chunk = phone_list[offset:offset + IN_CHUNK_SIZE]
+        customers.update((c.phone, c) for c in Customer.query.filter(Customer.phone.in_(chunk)))
+
+    missing = {}
+    for phone, name, *_ in entries:
+        if phone is not None and phone not in customers:
+            missing[phone] = name or missing.get(phone)
+    if missing:
+        customers.update(_insert_customers(missing))
+
+    for phone, name, email, plate, car_model in entries:
+        if phone is None:
+            continue
+        customer = customers[phone]
+        if name:
+            customer.name = name.strip()
+            customer.name_key = customer.name.lower()
+        customer.email = email or customer.email
+        customer.last_plate = plate or customer.last_plate
+        customer.last_car_model = car_model or customer.last_car_model
+    db.session.flush()
+    return customers
+
+
+def record_visits(archived_jobs):
+    """
+    Add newly archived jobs to their customers' loyalty counters (caller commits)
+    Jobs without a customer_id are linked by phone first
+    """
+    for job in archived_jobs:
+        if job.customer_id is None:
+            customer = find_or_create_customer(job.customer_name, job.customer_phone, job.customer_email)
+            job.customer_id = customer.id if customer else None
+
+    by_customer = defaultdict(list)
+    for job in archived_jobs:
+        if job.customer_id is not None:
+            by_customer[job.customer_id].append(job)
+    if not by_customer:
+        return
+
+    for customer in Customer.query.filter(Customer.id.in_(by_customer)):
+        _add_visits(customer, [(job.service_price, job.time_in) for job in by_customer[customer.id]])
+
+
+def remove_visit(archived_job):
+    """Take a deleted archived job off its customer's counters (caller commits)"""
+    if archived_job.customer_id is None:
+        return
+    customer = Customer.query.get(archived_job.customer_id)
+    if customer:
+        customer.visits = max(0, customer.visits - 1)
+        customer.total_spent = max(0.0, customer.total_spent - (archived_job.service_price or 0.0))
+
+
+def archived_customer_ids():
+    """Ids of customers with archived jobs (hot or cold) in the current branch"""
+    ids = {customer_id for (customer_id,) in db.session.query(ArchivedJob.customer_id).filter(
+        ArchivedJob.customer_id != None).distinct()}
+    for batch in iter_cold_jobs(['customer_id'], batch_size=10000):
+        ids.update(job.customer_id for job in batch if job.customer_id is not None)
+    return ids
+
+
+def recompute_visits(customer_ids):
+    """
+    Rebuild the counters of `customer_ids` from the archived jobs left in every branch,
+    e.g. after one branch's archive was cleared (customers are shared by all branches; caller commits)
+    """
+    totals = {customer_id: [0, 0.0, None, None] for customer_id in customer_ids}
+    if not totals:
+        return
+
+    def add(customer_id, visits, spent, first, last):
+        stats = totals[customer_id]
+        stats[0] += visits
+        stats[1] += spent or 0.0
+        if first is not None:
+            stats[2] = first if stats[2] is None else min(stats[2], first)
+            stats[3] = last if stats[3] is None else max(stats[3], last)
+
+    ids = list(totals)
+    for branch in all_branches():
+        with branch_scope(branch):
+            for offset in range(0, len(ids), IN_CHUNK_SIZE):
+                for row in db.session.query(
+                    ArchivedJob.customer_id,
+                    db.func.count(ArchivedJob.id),
+                    db.func.sum(ArchivedJob.service_price),
+                    db.func.min(ArchivedJob.time_in),
+                    db.func.max(ArchivedJob.time_in)
+                ).filter(ArchivedJob.customer_id.in_(ids[offset:offset + IN_CHUNK_SIZE])).group_by(
+                        ArchivedJob.customer_id):
+                    add(*row)
+            for batch in iter_cold_jobs(['customer_id', 'service_price', 'time_in'], batch_size=10000):
+                for job in batch:
+                    if job.customer_id in totals:
+                        add(job.customer_id, 1, job.service_price, job.time_in, job.time_in)
+
+    db.session.execute(db.update(Customer), [
+        {'id': customer_id, 'visits': visits, 'total_spent': spent, 'first_visit': first, 'last_visit': last}
+        for customer_id, (visits, spent, first, last) in totals.items()
+    ])
+
+
+def _add_visits(customer, visits):
+    times = [time_in for _, time_in in visits if time_in is not None]
+    customer.visits = (customer.visits or 0) + len(visits)
+    customer.total_spent = (customer.total_spent or 0.0) + sum(price or 0.0 for price, _ in visits)
+    if times:
+        customer.first_visit = min([customer.first_visit] + times) if customer.first_visit else min(times)
+        customer.last_visit = max([customer.last_visit] + times) if customer.last_visit else max(times)
+
+
+def _pending_phone(column):
+    """A job phone the backfill can link: set and not blank"""
+    return db.and_(column != None, db.func.trim(column) != '')
+
+
+def link_customers():
+    """
+    Create customers for archived jobs and cars that have no customer_id yet, in every branch
+    Rows are read in id order in chunks, linked with bulk primary-key updates and committed per
+    chunk, so a large archive doesn't sit in one transaction and an interrupted run picks up where
+    it stopped. Run it once after upgrading (`flask --app run link-customers`), not from a worker:
+    rows with a blank phone can't be linked and are left alone
+
+    Returns:
+        Number of jobs linked
+    """
+    linked = 0
+    for branch in all_branches():
+        with branch_scope(branch):
+            linked += _link_branch_customers(branch)
+    print(f"[OK] Linked {linked} jobs to customers")
+    return linked
+
+
+def _link_branch_customers(branch):
+    linked = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            ArchivedJob.id, ArchivedJob.customer_name, ArchivedJob.customer_phone, ArchivedJob.customer_email,
+            ArchivedJob.plate_number, ArchivedJob.car_model, ArchivedJob.service_price, ArchivedJob.time_in
+        ).filter(
+            ArchivedJob.id > last_id,
+            ArchivedJob.customer_id == None,
+            _pending_phone(ArchivedJob.customer_phone)
+        ).order_by(ArchivedJob.id).limit(BACKFILL_CHUNK_SIZE).all()
+        if not rows:
+            break
+
+        # Rows arrive oldest first, so the latest details win
+        customers = find_or_create_customers(
+            (name, phone, email, plate, car_model) for _, name, phone, email, plate, car_model, _, _ in rows)
+        visits = defaultdict(list)
+        for job_id, _, phone, _, _, _, price, time_in in rows:
+            customer = customers.get(normalize_phone(phone))
+            if customer is not None:
+                visits[customer].append((job_id, price, time_in))
+
+        updates = []
+        for customer, jobs in visits.items():
+            _add_visits(customer, [(price, time_in) for _, price, time_in in jobs])
+            updates.extend({'id': job_id, 'customer_id': customer.id} for job_id, _, _ in jobs)
+        if updates:
+            db.session.execute(db.update(ArchivedJob), updates)
+        db.session.commit()
+
+        linked += len(updates)
+        last_id = rows[-1][0]
+        print(f"[*] {branch.name}: linked {linked} archived jobs...")
+
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            Car.id, Car.version, Car.customer_name, Car.customer_phone, Car.customer_email, Car.plate_number,
+            Car.car_model
+        ).filter(
+            Car.id > last_id,
+            Car.customer_id == None,
+            _pending_phone(Car.customer_phone)
+        ).order_by(Car.id).limit(BACKFILL_CHUNK_SIZE).all()
+        if not rows:
+            break
+
+        customers = find_or_create_customers(
+            (name, phone, email, plate, car_model) for _, _, name, phone, email, plate, car_model in rows)
+        # Versioned rows: a car edited since it was read fails the update instead of being overwritten
+        updates = [{'id': car_id, 'version': version, 'customer_id': customers[normalize_phone(phone)].id}
+                   for car_id, version, _, phone, _, _, _ in rows if normalize_phone(phone) in customers]
+        if updates:
+            db.session.execute(db.update(Car), updates)
+        db.session.commit()
+
+        linked += len(updates)
+        last_id = rows[-1][0]
+    return linked
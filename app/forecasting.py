@@ -0,0 +1,152 @@
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from app import db
+from app.models import ArchivedJob
+from app.replica import read_engine
+from app.branches import PerBranch
+
+HOURS_PER_WEEK = 168
+KENYA_OFFSET_SECONDS = 3 * 3600
+CHUNK_SIZE = 100000
+
+
+def hour_of_week(epoch_seconds):
+    """
+    Hour of the week in Kenya time (Monday 00:00 = 0) for an array of UTC epoch seconds
+    1970-01-01 was a Thursday, hence the +3 days
+    """
+    local_hours = (np.asarray(epoch_seconds, dtype=np.int64) + KENYA_OFFSET_SECONDS) // 3600
+    return ((local_hours // 24 + 3) % 7) * 24 + local_hours % 24
+
+
+def epoch_seconds(column):
+    """SQL expression for a DateTime column as Unix seconds"""
+    if db.engine.dialect.name == 'postgresql':
+        return db.cast(db.func.extract('epoch', column), db.BigInteger)
+    return db.cast(db.func.strftime('%s', column), db.Integer)
+
+
+class DemandForecaster:
+    """
+    Hour-of-week x service arrival profiles built from ArchivedJob.time_in
+    Rows are streamed as (id, service_name, epoch) tuples and counted with np.bincount;
+    later refreshes only read archive rows above the last seen id
+    """
+
+    def __init__(self, branch_id=None):
+        self.branch_id = branch_id                              # None = every branch
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.services = []                                      # code -> service name
+        self.counts = np.zeros((0, HOURS_PER_WEEK), dtype=np.int64)
+        self.watermark = 0                                      # highest ArchivedJob.id counted
+        self.first_epoch = None
+        self.last_epoch = None
+
+    def refresh(self):
+        """
+        Fold newly archived jobs into the profiles
+        Rebuilds from scratch if archives were deleted below the watermark
+
+        Returns:
+            Number of archive rows read
+        """
+        with self._lock:
+            max_id = db.session.query(db.func.max(ArchivedJob.id)).scalar() or 0
+            if max_id < self.watermark:
+                self.reset()
+            if max_id == self.watermark:
+                return 0
+
+            codes = {name: code for code, name in enumerate(self.services)}
+            query = db.select(
+                ArchivedJob.id,
+                ArchivedJob.service_name,
+                epoch_seconds(ArchivedJob.time_in)
+            ).where(
+                ArchivedJob.id > self.watermark,
+                ArchivedJob.id <= max_id,
+                ArchivedJob.time_in != None
+            )
+            # Core query on a plain connection: the session's branch criteria don't apply
+            if self.branch_id is not None:
+                query = query.where(ArchivedJob.branch_id == self.branch_id)
+
+            rows_read = 0
+            with read_engine().connect() as connection:
+                result = connection.execution_options(stream_results=True).execute(query)
+                for chunk in result.partitions(CHUNK_SIZE):
+                    ids, names, epochs = (np.array(column) for column in zip(*chunk))
+                    epochs = epochs.astype(np.int64)
+
+                    # Map service names to stable codes, adding new services as rows
+                    unique_names, inverse = np.unique(names.astype(str), return_inverse=True)
+                    for name in unique_names:
+                        if name not in codes:
+                            codes[name] = len(self.services)
+                            self.services.append(name)
+                    chunk_codes = np.array([codes[name] for name in unique_names])[inverse]
+                    if len(self.services) > self.counts.shape[0]:
+                        grown = np.zeros((len(self.services), HOURS_PER_WEEK), dtype=np.int64)
+                        grown[:self.counts.shape[0]] = self.counts
+                        self.counts = grown
+
+                    flat = chunk_codes * HOURS_PER_WEEK + hour_of_week(epochs)
+                    self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+
+                    low, high = int(epochs.min()), int(epochs.max())
+                    self.first_epoch = low if self.first_epoch is None else min(self.first_epoch, low)
+                    self.last_epoch = high if self.last_epoch is None else max(self.last_epoch, high)
+                    rows_read += len(ids)
+
+            self.watermark = max_id
+            return rows_read
+
+    def profiles(self):
+        """
+        Average arrivals per hour-of-week for each service
+
+        Returns:
+            (service names, array of shape (services, 168))
+        """
+        if self.first_epoch is None:
+            return [], np.zeros((0, HOURS_PER_WEEK))
+
+        # How many times each hour-of-week occurred in the observed span
+        first_hour = self.first_epoch // 3600
+        last_hour = self.last_epoch // 3600
+        occurrences = np.bincount(
+            hour_of_week(np.arange(first_hour, last_hour + 1, dtype=np.int64) * 3600),
+            minlength=HOURS_PER_WEEK
+        )
+        return list(self.services), self.counts / np.maximum(occurrences, 1)
+
+    def forecast(self, start=None, hours=24):
+        """
+        Expected arrivals per hour, per service, starting at `start` (UTC, default: next full hour)
+
+        Returns:
+            List of {'hour': datetime (UTC), 'total': float, 'services': {name: float}}
+        """
+        self.refresh()
+        services, rates = self.profiles()
+
+        start = start or datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        start_epoch = int((start - datetime(1970, 1, 1)).total_seconds())
+        slots = hour_of_week(start_epoch + np.arange(hours, dtype=np.int64) * 3600)
+
+        forecast = []
+        for offset, slot in enumerate(slots):
+            per_service = rates[:, slot] if len(services) else np.zeros(0)
+            forecast.append({
+                'hour': start + timedelta(hours=offset),
+                'total': float(per_service.sum()),
+                'services': {name: float(rate) for name, rate in zip(services, per_service) if rate > 0}
+            })
+        return forecast
+
+
+forecaster = PerBranch(DemandForecaster)
@@ -1,7 +1,10 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SelectField, TextAreaField, FloatField, IntegerField
+from flask_wtf.file import FileField, FileAllowed, FileRequired
+from wtforms import (StringField, PasswordField, BooleanField, SelectField, TextAreaField, FloatField, IntegerField,
+                     HiddenField)
 from wtforms.validators import DataRequired, Email, Length, Optional, ValidationError, EqualTo
 from app.models import User, Service, Car
+from app.branches import unscoped
 from flask_login import current_user
 
 
@@ -29,11 +32,18 @@ class AddCarForm(FlaskForm):
     notes = TextAreaField('Additional Notes', validators=[Optional()])
     
     def validate_plate_number(self, field):
-        """Check if plate number already exists"""
+        """Check if plate number is already on the floor at this branch (unique per branch)"""
         plate = field.data.upper().strip()
         existing = Car.query.filter_by(plate_number=plate).first()
         if existing:
-            raise ValidationError('This plate number is already registered in the system.')
+            raise ValidationError('This plate number is already registered at this branch.')
+
+
+class BulkIntakeForm(FlaskForm):
+    """Form to import many cars/jobs from a CSV file"""
+    csv_file = FileField('CSV File', validators=[FileRequired(), FileAllowed(['csv'], 'CSV files only.')])
+    service_id = SelectField('Default Service', coerce=int, validators=[Optional()])
+    auto_assign = BooleanField('Assign staff automatically', default=True)
 
 
 class EditCarForm(FlaskForm):
@@ -58,6 +68,9 @@ class EditCarForm(FlaskForm):
         ('Completed', 'Completed')
     ], validators=[DataRequired()])
     notes = TextAreaField('Additional Notes', validators=[Optional()])
+    
+    # Car.version when the form was loaded; a mismatch on submit means someone else changed the job
+    version = HiddenField()
 
 
 class AddServiceForm(FlaskForm):
@@ -66,10 +79,12 @@ class AddServiceForm(FlaskForm):
     description = TextAreaField('Description', validators=[Optional()])
     price = FloatField('Price (KSh)', validators=[DataRequired()])
     duration = IntegerField('Duration (minutes)', validators=[DataRequired()])
+    all_branches = BooleanField('Offer at every branch')  # owners only; otherwise the current branch
     
     def validate_name(self, field):
-        """Check if service name already exists"""
-        existing = Service.query.filter_by(name=field.data.strip()).first()
+        """Check if service name already exists at any branch (services all live in the main database)"""
+        with unscoped():
+            existing = Service.query.filter_by(name=field.data.strip()).first()
         if existing:
             raise ValidationError('A service with this name already exists.')
     
@@ -111,16 +126,19 @@ class AddUserForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired(), Length(min=6)])
     role = SelectField('Role', choices=[('admin', 'Admin'), ('staff', 'Staff')], validators=[DataRequired()])
     is_active = BooleanField('Active', default=True)
+    owner = BooleanField('Owner (all branches)')  # owners only; admins without a branch
     
     def validate_username(self, field):
         """Check if username already exists"""
-        existing = User.query.filter_by(username=field.data.strip()).first()
+        with unscoped():
+            existing = User.query.filter_by(username=field.data.strip()).first()
         if existing:
             raise ValidationError('This username is already taken.')
     
     def validate_email(self, field):
         """Check if email already exists"""
-        existing = User.query.filter_by(email=field.data.strip()).first()
+        with unscoped():
+            existing = User.query.filter_by(email=field.data.strip()).first()
         if existing:
             raise ValidationError('This email is already registered.')
 
@@ -172,6 +190,25 @@ class UpdateProfileForm(FlaskForm):
         from app.models import User
         from flask_login import current_user
         
-        existing = User.query.filter_by(email=field.data.strip()).first()
+        with unscoped():
+            existing = User.query.filter_by(email=field.data.strip()).first()
         if existing and existing.id != current_user.id:
             raise ValidationError('This email is already registered by another user.')
+
+
+class AddBranchForm(FlaskForm):
+    """Form to add a branch (owners only)"""
+    name = StringField('Branch Name', validators=[DataRequired(), Length(max=100)])
+    code = StringField('Code', validators=[DataRequired(), Length(min=2, max=20)])
+    location = StringField('Location', validators=[Optional(), Length(max=200)])
+    bind_key = SelectField('Database', validators=[Optional()])
+    
+    def validate_code(self, field):
+        """Codes are short slugs, unique across branches"""
+        from app.models import Branch
+        
+        code = field.data.strip().lower()
+        if not code.replace('-', '').isalnum():
+            raise ValidationError('Use letters, numbers and dashes only.')
+        if Branch.query.filter_by(code=code).first():
+            raise ValidationError('A branch with this code already exists.')
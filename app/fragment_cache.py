@@ -0,0 +1,79 @@
+import os
+import threading
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from app.metrics import FRAGMENT_CACHE
+
+
+class FragmentCache:
+    """
+    Bounded LRU of rendered template fragments (per worker)
+    Keys include a row version, so entries are never invalidated; stale ones just age out
+    (row keys also carry time_in because SQLite can reuse the id of a deleted car)
+    """
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+fragment_cache = FragmentCache()
+
+
+class FragmentCacheExtension(Extension):
+    """
+    {% cache 'name', key, ... %}...{% endcache %}
+    Renders the body once per distinct key and reuses the HTML afterwards
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(key)]), [], [], body).set_lineno(lineno)
+
+    def _render(self, key, caller):
+        key = tuple(key)
+        html = fragment_cache.get(key)
+        if html is None:
+            FRAGMENT_CACHE.labels('miss').inc()
+            html = caller()
+            fragment_cache.set(key, html)
+        else:
+            FRAGMENT_CACHE.labels('hit').inc()
+        return html
+
+
+def init_fragment_cache(app):
+    """Enable {% cache %} in templates and the on-disk Jinja bytecode cache"""
+    fragment_cache.max_entries = app.config.get('FRAGMENT_CACHE_SIZE', 2000)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+
+    # Compiled templates survive worker restarts instead of being recompiled by every new worker
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
@@ -0,0 +1,168 @@
+import hashlib
+import time
+import uuid
+from datetime import datetime, timedelta
+from functools import wraps
+import sqlalchemy as sa
+from flask import Response, current_app, flash, g, jsonify, request
+from flask_login import current_user
+from markupsafe import Markup
+from app import db
+from app.models import IdempotencyKey
+
+# Clients send the key as a header (API) or a hidden form field (idempotency_field() in templates)
+KEY_HEADER = 'Idempotency-Key'
+KEY_FIELD = 'idempotency_key'
+IGNORED_FIELDS = ('csrf_token', KEY_FIELD)
+MAX_KEY_LENGTH = 200
+
+_last_purge = 0.0
+
+# _claim result when the key kept changing hands: the client should retry (409)
+BUSY = object()
+
+
+def idempotency_field():
+    """Hidden input with a fresh key; resubmitting the same rendered form reuses it"""
+    return Markup(f'<input type="hidden" name="{KEY_FIELD}" value="{uuid.uuid4().hex}">')
+
+
+def _fingerprint():
+    """Hash of what the request asks for, so a key reused for a different request is rejected"""
+    digest = hashlib.sha256(f'{request.method} {request.path}'.encode())
+    for name, value in sorted(request.form.items(multi=True)):
+        if name not in IGNORED_FIELDS:
+            digest.update(f'\0{name}={value}'.encode())
+    for name, upload in sorted(request.files.items(multi=True)):
+        digest.update(f'\0{name}:{upload.filename}:'.encode())
+        digest.update(upload.stream.read())
+        upload.stream.seek(0)
+    if not request.form and not request.files:
+        digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _purge_expired(now):
+    """Delete expired keys, at most once a minute per worker"""
+    global _last_purge
+    if time.monotonic() - _last_purge < 60:
+        return
+    _last_purge = time.monotonic()
+    with db.engine.begin() as connection:
+        connection.execute(sa.delete(IdempotencyKey.__table__).where(IdempotencyKey.expires_at < now))
+
+
+def _claim(key, fingerprint, now):
+    """
+    Insert the key as 'in progress' in its own transaction
+
+    Returns:
+        None if this request now owns the key, the existing row, or BUSY if the key was
+        purged or taken over by another request on every attempt
+    """
+    table = IdempotencyKey.__table__
+    ttl = timedelta(hours=current_app.config.get('IDEMPOTENCY_TTL_HOURS', 24))
+    lock_seconds = current_app.config.get('IDEMPOTENCY_LOCK_SECONDS', 60)
+
+    for _ in range(2):
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(sa.insert(table).values(
+                    key=key, fingerprint=fingerprint, created_at=now, expires_at=now + ttl))
+            return None
+        except sa.exc.IntegrityError:
+            pass
+
+        with db.engine.connect() as connection:
+            existing = connection.execute(sa.select(table).where(table.c.key == key)).first()
+        if existing is None:
+            continue  # expired and purged in between
+        # A worker that died mid-request leaves an unfinished claim; let a retry take it over
+        if existing.status_code is None and existing.created_at < now - timedelta(seconds=lock_seconds):
+            with db.engine.begin() as connection:
+                connection.execute(sa.delete(table).where(table.c.key == key, table.c.status_code == None))
+            continue
+        return existing
+
+    with db.engine.connect() as connection:
+        existing = connection.execute(sa.select(table).where(table.c.key == key)).first()
+    return BUSY if existing is None else existing
+
+
+def _store(key, response):
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        connection.execute(sa.update(table).where(table.c.key == key).values(
+            status_code=response.status_code,
+            content_type=response.content_type,
+            location=response.headers.get('Location'),
+            body=response.get_data()
+        ))
+
+
+def _release(key):
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        connection.execute(sa.delete(table).where(table.c.key == key, table.c.status_code == None))
+
+
+def _wants_json():
+    return request.is_json or request.accept_mimetypes.best == 'application/json'
+
+
+def _replay(existing):
+    response = Response(existing.body, status=existing.status_code, content_type=existing.content_type)
+    if existing.location:
+        response.headers['Location'] = existing.location
+    response.headers['Idempotent-Replayed'] = 'true'
+    if not _wants_json() and 300 <= existing.status_code < 400:
+        flash('That request was already processed.', 'info')
+    return response
+
+
+def idempotent(f):
+    """
+    Route decorator: a retried request with the same Idempotency-Key (header or form field)
+    gets the stored response back instead of running the view (and its writes and
+    notifications) again. Requests without a key run as usual.
+    Keys are scoped per user and kept for IDEMPOTENCY_TTL_HOURS.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        client_key = request.headers.get(KEY_HEADER) or request.form.get(KEY_FIELD)
+        if not client_key or request.method != 'POST':
+            return f(*args, **kwargs)
+        if len(client_key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{KEY_HEADER} is too long'}), 400
+
+        user = g.get('api_user') or current_user  # API token user, else the cookie session
+        user_id = user.id if user.is_authenticated else 'anonymous'
+        key = f'{user_id}:{request.endpoint}:{client_key}'
+        fingerprint = _fingerprint()
+        now = datetime.utcnow()
+        _purge_expired(now)
+
+        existing = _claim(key, fingerprint, now)
+        if existing is not None:
+            if existing is not BUSY and existing.fingerprint != fingerprint:
+                return jsonify({'error': f'{KEY_HEADER} was already used for a different request'}), 422
+            if existing is BUSY or existing.status_code is None:
+                response = jsonify({'error': 'A request with this key is still being processed'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            return _replay(existing)
+
+        try:
+            response = current_app.make_response(f(*args, **kwargs))
+        except Exception:
+            db.session.rollback()
+            _release(key)
+            raise
+
+        # Server errors are not final: let the client retry them for real
+        if response.status_code >= 500 or response.is_streamed:
+            _release(key)
+        else:
+            _store(key, response)
+        return response
+    return decorated_function
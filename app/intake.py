@@ -0,0 +1,211 @@
+import csv
+import io
+import re
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Car, Service, User, JobStatusChange
+from app.customers import find_or_create_customers, normalize_phone, IN_CHUNK_SIZE
+from app.scheduler import scheduler
+
+# CSV header / JSON key -> Car column (service and staff are resolved separately)
+INTAKE_FIELDS = ['customer_name', 'customer_phone', 'customer_email', 'plate_number', 'car_model',
+                 'service', 'staff', 'notes']
+MAX_ROWS = 5000
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def parse_csv(stream):
+    """
+    Read intake rows from an uploaded CSV file
+    Headers are matched case-insensitively; 'service_id' / 'assigned_user_id' are accepted as aliases
+
+    Returns:
+        List of dictionaries keyed by INTAKE_FIELDS
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    aliases = {'service_id': 'service', 'service_name': 'service', 'assigned_user_id': 'staff',
+               'username': 'staff', 'phone': 'customer_phone', 'plate': 'plate_number'}
+    rows = []
+    for raw in csv.DictReader(text):
+        row = {}
+        for header, value in raw.items():
+            if header is None:
+                continue
+            key = header.strip().lower().replace(' ', '_')
+            row[aliases.get(key, key)] = (value or '').strip()
+        rows.append(row)
+    return rows
+
+
+def _lookup(mapping, value):
+    """Match a service/staff given as an id or a (case-insensitive) name"""
+    if value is None or value == '':
+        return None
+    value = str(value).strip()
+    if value.isdigit() and int(value) in mapping['ids']:
+        return int(value)
+    return mapping['names'].get(value.lower())
+
+
+def bulk_intake(rows, auto_assign=False, default_service_id=None, changed_by=None):
+    """
+    Validate and insert many jobs at once
+
+    All plate numbers are checked with one IN query per 500 plates (plus duplicates inside
+    the batch), services/staff/customers are resolved from in-memory maps, and every valid
+    row is inserted in a single transaction. Invalid rows are skipped and reported.
+
+    Args:
+        rows: List of dictionaries keyed by INTAKE_FIELDS (anything else is reported as an invalid row)
+        auto_assign: Give rows without staff to the least-loaded staff members
+        default_service_id: Service (id or name) for rows that don't name one
+        changed_by: User recorded on the initial 'Waiting' status change
+
+    Returns:
+        (list of created Car objects, list of {'row': n, 'plate_number': ..., 'errors': [...]})
+    """
+    if len(rows) > MAX_ROWS:
+        return [], [{'row': 0, 'plate_number': None, 'errors': [f'At most {MAX_ROWS} rows per import.']}]
+
+    services = {'ids': set(), 'names': {}}
+    for service_id, name in db.session.query(Service.id, Service.name).filter_by(is_active=True):
+        services['ids'].add(service_id)
+        services['names'][name.lower()] = service_id
+    staff = {'ids': set(), 'names': {}}
+    for user_id, username, full_name in db.session.query(User.id, User.username, User.full_name).filter_by(
+            role='staff', is_active=True):
+        staff['ids'].add(user_id)
+        staff['names'][username.lower()] = user_id
+        staff['names'].setdefault((full_name or '').lower(), user_id)
+    default_service_id = _lookup(services, default_service_id)
+
+    # One set-based query for plates already on the floor at this branch (plates are unique per branch)
+    plates = [str(row.get('plate_number') or '').upper().strip() if isinstance(row, dict) else '' for row in rows]
+    unique_plates = list({plate for plate in plates if plate})
+    taken = set()
+    for offset in range(0, len(unique_plates), IN_CHUNK_SIZE):
+        chunk = unique_plates[offset:offset + IN_CHUNK_SIZE]
+        taken.update(plate for (plate,) in db.session.query(Car.plate_number).filter(Car.plate_number.in_(chunk)))
+
+    valid, errors, seen = [], [], set()
+    for index, (row, plate) in enumerate(zip(rows, plates), start=1):
+        if not isinstance(row, dict):
+            errors.append({'row': index, 'plate_number': None, 'errors': ['Each job must be an object.']})
+            continue
+        problems = []
+        name = str(row.get('customer_name') or '').strip()
+        phone = str(row.get('customer_phone') or '').strip()
+        email = str(row.get('customer_email') or '').strip() or None
+
+        if not name:
+            problems.append('Customer name is required.')
+        elif len(name) > 120:
+            problems.append('Customer name is too long.')
+        if not 10 <= len(phone) <= 20:
+            problems.append('Phone number must be 10-20 characters.')
+        if email and not EMAIL_PATTERN.match(email):
+            problems.append('Invalid email address.')
+
+        if not plate:
+            problems.append('Plate number is required.')
+        elif len(plate) > 20:
+            problems.append('Plate number is too long.')
+        elif plate in taken:
+            problems.append('This plate number is already registered at this branch.')
+        elif plate in seen:
+            problems.append('Duplicate plate number in this import.')
+
+        service_id = _lookup(services, row.get('service')) if row.get('service') else default_service_id
+        if service_id not in services['ids']:
+            problems.append('Unknown or inactive service.')
+
+        staff_id = _lookup(staff, row.get('staff'))
+        if row.get('staff') and staff_id is None:
+            problems.append('Unknown or inactive staff member.')
+        elif staff_id is None and not auto_assign:
+            problems.append('Staff is required (or enable automatic assignment).')
+
+        if problems:
+            errors.append({'row': index, 'plate_number': plate or None, 'errors': problems})
+            continue
+        seen.add(plate)
+        valid.append((index, {
+            'customer_name': name,
+            'customer_phone': phone,
+            'customer_email': email,
+            'plate_number': plate,
+            'car_model': str(row.get('car_model') or '').strip() or None,
+            'service_id': service_id,
+            'assigned_user_id': staff_id,
+            'notes': str(row.get('notes') or '').strip() or None
+        }))
+
+    if not valid:
+        return [], errors
+
+    # Least-loaded staff for rows without one, spread across the batch
+    unassigned = [(index, row) for index, row in valid if row['assigned_user_id'] is None]
+    if unassigned:
+        picks = scheduler.plan_assignments(staff['ids'], [row['service_id'] for _, row in unassigned])
+        if not picks:
+            for index, row in unassigned:
+                errors.append({'row': index, 'plate_number': row['plate_number'], 'errors': ['No active staff to assign.']})
+            valid = [(index, row) for index, row in valid if row['assigned_user_id'] is not None]
+        for (_, row), staff_id in zip(unassigned, picks):
+            row['assigned_user_id'] = staff_id
+    if not valid:
+        return [], sorted(errors, key=lambda error: error['row'])
+
+    while True:
+        try:
+            cars = _insert_jobs([row for _, row in valid], changed_by)
+            break
+        except IntegrityError:
+            # A plate was registered by another request since the check above: report it and retry
+            db.session.rollback()
+            conflicts = {plate for (plate,) in db.session.query(Car.plate_number).filter(
+                Car.plate_number.in_([row['plate_number'] for _, row in valid]))}
+            if not conflicts:
+                raise
+            for index, row in valid:
+                if row['plate_number'] in conflicts:
+                    errors.append({'row': index, 'plate_number': row['plate_number'],
+                                   'errors': ['This plate number is already registered at this branch.']})
+            valid = [(index, row) for index, row in valid if row['plate_number'] not in conflicts]
+            if not valid:
+                return [], sorted(errors, key=lambda error: error['row'])
+
+    for car in cars:
+        scheduler.track(car)
+    return cars, sorted(errors, key=lambda error: error['row'])
+
+
+def _insert_jobs(valid, changed_by):
+    """Insert validated intake rows (with their customers and first status change) and commit"""
+    customers = find_or_create_customers(
+        (row['customer_name'], row['customer_phone'], row['customer_email'], row['plate_number'], row['car_model'])
+        for row in valid
+    )
+
+    now = datetime.utcnow()
+    cars = []
+    for row in valid:
+        row = dict(row)
+        customer = customers.get(normalize_phone(row['customer_phone']))
+        if customer:
+            row['customer_phone'] = customer.phone
+            row['customer_id'] = customer.id
+        cars.append(Car(status='Waiting', time_in=now, **row))
+    db.session.add_all(cars)
+    db.session.flush()
+
+    db.session.add_all([JobStatusChange(
+        car_id=car.id,
+        from_status=None,
+        to_status='Waiting',
+        changed_by_id=changed_by.id if changed_by else None,
+        changed_at=now
+    ) for car in cars])
+    db.session.commit()
+    return cars
@@ -0,0 +1,202 @@
+import os
+import time
+import sqlalchemy as sa
+from flask import Response, g, has_request_context, request, jsonify
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from app import db
+from app.replica import get_replica
+
+# Under gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a shared directory before
+# the workers import the app; every worker writes its samples there and /metrics merges them
+MULTIPROCESS = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+# Routes that are scraped/probed constantly and would drown out real traffic
+UNTIMED_ENDPOINTS = ('metrics', 'healthz', 'readyz', 'static')
+
+REQUEST_LATENCY = Histogram(
+    'spot_http_request_duration_seconds', 'Request latency by route',
+    ['method', 'route', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    'spot_http_requests_in_progress', 'Requests being handled right now',
+    multiprocess_mode='livesum'
+)
+DB_QUERIES = Counter(
+    'spot_db_queries_total', 'SQL statements executed, by route (or "background")',
+    ['route']
+)
+DB_QUERY_DURATION = Histogram(
+    'spot_db_query_duration_seconds', 'SQL statement execution time',
+    ['engine'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'spot_db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled connection',
+    ['engine'],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    'spot_db_pool_connections_in_use', 'Pooled connections currently checked out',
+    ['engine'], multiprocess_mode='livesum'
+)
+ARCHIVE_BATCH_SIZE = Histogram(
+    'spot_archive_batch_jobs', 'Jobs moved to the archive per batch',
+    ['trigger'],
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+)
+ARCHIVE_DURATION = Histogram(
+    'spot_archive_batch_duration_seconds', 'Time to archive one batch',
+    ['trigger'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+FRAGMENT_CACHE = Counter(
+    'spot_fragment_cache_total', 'Cached template fragment lookups',
+    ['result']
+)
+NOTIFICATIONS_UNREAD = Gauge(
+    'spot_notifications_unread', 'Notifications waiting to be read (queue depth)',
+    multiprocess_mode='mostrecent'
+)
+
+
+def observe_archive_batch(trigger, jobs, started):
+    """
+    Record one archive run
+
+    Args:
+        trigger: 'auto' (dashboard / Archive Now) or 'clear_today'
+        jobs: Number of jobs archived
+        started: time.perf_counter() when the run began
+    """
+    ARCHIVE_BATCH_SIZE.labels(trigger).observe(jobs)
+    ARCHIVE_DURATION.labels(trigger).observe(time.perf_counter() - started)
+
+
+def _route_label():
+    rule = getattr(request, 'url_rule', None)
+    return rule.rule if rule is not None else '<unmatched>'
+
+
+def _instrument_engine(engine, name):
+    """Count and time statements, pool checkouts and connections in use on one engine"""
+
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_started'].pop()
+        DB_QUERY_DURATION.labels(name).observe(time.perf_counter() - started)
+        DB_QUERIES.labels(_route_label() if has_request_context() else 'background').inc()
+
+    @sa.event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_CHECKED_OUT.labels(name).inc()
+
+    @sa.event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        DB_POOL_CHECKED_OUT.labels(name).dec()
+
+    # The pool has no "before checkout" event, so time the call that blocks on the queue
+    pool = engine.pool
+    if hasattr(pool, '_do_get'):
+        do_get = pool._do_get
+
+        def timed_do_get():
+            started = time.perf_counter()
+            try:
+                return do_get()
+            finally:
+                DB_POOL_CHECKOUT_WAIT.labels(name).observe(time.perf_counter() - started)
+
+        pool._do_get = timed_do_get
+
+
+def _registry():
+    if not MULTIPROCESS:
+        from prometheus_client import REGISTRY
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def init_metrics(app):
+    """Register request timing, DB instrumentation and the /metrics, /healthz, /readyz endpoints"""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    _instrument_engine(db.engine, 'primary')
+    replica = app.extensions.get('replica')
+    if replica is not None:
+        _instrument_engine(replica.engine, 'replica')
+
+    @app.before_request
+    def start_timer():
+        if request.endpoint in UNTIMED_ENDPOINTS:
+            return
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = _route_label()
+        REQUESTS_IN_PROGRESS.inc()
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def stop_timer(exception=None):
+        # Teardown runs even when the view raised, so the in-progress gauge can't drift
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        REQUESTS_IN_PROGRESS.dec()
+        REQUEST_LATENCY.labels(request.method, g.metrics_route, str(g.get('metrics_status', 500))).observe(
+            time.perf_counter() - started)
+
+    @app.route('/metrics')
+    def metrics():
+        token = app.config.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f'Bearer {token}':
+            return Response('Unauthorized\n', status=401, mimetype='text/plain')
+
+        # Queue depth is read at scrape time: one COUNT instead of tracking every change
+        from app.models import Notification
+        try:
+            NOTIFICATIONS_UNREAD.set(db.session.query(db.func.count(Notification.id)).filter(
+                Notification.is_read == False).scalar() or 0)
+        except sa.exc.SQLAlchemyError as e:
+            print(f"[ERROR] Metrics: could not count notifications: {str(e)}")
+            db.session.rollback()
+
+        return Response(generate_latest(_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+    @app.route('/healthz')
+    def healthz():
+        """Liveness: the worker answers requests (no database access, so a DB outage doesn't restart workers)"""
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz')
+    def readyz():
+        """Readiness: the primary database answers a trivial query"""
+        result = {'status': 'ok', 'database': 'ok'}
+        status = 200
+        try:
+            with db.engine.connect() as connection:
+                connection.execute(sa.text('SELECT 1'))
+        except sa.exc.SQLAlchemyError as e:
+            print(f"[ERROR] Readiness check failed: {str(e)}")
+            result.update(status='unavailable', database='unreachable')
+            status = 503
+
+        # Reported only: reads fall back to the primary when the replica is down
+        replica = get_replica()
+        if replica is not None:
+            result['replica'] = 'ok' if replica.usable() else 'degraded'
+            result['replica_lag_seconds'] = replica.lag
+        return jsonify(result), status
+
+    print(f"[OK] Metrics enabled{' (multiprocess)' if MULTIPROCESS else ''}")
@@ -1,5 +1,8 @@
 from datetime import datetime
+import sqlalchemy as sa
+from sqlalchemy.orm import declared_attr
 from flask_login import UserMixin
+from flask import current_app, g, has_app_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login_manager
 
@@ -7,12 +10,68 @@ from app import db, login_manager
 # User Loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Lean principal cached in the server-side session; no users query on most requests
+    from app.sessions import load_principal
+    return load_principal(int(user_id))
+
+
+_default_branch_ids = {}
+
+
+def current_branch_id(context):
+    """Column default for branch_id: the request's branch, else the default (first) branch"""
+    branch_id = g.get('branch_id') if has_app_context() else None
+    if branch_id is None:
+        url = str(context.engine.url)
+        branch_id = _default_branch_ids.get(url)
+        if branch_id is None:
+            branch_id = context.connection.execute(sa.text('SELECT MIN(id) FROM branches')).scalar()
+            if branch_id is not None:
+                _default_branch_ids[url] = branch_id
+    return branch_id
+
+
+# Branch scoping (see app/branches.py): queries in a request for one branch only see
+# BranchScoped rows of that branch, and BranchShared rows of that branch or of no branch
+class BranchScoped:
+    """Rows that belong to exactly one branch (branch_id is set on insert)"""
+    
+    @declared_attr
+    def branch_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('branches.id'), default=current_branch_id)
+
+
+class BranchShared:
+    """Rows that belong to one branch, or to all branches when branch_id is NULL"""
+    
+    @declared_attr
+    def branch_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('branches.id'))
+
+
+# Branch Model (one car wash location)
+class Branch(db.Model):
+    __tablename__ = 'branches'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(20), unique=True, nullable=False)  # short slug, e.g. 'westlands'
+    name = db.Column(db.String(100), nullable=False)
+    location = db.Column(db.String(200))
+    # Key in SQLALCHEMY_BINDS when the branch's jobs live in their own database; NULL = primary
+    bind_key = db.Column(db.String(50))
+    is_active = db.Column(db.Boolean, default=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Branch {self.code}>'
 
 
 # User Model (Admin/Staff)
-class User(UserMixin, db.Model):
+class User(BranchShared, UserMixin, db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('ix_users_branch_role', 'branch_id', 'role'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False, index=True)
@@ -21,28 +80,44 @@ class User(UserMixin, db.Model):
     phone_number = db.Column(db.String(20))
     password_hash = db.Column(db.String(255), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='staff')  # 'admin' or 'staff'
+    # branch_id (BranchShared): staff and branch admins work at one branch; admins without one are owners
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Bumped whenever name, role, branch, password or active flag change: cached session principals
+    # with an older version are reloaded (see app/sessions.py)
+    session_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     
     # Relationships
     cars = db.relationship('Car', backref='assigned_user', lazy='dynamic')
     notifications = db.relationship('Notification', backref='user', lazy='dynamic')
     
     def set_password(self, password):
-        """Hash and set the password"""
-        self.password_hash = generate_password_hash(password)
+        """Hash and set the password using the configured PASSWORD_HASH_METHOD"""
+        self.password_hash = generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
     
     def check_password(self, password):
         """Check if provided password matches the hash"""
         return check_password_hash(self.password_hash, password)
     
+    def password_needs_rehash(self):
+        """Check if the stored hash was made with different parameters than PASSWORD_HASH_METHOD"""
+        return self.password_hash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
+    
+    @property
+    def is_owner(self):
+        """Admins not tied to a branch manage every branch"""
+        return self.role == 'admin' and self.branch_id is None
+    
     def __repr__(self):
         return f'<User {self.username}>'
 
 
 # Service Model (Car Wash Services)
-class Service(db.Model):
+class Service(BranchShared, db.Model):
     __tablename__ = 'services'
+    __table_args__ = (
+        db.Index('ix_services_branch_id', 'branch_id'),  # NULL branch = offered at every branch
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
@@ -59,9 +134,40 @@ class Service(db.Model):
         return f'<Service {self.name}>'
 
 
+# Customer Model (one row per normalized phone number)
+class Customer(db.Model):
+    __tablename__ = 'customers'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    phone = db.Column(db.String(20), unique=True, nullable=False, index=True)  # +2547XXXXXXXX
+    name = db.Column(db.String(120), nullable=False)
+    name_key = db.Column(db.String(120), index=True)  # lowercased name for prefix search
+    email = db.Column(db.String(120))
+    
+    # Last vehicle seen, to prefill the intake form
+    last_plate = db.Column(db.String(20))
+    last_car_model = db.Column(db.String(100))
+    
+    # Loyalty counters, updated when jobs are archived
+    visits = db.Column(db.Integer, default=0, nullable=False, index=True)
+    total_spent = db.Column(db.Float, default=0.0, nullable=False)
+    first_visit = db.Column(db.DateTime)
+    last_visit = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<Customer {self.phone}>'
+
+
 # Car Model (Customer Jobs)
-class Car(db.Model):
+class Car(BranchScoped, db.Model):
     __tablename__ = 'cars'
+    __table_args__ = (
+        db.Index('ix_cars_branch_status', 'branch_id', 'status'),
+        db.Index('ix_cars_branch_time_in', 'branch_id', 'time_in'),
+        # A plate can be on the floor once per branch; each branch database enforces its own branches
+        db.Index('uq_cars_branch_plate', 'branch_id', 'plate_number', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     
@@ -69,9 +175,10 @@ class Car(db.Model):
     customer_name = db.Column(db.String(120), nullable=False)
     customer_phone = db.Column(db.String(20), nullable=False)
     customer_email = db.Column(db.String(120))
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), index=True)
     
     # Vehicle Information
-    plate_number = db.Column(db.String(20), nullable=False, unique=True, index=True)
+    plate_number = db.Column(db.String(20), nullable=False, index=True)
     car_model = db.Column(db.String(100))
     
     # Service Information
@@ -84,6 +191,19 @@ class Car(db.Model):
     time_out = db.Column(db.DateTime)
     notes = db.Column(db.Text)
     
+    # Last change to the row; watermark for the staff app's delta sync
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    
+    # Row version for optimistic concurrency: every UPDATE/DELETE runs
+    # `WHERE id = ? AND version = ?` and bumps it, raising StaleDataError if another
+    # request changed the row first (also keys the dashboards' cached row HTML)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    
+    __mapper_args__ = {'version_id_col': version}
+    
+    # Job statuses in workflow order
+    STATUSES = ('Waiting', 'Washing', 'Detailing', 'Ready for Pickup', 'Completed')
+    
     def get_duration(self):
         """Calculate duration in minutes"""
         if self.time_out and self.time_in:
@@ -91,10 +211,57 @@ class Car(db.Model):
             return delta.total_seconds() / 60
         return None
     
+    def set_status(self, new_status, changed_by=None, changed_at=None):
+        """
+        Change the job status and log the transition in the same transaction
+        `changed_at` backdates the change (e.g. made offline and synced later)
+        A new job (added to the session, not flushed yet) gets its initial entry from None
+        Caller commits. Returns False if the status didn't change.
+        """
+        if new_status == self.status:
+            return False
+        
+        from_status = self.status
+        if self.id is None:
+            # The log row needs the job's id
+            db.session.flush()
+        now = changed_at or datetime.utcnow()
+        db.session.add(JobStatusChange(
+            car_id=self.id,
+            from_status=from_status,
+            to_status=new_status,
+            changed_by_id=changed_by.id if changed_by else None,
+            changed_at=now
+        ))
+        self.status = new_status
+        
+        if new_status == 'Completed' and not self.time_out:
+            self.time_out = now
+        return True
+    
     def __repr__(self):
         return f'<Car {self.plate_number}>'
 
 
+# Job Status Change Model (append-only log of status transitions)
+class JobStatusChange(db.Model):
+    __tablename__ = 'job_status_changes'
+    __table_args__ = (
+        db.Index('ix_job_status_changes_car_changed', 'car_id', 'changed_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # No FK: the log outlives the Car row, which is deleted on archive
+    car_id = db.Column(db.Integer, nullable=False)
+    from_status = db.Column(db.String(20))  # None for the initial 'Waiting' entry
+    to_status = db.Column(db.String(20), nullable=False)
+    changed_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    changed_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<JobStatusChange {self.car_id} {self.from_status} -> {self.to_status}>'
+
+
 # Notification Model
 class Notification(db.Model):
     __tablename__ = 'notifications'
@@ -110,8 +277,12 @@ class Notification(db.Model):
 
 
 # Archived Job Model (for completed jobs)
-class ArchivedJob(db.Model):
+class ArchivedJob(BranchScoped, db.Model):
     __tablename__ = 'archived_jobs'
+    __table_args__ = (
+        db.Index('ix_archived_jobs_branch_time_in', 'branch_id', 'time_in'),
+        db.Index('ix_archived_jobs_branch_archived_at', 'branch_id', 'archived_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     original_id = db.Column(db.Integer)  # Original Car ID
@@ -120,6 +291,7 @@ class ArchivedJob(db.Model):
     customer_name = db.Column(db.String(120))
     customer_phone = db.Column(db.String(20))
     customer_email = db.Column(db.String(120))
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), index=True)
     
     # Vehicle Information
     plate_number = db.Column(db.String(20), index=True)
@@ -137,12 +309,161 @@ class ArchivedJob(db.Model):
     # Job Details
     status = db.Column(db.String(20))
     notes = db.Column(db.Text)
-    time_in = db.Column(db.DateTime)
+    time_in = db.Column(db.DateTime, index=True)
     time_out = db.Column(db.DateTime)
     duration_minutes = db.Column(db.Integer)
     
+    # Minutes spent in each stage (from the status log, materialized at archive time)
+    waiting_minutes = db.Column(db.Integer)
+    washing_minutes = db.Column(db.Integer)
+    detailing_minutes = db.Column(db.Integer)
+    ready_minutes = db.Column(db.Integer)
+    
     # Archive timestamp
     archived_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
+    # Status -> column holding the minutes spent in it
+    STAGE_COLUMNS = {
+        'Waiting': 'waiting_minutes',
+        'Washing': 'washing_minutes',
+        'Detailing': 'detailing_minutes',
+        'Ready for Pickup': 'ready_minutes'
+    }
+    
+    def __repr__(self):
+        return f'<ArchivedJob {self.plate_number}>'
+
+
+# Cold Archive File Model (manifest of archived jobs moved out to Parquet, see app/cold_storage.py)
+class ColdArchiveFile(BranchScoped, db.Model):
+    __tablename__ = 'cold_archive_files'
+    __table_args__ = (
+        db.Index('ix_cold_archive_files_branch_month', 'branch_id', 'month'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Date, nullable=False, index=True)  # first day of the month (time_in, UTC)
+    path = db.Column(db.String(255), unique=True, nullable=False)  # relative to COLD_STORAGE_DIR
+    row_count = db.Column(db.Integer, nullable=False)
+    size_bytes = db.Column(db.BigInteger)
+    min_time_in = db.Column(db.DateTime)
+    max_time_in = db.Column(db.DateTime)
+    min_archived_at = db.Column(db.DateTime)
+    max_archived_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ColdArchiveFile {self.path}>'
+
+
+# Daily Rollup Model (per-day archive aggregates with mergeable quantile sketches)
+class DailyRollup(BranchScoped, db.Model):
+    __tablename__ = 'daily_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('branch_id', 'dimension', 'day', 'key', name='uq_daily_rollups_branch_dimension_day_key'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, index=True)  # Kenya-local date of time_in
+    dimension = db.Column(db.String(10), nullable=False)  # 'service', 'staff' or 'day'
+    key = db.Column(db.String(120), nullable=False)
+    
+    jobs = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    duration_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    duration_sketch = db.Column(db.Text)  # DDSketch JSON, see app/stats.py
+    revenue_sketch = db.Column(db.Text)
+    stage_sketches = db.Column(db.Text)  # 'day' rows only: {stage: DDSketch} of minutes spent in each stage
+    
+    def __repr__(self):
+        return f'<DailyRollup {self.day} {self.dimension}={self.key}>'
+
+
+# Rate Limit Bucket Model (shared login token buckets)
+class RateLimitBucket(db.Model):
+    __tablename__ = 'rate_limit_buckets'
+    
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # Unix timestamp
+    
+    def __repr__(self):
+        return f'<RateLimitBucket {self.key}>'
+
+
+# Idempotency Key Model (stored responses of write requests, replayed on retry)
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(300), nullable=False, unique=True)  # user:endpoint:client key
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)  # NULL while the first request is still running
+    content_type = db.Column(db.String(100))
+    location = db.Column(db.String(500))
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key}>'
+
+
+# Server Session Model (session data behind the cookie's random id, see app/sessions.py)
+class ServerSession(db.Model):
+    __tablename__ = 'server_sessions'
+    
+    key = db.Column(db.String(64), primary_key=True)  # sha256 of the session id; the id itself is never stored
+    user_id = db.Column(db.Integer, index=True)  # signed-in user, for invalidating their sessions
+    user_version = db.Column(db.Integer, nullable=False, default=0)  # latest User.session_version; older cached principals are reloaded
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.Float, nullable=False, index=True)  # Unix timestamp
+    
+    def __repr__(self):
+        return f'<ServerSession {self.user_id}>'
+
+
+# Background Task Model (heavy admin actions run outside the request, see app/tasks.py)
+class BackgroundTask(db.Model):
+    __tablename__ = 'background_tasks'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)  # key in app.tasks.TASKS
+    params = db.Column(db.Text)  # JSON keyword arguments
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed
+    done = db.Column(db.Integer, nullable=False, default=0)  # progress: units done out of total
+    total = db.Column(db.Integer)
+    message = db.Column(db.String(300))  # latest progress note, then the result or the error
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    branch_id = db.Column(db.Integer, db.ForeignKey('branches.id'))  # branch the task runs in
+    worker = db.Column(db.String(100))  # host:pid of the worker running it
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # refreshed while running; a stale one means the worker died
+    
+    __table_args__ = (
+        db.Index('ix_background_tasks_status_id', 'status', 'id'),
+        db.Index('ix_background_tasks_branch_created', 'branch_id', 'created_at'),
+    )
+    
+    def __repr__(self):
+        return f'<BackgroundTask {self.id} {self.name} {self.status}>'
+
+
+# API Token Model (bearer tokens for /api/v1, separate from the cookie session)
+class ApiToken(db.Model):
+    __tablename__ = 'api_tokens'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)  # sha256 of the token; the token itself is never stored
+    name = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime)
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
+    
+    user = db.relationship('User')
+    
     def __repr__(self):
-        return f'<ArchivedJob {self.plate_number}>'
\ No newline at end of file
+        return f'<ApiToken {self.id} {self.user_id}>'
@@ -0,0 +1,266 @@
+import json
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Signed token that turns profiling on for one request: header or ?_profile= query parameter
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PARAM = '_profile'
+UNPROFILED_ENDPOINTS = ('static', 'metrics', 'healthz', 'readyz', 'list_profiles_view', 'download_profile')
+
+# Frames in which SQLAlchemy hands a statement to the DB driver; shown with the SQL as a child frame
+SQL_FRAMES = ('do_execute', 'do_executemany', 'do_execute_no_params')
+SQL_FILE = os.path.join('sqlalchemy', 'engine', 'default.py')
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{13}-[0-9]+-[0-9a-f]{6}$')
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+
+_labels = {}  # code object -> frame label
+
+
+def _frame_label(code):
+    """'function (file.py:line)': paths relative to site-packages or the project, bare for the stdlib"""
+    label = _labels.get(code)
+    if label is None:
+        filename = code.co_filename
+        marker = 'site-packages' + os.sep
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+        elif filename.startswith(PROJECT_ROOT):
+            filename = os.path.relpath(filename, PROJECT_ROOT)
+        else:
+            filename = os.path.basename(filename)
+        label = _labels[code] = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+    return label
+
+
+def _sql_label(frame):
+    statement = frame.f_locals.get('statement')
+    if not isinstance(statement, str):
+        return 'SQL'
+    return 'SQL ' + ' '.join(statement.split())[:80].replace(';', ',')
+
+
+def _collapse(frame):
+    """Root-first 'a;b;c' stack for one sample"""
+    labels = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name in SQL_FRAMES and code.co_filename.endswith(SQL_FILE):
+            labels.append(_sql_label(frame))
+        labels.append(_frame_label(code))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class RequestSampler(threading.Thread):
+    """
+    Samples one thread's Python stack every `interval` seconds until stopped
+    Nothing is hooked into the profiled code, so requests that aren't profiled pay nothing
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True, name='request-profiler')
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = defaultdict(float)  # collapsed stack -> milliseconds
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is not None:
+                self.stacks[_collapse(frame)] += (now - last) * 1000
+                self.samples += 1
+            last = now
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.secret_key, salt='request-profile')
+
+
+def issue_token(app, user):
+    """Signed profiling token for an admin, valid for PROFILE_TOKEN_MAX_AGE seconds"""
+    return _serializer(app).dumps({'user': user.id})
+
+
+def _token_valid(app, token):
+    try:
+        _serializer(app).loads(token, max_age=app.config.get('PROFILE_TOKEN_MAX_AGE', 3600))
+        return True
+    except BadSignature:
+        return False
+
+
+def _profile_dir(app):
+    return app.config.get('PROFILE_DIR')
+
+
+def _save(app, profile):
+    """Write one profile and drop the oldest beyond PROFILE_BUFFER_SIZE (shared by all workers)"""
+    directory = _profile_dir(app)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, profile['id'] + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(profile, f)
+    os.replace(path + '.tmp', path)
+
+    names = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    for name in names[:-app.config.get('PROFILE_BUFFER_SIZE', 50)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def list_profiles(app):
+    """Stored profiles, newest first, without their stacks"""
+    directory = _profile_dir(app)
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            continue  # pruned or half-written by another worker
+        profile.pop('stacks', None)
+        profile['created_at'] = datetime.fromisoformat(profile['created_at'])
+        profiles.append(profile)
+    return profiles
+
+
+def load_profile(app, profile_id):
+    """
+    One stored profile
+
+    Returns:
+        Profile dictionary, or None if the id is unknown
+    """
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(_profile_dir(app), profile_id + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def to_collapsed(profile):
+    """Brendan Gregg collapsed stacks ('a;b;c <microseconds>'), for flamegraph.pl or speedscope"""
+    return ''.join(f"{stack} {int(round(ms * 1000))}\n" for stack, ms in sorted(profile['stacks'].items()))
+
+
+def to_speedscope(profile):
+    """speedscope.app JSON ('sampled' profile weighted in milliseconds)"""
+    frames, index = [], {}
+    samples, weights = [], []
+    for stack, ms in profile['stacks'].items():
+        sample = []
+        for label in stack.split(';'):
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({'name': label})
+            sample.append(index[label])
+        samples.append(sample)
+        weights.append(round(ms, 3))
+
+    name = f"{profile['method']} {profile['path']}"
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'name': name,
+        'exporter': 'spot',
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': name,
+            'unit': 'milliseconds',
+            'startValue': 0,
+            'endValue': round(sum(weights), 3),
+            'samples': samples,
+            'weights': weights
+        }]
+    }
+
+
+def init_profiler(app):
+    """
+    Profile a request when it carries a valid signed token (header or query parameter) or is
+    picked by PROFILE_SAMPLE_RATE. Requests that aren't profiled only pay for the header check.
+    """
+    if not app.config.get('PROFILING_ENABLED', True):
+        return
+
+    @app.before_request
+    def start_profile():
+        if request.endpoint in UNPROFILED_ENDPOINTS:
+            return
+        token = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_PARAM)
+        if token:
+            if not _token_valid(app, token):
+                return
+            trigger = 'token'
+        else:
+            rate = app.config.get('PROFILE_SAMPLE_RATE', 0)
+            if not rate or random.random() >= rate:
+                return
+            trigger = 'sampled'
+
+        sampler = RequestSampler(threading.get_ident(), app.config.get('PROFILE_INTERVAL_MS', 2) / 1000)
+        g.profile = (sampler, trigger, time.perf_counter())
+        sampler.start()
+
+    @app.after_request
+    def record_profile_status(response):
+        if 'profile' in g:
+            g.profile_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_profile(exception=None):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        sampler, trigger, started = profile
+        sampler.stop()
+        stacks = dict(sampler.stacks)
+
+        profile = {
+            'id': f"{int(time.time() * 1000):013d}-{os.getpid()}-{secrets.token_hex(3)}",
+            'created_at': datetime.utcnow().isoformat(),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': g.get('profile_status', 500),
+            'user': current_user.username if current_user.is_authenticated else None,
+            'trigger': trigger,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+            'sql_ms': round(sum(ms for stack, ms in stacks.items() if ';SQL' in stack), 1),
+            'samples': sampler.samples,
+            'stacks': stacks
+        }
+        try:
+            _save(app, profile)
+            print(f"[*] Profiled {profile['method']} {profile['path']}: {profile['duration_ms']} ms, "
+                  f"{profile['samples']} samples")
+        except OSError as e:
+            print(f"[ERROR] Could not save profile: {str(e)}")
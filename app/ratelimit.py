@@ -0,0 +1,137 @@
+import random
+import time
+import threading
+from collections import OrderedDict
+from flask import current_app
+from app import db
+
+PURGE_PROBABILITY = 0.01  # share of login attempts that also forget idle buckets
+
+
+class MemoryTokenBucket:
+    """
+    Per-process token buckets
+    Each worker keeps its own buckets, so the effective limit is per gunicorn worker
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently seen first
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, period, now=None):
+        """
+        Take one token from the bucket for `key`
+
+        Args:
+            key: Bucket key, e.g. 'ip:10.0.0.1'
+            capacity: Burst size (tokens when full)
+            period: Seconds to refill a full bucket
+
+        Returns:
+            Boolean indicating if the request is allowed
+        """
+        now = now or time.monotonic()
+        rate = capacity / period
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+
+            # Forget the least recently seen buckets so memory stays bounded
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def purge(self, idle_seconds, now=None):
+        """Forget buckets untouched for idle_seconds (they have refilled)"""
+        cutoff = (now or time.monotonic()) - idle_seconds
+        with self._lock:
+            while self._buckets:
+                key, (_, updated) = next(iter(self._buckets.items()))
+                if updated >= cutoff:
+                    break
+                del self._buckets[key]
+
+
+class DatabaseTokenBucket:
+    """Token buckets stored in the app database, shared by all workers"""
+
+    def consume(self, key, capacity, period, now=None):
+        """Take one token from the shared bucket for `key` (see MemoryTokenBucket.consume)"""
+        from app.models import RateLimitBucket
+
+        now = now or time.time()
+        rate = capacity / period
+        try:
+            bucket = RateLimitBucket.query.filter_by(key=key).with_for_update().first()
+            if bucket is None:
+                bucket = RateLimitBucket(key=key, tokens=capacity, updated_at=now)
+                db.session.add(bucket)
+
+            tokens = min(capacity, bucket.tokens + (now - bucket.updated_at) * rate)
+            allowed = tokens >= 1
+            bucket.tokens = tokens - 1 if allowed else tokens
+            bucket.updated_at = now
+            db.session.commit()
+            return allowed
+        except Exception as e:
+            # Never lock everyone out because the limiter's storage failed
+            print(f"[ERROR] Rate limiter: {str(e)}")
+            db.session.rollback()
+            return True
+
+    def purge(self, idle_seconds, now=None):
+        """Delete buckets untouched for idle_seconds (they have refilled)"""
+        from app.models import RateLimitBucket
+
+        cutoff = (now or time.time()) - idle_seconds
+        try:
+            RateLimitBucket.query.filter(RateLimitBucket.updated_at < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            print(f"[ERROR] Rate limiter purge: {str(e)}")
+            db.session.rollback()
+
+
+_backends = {
+    'memory': MemoryTokenBucket,
+    'database': DatabaseTokenBucket,
+}
+_limiter = None
+
+
+def get_limiter():
+    """Limiter instance for the configured LOGIN_RATE_LIMIT_BACKEND"""
+    global _limiter
+    backend = _backends[current_app.config.get('LOGIN_RATE_LIMIT_BACKEND', 'memory')]
+    if not isinstance(_limiter, backend):
+        _limiter = backend()
+    return _limiter
+
+
+def login_allowed(ip_address, username):
+    """
+    Check the per-IP and per-(IP, username) login buckets
+    Both buckets are charged, so a single IP can't spray many usernames or
+    hammer one of them; the username bucket is keyed by IP too, so attempts
+    from elsewhere can't lock a known account (e.g. the default admin) out
+
+    Returns:
+        Boolean indicating if the login attempt may proceed
+    """
+    config = current_app.config
+    if not config.get('LOGIN_RATE_LIMIT_ENABLED', True):
+        return True
+
+    limiter = get_limiter()
+    ip_limit, user_limit = config['LOGIN_RATE_LIMIT_PER_IP'], config['LOGIN_RATE_LIMIT_PER_USERNAME']
+    ip_ok = limiter.consume(f'ip:{ip_address}', *ip_limit)
+    user_ok = limiter.consume(f'user:{ip_address}:{(username or "").lower()}', *user_limit)
+    if random.random() < PURGE_PROBABILITY:
+        limiter.purge(max(ip_limit[1], user_limit[1]))
+    return ip_ok and user_ok
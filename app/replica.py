@@ -0,0 +1,187 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+import sqlalchemy as sa
+from flask import current_app, g, has_app_context, has_request_context, session
+from flask_sqlalchemy.session import Session
+
+# Seconds the replica is behind; 0 when it has replayed everything it received
+POSTGRES_LAG_SQL = sa.text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class ReplicaState:
+    """
+    Read-replica engine for one app plus a cached health check
+    The replica is skipped while it is unreachable or lagging more than REPLICA_MAX_LAG_SECONDS
+    """
+
+    def __init__(self, engine, max_lag, check_interval):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = True
+        self.lag = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def usable(self):
+        if self.checked_at is None or time.monotonic() - self.checked_at > self.check_interval:
+            with self._lock:
+                if self.checked_at is None or time.monotonic() - self.checked_at > self.check_interval:
+                    self.check()
+        return self.healthy
+
+    def check(self):
+        """Measure replication lag; any error marks the replica down until the next check"""
+        was_healthy = self.healthy
+        try:
+            with self.engine.connect() as connection:
+                if self.engine.dialect.name == 'postgresql':
+                    self.lag = float(connection.execute(POSTGRES_LAG_SQL).scalar() or 0)
+                else:
+                    # e.g. a SQLite file standing in for the replica in tests
+                    connection.execute(sa.text('SELECT 1'))
+                    self.lag = 0.0
+            self.healthy = self.lag <= self.max_lag
+            if not self.healthy and was_healthy:
+                print(f"[!] Read replica is {self.lag:.0f}s behind, reading from the primary")
+        except sa.exc.SQLAlchemyError as e:
+            self.healthy = False
+            self.lag = None
+            if was_healthy:
+                print(f"[ERROR] Read replica unavailable, reading from the primary: {str(e)}")
+        if self.healthy and not was_healthy:
+            print("[OK] Read replica back in use")
+        self.checked_at = time.monotonic()
+
+    def mark_down(self):
+        """Stop using the replica until the next health check (after a failed query)"""
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+
+def get_replica():
+    """ReplicaState of the current app, or None if no replica is configured"""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('replica')
+
+
+def init_replica(app):
+    """Create the replica engine if SQLALCHEMY_REPLICA_URI is set"""
+    uri = app.config.get('SQLALCHEMY_REPLICA_URI')
+    if not uri:
+        return
+
+    engine = sa.create_engine(uri, pool_pre_ping=True)
+    state = ReplicaState(engine, app.config.get('REPLICA_MAX_LAG_SECONDS', 30),
+                         app.config.get('REPLICA_HEALTH_CHECK_SECONDS', 10))
+    app.extensions['replica'] = state
+
+    @sa.event.listens_for(engine, 'handle_error')
+    def replica_error(context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, sa.exc.OperationalError):
+            state.mark_down()
+            if has_app_context():
+                g.replica_failed = True
+
+    @app.after_request
+    def pin_to_primary(response):
+        # Read-your-writes: keep this browser session on the primary for a while after it wrote
+        pin_seconds = app.config.get('REPLICA_READ_YOUR_WRITES_SECONDS', 0)
+        if pin_seconds and g.get('replica_wrote'):
+            session['replica_pinned_until'] = time.time() + pin_seconds
+        return response
+
+    print(f"[OK] Read replica configured ({engine.dialect.name})")
+
+
+def _replica_allowed():
+    if not g.get('use_replica') or g.get('replica_wrote'):
+        return False
+    if has_request_context() and session.get('replica_pinned_until', 0) > time.time():
+        return False
+    return True
+
+
+def read_replica(f):
+    """
+    Route decorator: SELECTs in this request go to the read replica when one is healthy
+    Writes, and reads after a write in the same request, stay on the primary
+    If the replica fails mid-view the view is run again on the primary (nothing was sent yet)
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.use_replica = True
+        g.replica_failed = False
+        try:
+            return f(*args, **kwargs)
+        except sa.exc.OperationalError:
+            if not g.get('replica_failed') or g.get('replica_wrote'):
+                raise
+            from app import db
+            db.session.rollback()
+            g.use_replica = False
+            return f(*args, **kwargs)
+        finally:
+            g.use_replica = False
+    return decorated_function
+
+
+@contextmanager
+def replica_reads():
+    """Query-level version of @read_replica: `with replica_reads(): ...`"""
+    previous = g.get('use_replica', False)
+    g.use_replica = True
+    try:
+        yield
+    finally:
+        g.use_replica = previous
+
+
+def read_engine():
+    """Engine for reads that bypass the session (e.g. streamed Core queries)"""
+    from app.branches import branch_engine
+    if branch_engine() is not None:
+        return branch_engine()
+    replica = get_replica()
+    if replica is not None and _replica_allowed() and replica.usable():
+        return replica.engine
+    from app import db
+    return db.engine
+
+
+class RoutingSession(Session):
+    """
+    Session that sends job tables to the current branch's database (if it has one)
+    and SELECTs to the replica inside @read_replica / replica_reads()
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('branch_engine') is not None:
+            from app.branches import partitioned
+            if partitioned(mapper, clause):
+                return g.branch_engine
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False):
+            replica = get_replica()
+            if replica is not None and _replica_allowed() and replica.usable():
+                return replica.engine
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+@sa.event.listens_for(RoutingSession, 'after_flush')
+def _flushed(session, flush_context):
+    if has_app_context():
+        g.replica_wrote = True
+
+
+@sa.event.listens_for(RoutingSession, 'do_orm_execute')
+def _executed(orm_execute_state):
+    if has_app_context() and (orm_execute_state.is_insert or orm_execute_state.is_update
+                              or orm_execute_state.is_delete):
+        g.replica_wrote = True
@@ -0,0 +1,146 @@
+"""
+Spot - Response compression and streamed rendering
+Text responses (HTML, JSON, CSV) are compressed with brotli or gzip, whichever the client
+prefers in Accept-Encoding. Buffered bodies below COMPRESS_MIN_SIZE are sent as they are;
+streamed bodies are compressed chunk by chunk and flushed, so the client still gets the
+first bytes early.
+"""
+
+import gzip
+import zlib
+from flask import current_app, get_flashed_messages, request, stream_template, stream_with_context
+from flask_wtf.csrf import generate_csrf
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+COMPRESSIBLE_MIMETYPES = ('text/html', 'text/plain', 'text/csv', 'text/css', 'text/javascript',
+                          'application/json', 'application/javascript', 'image/svg+xml')
+# Rendered template text is sent in pieces of about this size; the first one goes out sooner
+# so the browser can start on <head> (stylesheets, scripts) while the rest renders
+STREAM_CHUNK_SIZE = 16 * 1024
+STREAM_FIRST_CHUNK_SIZE = 2 * 1024
+
+
+# COMPRESSION
+
+
+def _negotiate():
+    """Best encoding both sides support, or None"""
+    offered = ['br', 'gzip'] if BROTLI_AVAILABLE else ['gzip']
+    return request.accept_encodings.best_match(offered)
+
+
+def _compress(data, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+
+def _compress_stream(chunks, encoding, config):
+    """Compress a streamed body, flushing after every chunk so nothing waits for the end"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)  # 31: gzip container
+        process, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            if chunk:
+                yield process(chunk) + flush()
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _compressible(response):
+    if response.status_code != 200 or response.direct_passthrough:
+        return False
+    if 'Content-Encoding' in response.headers or 'no-transform' in response.headers.get('Cache-Control', ''):
+        return False
+    return response.mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def init_compression(app):
+    """
+    Compress responses after every other after_request hook has run
+    Call before registering other hooks: Flask runs after_request hooks in reverse order
+    """
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if not _compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = _negotiate()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, app.config)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < app.config['COMPRESS_MIN_SIZE']:
+                return response
+            compressed = _compress(data, encoding, app.config)
+            if len(compressed) >= len(data):
+                return response
+            response.set_data(compressed)
+
+        response.headers['Content-Encoding'] = encoding
+        # The bytes differ per encoding, so a strong validator would claim otherwise
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    print(f"[OK] Response compression ({'brotli, ' if BROTLI_AVAILABLE else ''}gzip)")
+
+
+# STREAMING
+
+
+def _chunked(pieces):
+    """Join Jinja's many small pieces into chunks"""
+    buffer, buffered, size = [], 0, STREAM_FIRST_CHUNK_SIZE
+    try:
+        for piece in pieces:
+            buffer.append(piece)
+            buffered += len(piece)
+            if buffered >= size:
+                yield ''.join(buffer)
+                buffer, buffered, size = [], 0, STREAM_CHUNK_SIZE
+        if buffer:
+            yield ''.join(buffer)
+    finally:
+        pieces.close()  # ends the request context stream_template keeps open
+
+
+def stream_page(template_name, **context):
+    """
+    Render a template as a streamed response
+    The session is saved before the body is generated, so anything the templates would
+    take from it (flashed messages, the CSRF token) is read here, up front
+    """
+    get_flashed_messages()
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        generate_csrf()
+    return current_app.response_class(_chunked(stream_template(template_name, **context)),
+                                      mimetype='text/html')
+
+
+def stream_rows(rows, mimetype='text/csv', filename=None):
+    """Streamed response of already formatted text chunks (e.g. CSV), generated inside the request context"""
+    headers = {'Content-Disposition': f'attachment; filename={filename}'} if filename else None
+    return current_app.response_class(stream_with_context(rows), mimetype=mimetype, headers=headers)
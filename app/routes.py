@@ -1,13 +1,36 @@
 #from flask import Markup
-from flask import render_template, redirect, url_for, flash, request, current_app as app, jsonify
+from flask import render_template, redirect, url_for, flash, request, current_app as app, jsonify, Response, g, session
 from markupsafe import Markup #allows python not assume hyper link.
 from flask_login import login_user, logout_user, current_user, login_required
 from datetime import datetime, date, timedelta
+from sqlalchemy.orm.exc import StaleDataError
+import csv
+import io
+import json
+import time
 from app import db
-from app.models import User, Service, Car, Notification, ArchivedJob #classes
-from app.forms import (LoginForm, AddCarForm, EditCarForm, AddServiceForm, 
-                       EditServiceForm, AddUserForm, EditUserForm, UpdateStatusForm, UpdateProfileForm)
-from app.utils import admin_required, send_notification
+from app.models import User, Service, Car, Customer, Notification, ArchivedJob, JobStatusChange, DailyRollup, Branch #classes
+from app.forms import (LoginForm, AddCarForm, BulkIntakeForm, EditCarForm, AddServiceForm, 
+                       EditServiceForm, AddUserForm, EditUserForm, UpdateStatusForm, UpdateProfileForm, AddBranchForm)
+from app.utils import admin_required, owner_required, send_notification
+from app.branches import all_branches, get_branch, branch_scope, invalidate_branches, create_branch_tables, unscoped
+from app.replica import read_replica, replica_reads
+from app.ratelimit import login_allowed
+from app.scheduler import scheduler
+from app.forecasting import forecaster
+from app.stats import (record_archived_jobs, rebuild_rollup_day, rebuild_daily_rollups, rollups_missing,
+                       distribution_stats, kenya_day, stage_stats)
+from app.cold_storage import (archive_totals, archive_service_stats, archive_staff_stats,
+                               search_archived_jobs, iter_archived_jobs, tier_archived_jobs, clear_cold_storage,
+                               cold_storage_summary)
+from app.intake import bulk_intake, parse_csv, INTAKE_FIELDS
+from app.customers import find_or_create_customer, search_customers, record_visits, remove_visit, archived_customer_ids, recompute_visits
+from app.metrics import observe_archive_batch
+from app.idempotency import idempotent
+from app.sync import apply_changes, delta, parse_watermark
+from app.profiling import issue_token, list_profiles, load_profile, to_collapsed, to_speedscope, PROFILE_HEADER
+from app.responses import stream_page, stream_rows
+from app.tasks import task, enqueue, active_task, get_task, recent_tasks, task_dict, task_title, delete_in_batches
 
 def kenya_time(dt):
     """Convert UTC to Kenya time (UTC+3)"""
@@ -33,50 +56,252 @@ def get_today_start_end_utc():
     
     return start_of_day_utc, end_of_day_utc
 
-def auto_archive_old_jobs():
-    """Automatically archive completed jobs older than 24 hours"""
+def get_stage_minutes(jobs):
+    """
+    Minutes each job spent in each stage, from the status log
+    One windowed query (LEAD over each car's transitions) for the whole batch
+    
+    Returns:
+        Dictionary of car id -> {status: minutes}
+    """
+    jobs_by_id = {job.id: job for job in jobs}
+    stage_minutes = {job.id: {} for job in jobs}
+    if not jobs:
+        return stage_minutes
+    
+    next_change = db.func.lead(JobStatusChange.changed_at, type_=db.DateTime).over(
+        partition_by=JobStatusChange.car_id,
+        order_by=JobStatusChange.changed_at
+    )
+    # Car ids can be reused after deletion, so only read the log since this job's time_in
+    transitions = db.session.query(
+        JobStatusChange.car_id,
+        JobStatusChange.from_status,
+        JobStatusChange.to_status,
+        JobStatusChange.changed_at,
+        next_change.label('next_change')
+    ).join(Car, Car.id == JobStatusChange.car_id).filter(
+        JobStatusChange.car_id.in_(jobs_by_id),
+        JobStatusChange.changed_at >= Car.time_in
+    ).order_by(JobStatusChange.car_id, JobStatusChange.changed_at).all()
+    
+    def add(minutes, status, start, end):
+        if status in ArchivedJob.STAGE_COLUMNS and start and end:
+            minutes[status] = minutes.get(status, 0) + (end - start).total_seconds() / 60
+    
+    seen = set()
+    for row in transitions:
+        job = jobs_by_id[row.car_id]
+        minutes = stage_minutes[row.car_id]
+        if row.car_id not in seen:
+            seen.add(row.car_id)
+            # Jobs created before the log existed have no initial entry
+            if row.from_status is not None:
+                add(minutes, row.from_status, job.time_in, row.changed_at)
+        add(minutes, row.to_status, row.changed_at, row.next_change or job.time_out)
+    
+    return stage_minutes
+
+def build_archived_job(job, stage_minutes):
+    """Create the ArchivedJob record for a completed job"""
+    duration = job.get_duration()
+    archived = ArchivedJob(
+        branch_id=job.branch_id,
+        original_id=job.id,
+        plate_number=job.plate_number,
+        car_model=job.car_model,
+        customer_name=job.customer_name,
+        customer_phone=job.customer_phone,
+        customer_email=job.customer_email,
+        customer_id=job.customer_id,
+        service_name=job.service.name,
+        service_price=job.service.price,
+        service_duration=job.service.duration,
+        staff_name=job.assigned_user.full_name if job.assigned_user else None,
+        staff_username=job.assigned_user.username if job.assigned_user else None,
+        status=job.status,
+        notes=job.notes,
+        time_in=job.time_in,
+        time_out=job.time_out,
+        duration_minutes=int(duration) if duration else None,
+        archived_at=datetime.utcnow()
+    )
+    for status, minutes in stage_minutes.items():
+        setattr(archived, ArchivedJob.STAGE_COLUMNS[status], int(round(minutes)))
+    return archived
+
+def archive_jobs(jobs):
+    """Take jobs off the active list: completed ones are archived, the rest deleted (caller commits)"""
+    stage_minutes = get_stage_minutes([job for job in jobs if job.status == 'Completed' and job.time_out])
+    
+    archived = []
+    for job in jobs:
+        if job.status == 'Completed' and job.time_out:
+            archived.append(build_archived_job(job, stage_minutes[job.id]))
+            db.session.add(archived[-1])
+        db.session.delete(job)
+        scheduler.remove(job.id)
+    
+    if archived:
+        record_archived_jobs(archived)
+        record_visits(archived)
+    return archived
+
+def auto_archive_old_jobs(limit=None):
+    """Automatically archive completed jobs older than 24 hours (at most `limit`, oldest first)"""
+    started = time.perf_counter()
     cutoff_time = datetime.utcnow() - timedelta(hours=24)
     
-    old_completed_jobs = Car.query.filter(
+    query = Car.query.filter(
         Car.status == 'Completed',
         Car.time_out != None,
         Car.time_out < cutoff_time
-    ).all()
+    ).order_by(Car.id)
+    old_completed_jobs = (query.limit(limit) if limit else query).all()
     
-    archived_count = 0
-    for job in old_completed_jobs:
-        # Create archive record
-        duration = job.get_duration()
-        archived = ArchivedJob(
-            original_id=job.id,
-            plate_number=job.plate_number,
-            car_model=job.car_model,
-            customer_name=job.customer_name,
-            customer_phone=job.customer_phone,
-            customer_email=job.customer_email,
-            service_name=job.service.name,
-            service_price=job.service.price,
-            service_duration=job.service.duration,
-            staff_name=job.assigned_user.full_name if job.assigned_user else None,
-            staff_username=job.assigned_user.username if job.assigned_user else None,
-            status=job.status,
-            notes=job.notes,
-            time_in=job.time_in,
-            time_out=job.time_out,
-            duration_minutes=int(duration) if duration else None,
-            archived_at=datetime.utcnow()
-        )
-        db.session.add(archived)
-        db.session.delete(job)
-        archived_count += 1
+    archived_count = len(archive_jobs(old_completed_jobs))
     
     if archived_count > 0:
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # A job was edited while being archived; it is picked up on a later run
+            db.session.rollback()
+            print("[!] Auto-archive skipped: a job changed while it was being archived")
+            return 0
+        observe_archive_batch('auto', archived_count, started)
         print(f"[AUTO-ARCHIVE] Archived {archived_count} completed jobs older than 24 hours")
     
     return archived_count
 
 
+# BACKGROUND TASKS (heavy admin actions, run by app/tasks.py worker threads)
+
+
+def queue_task(name, **params):
+    """Queue a background task for the admin and send them to the task status page"""
+    task_id, created = enqueue(name, current_user, **params)
+    if created:
+        flash(f'{task_title(name)} started in the background.', 'info')
+    else:
+        flash(f'{task_title(name)} is already running.', 'info')
+    return redirect(url_for('list_tasks'))
+
+
+@task('archive_jobs', 'Archive completed jobs')
+def archive_jobs_task(progress):
+    """Archive completed jobs older than 24 hours, one batch per transaction"""
+    cutoff_time = datetime.utcnow() - timedelta(hours=24)
+    progress.update(total=Car.query.filter(
+        Car.status == 'Completed', Car.time_out != None, Car.time_out < cutoff_time
+    ).count())
+    
+    batch_size = app.config.get('TASK_BATCH_SIZE', 1000)
+    while True:
+        archived_count = auto_archive_old_jobs(limit=batch_size)
+        if not archived_count:
+            break
+        progress.advance(archived_count)
+    
+    if progress.done:
+        return f'Archived {progress.done} completed jobs'
+    return 'No completed jobs to archive at this time'
+
+
+@task('clear_today', "Clear today's jobs")
+def clear_today_task(progress, until=None):
+    """Clear today's jobs (completed ones archived, the rest deleted), one batch per transaction"""
+    started = time.perf_counter()
+    start_of_day_utc, end_of_day_utc = get_today_start_end_utc()
+    # Jobs added after the button was pressed are kept
+    if until:
+        end_of_day_utc = min(end_of_day_utc, datetime.fromisoformat(until))
+    
+    todays_jobs = Car.query.filter(
+        Car.time_in >= start_of_day_utc,
+        Car.time_in <= end_of_day_utc
+    ).order_by(Car.id)
+    progress.update(total=todays_jobs.count())
+    
+    batch_size = app.config.get('TASK_BATCH_SIZE', 1000)
+    completed_count = 0
+    conflicts = 0
+    while True:
+        jobs = todays_jobs.limit(batch_size).all()
+        if not jobs:
+            break
+        archived = archive_jobs(jobs)
+        try:
+            db.session.commit()
+        except StaleDataError:
+            # A job changed under this batch: reload it and try again
+            db.session.rollback()
+            conflicts += 1
+            if conflicts > 3:
+                raise RuntimeError('Jobs kept changing while today\'s data was being cleared. Please try again.')
+            continue
+        completed_count += len(archived)
+        progress.advance(len(jobs), f'{completed_count} archived so far')
+    
+    observe_archive_batch('clear_today', completed_count, started)
+    return (f'Cleared {progress.done} jobs from today ({completed_count} archived, '
+            f'{progress.done - completed_count} deleted)')
+
+
+@task('tier_archives', 'Move old archives to cold storage')
+def tier_archives_task(progress):
+    """Move archived jobs older than ARCHIVE_HOT_MONTHS to cold storage files, a month at a time"""
+    files = tier_archived_jobs(progress=progress)
+    if files:
+        return f'Moved {sum(entry.row_count for entry in files)} archived jobs into {len(files)} cold storage files'
+    return 'No archived jobs are old enough for cold storage'
+
+
+@task('rebuild_rollups', 'Rebuild analytics rollups')
+def rebuild_rollups_task(progress):
+    """Recompute the daily rollups behind the percentiles and branch totals"""
+    try:
+        rebuild_daily_rollups(progress=progress)
+    except Exception:
+        # Partial rollups would pass for complete ones: drop them so the next visit queues a rebuild
+        db.session.rollback()
+        DailyRollup.query.delete()
+        db.session.commit()
+        raise
+    return f'Rebuilt analytics rollups from {progress.done} archived jobs'
+
+
+def rollups_ready():
+    """
+    Whether the daily rollups can be read. When they are missing (fresh install, or dropped
+    by a migration) or out of date, a rebuild is queued once and this is False until it has finished.
+    """
+    if active_task('rebuild_rollups') is not None:
+        return False
+    if rollups_missing():
+        enqueue('rebuild_rollups')
+        return False
+    return True
+
+
+@task('clear_all_archives', 'Delete all archived jobs')
+def clear_all_archives_task(progress):
+    """
+    Delete every archived job of the branch, hot rows in batches, then rollups and cold files;
+    the visit counters of its customers are recomputed from the jobs other branches still hold
+    """
+    count = archive_totals()[0]
+    progress.update(total=count)
+    customer_ids = archived_customer_ids()
+    delete_in_batches(ArchivedJob.query, progress)
+    DailyRollup.query.delete()
+    clear_cold_storage()
+    recompute_visits(customer_ids)
+    db.session.commit()
+    progress.update(done=count)
+    return f'Permanently deleted {count} archived jobs'
+
+
 # AUTHENTICATION ROUTES
 
 
@@ -90,6 +315,10 @@ def login():
         return redirect(url_for('staff_dashboard'))
     
     form = LoginForm()
+    if request.method == 'POST' and not login_allowed(request.remote_addr, form.username.data):
+        flash('Too many login attempts. Please wait a minute and try again.', 'error')
+        return render_template('login.html', form=form), 429
+    
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         
@@ -101,6 +330,11 @@ def login():
             flash(Markup('Your account was deactivated. Please contact admin at <a href="mailto:murabulaelizabeth@gmail.com">murabulaelizabeth@gmail.com</a>'), 'error')
             return redirect(url_for('login'))
         
+        # Upgrade the stored hash while we have the plaintext
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+        
         login_user(user, remember=form.remember_me.data)
         flash(f'Welcome back, {user.full_name}!', 'success')
         
@@ -116,7 +350,10 @@ def logout():
     """Logout user"""
     logout_user()
     flash('You have been logged out successfully.', 'info')
-    return redirect(url_for('login'))
+    response = redirect(url_for('login'))
+    # Drop the staff app's cached shell and job list so the next user on this phone starts clean
+    response.headers['Clear-Site-Data'] = '"cache", "storage"'
+    return response
 
 
 
@@ -128,8 +365,10 @@ def logout():
 @admin_required
 def admin_dashboard():
     """Admin dashboard with statistics and job list"""
-    # Auto-archive old jobs on each dashboard load
-    auto_archive_old_jobs()
+    # Auto-archive old jobs on each dashboard load; a backlog bigger than one batch goes to the background
+    batch_size = app.config.get('TASK_BATCH_SIZE', 1000)
+    if auto_archive_old_jobs(limit=batch_size) >= batch_size:
+        enqueue('archive_jobs', current_user)
     
     # Get today's date range in UTC
     start_of_day_utc, end_of_day_utc = get_today_start_end_utc()
@@ -164,7 +403,11 @@ def admin_dashboard():
     revenue = sum([job.service.price for job in completed_jobs_today])
     
     # Get all active jobs (not completed) + completed jobs from today
-    active_cars = Car.query.filter(
+    # (service and staff loaded up front: their names are part of the cached row key; selectinload
+    # rather than a join because a branch's jobs may live in a different database from users/services)
+    active_cars = Car.query.options(
+        db.selectinload(Car.service), db.selectinload(Car.assigned_user)
+    ).filter(
         db.or_(
             Car.status != 'Completed',
             db.and_(
@@ -176,9 +419,12 @@ def admin_dashboard():
     ).order_by(Car.time_in.desc()).all()
     
     # Convert times to Kenya timezone for display
+    etas = scheduler.etas()
     for car in active_cars:
         car.time_in_display = kenya_time(car.time_in)
         car.time_out_display = kenya_time(car.time_out)
+        eta = etas.get(car.id)
+        car.ready_by_display = kenya_time(eta['ready_at']) if eta else None
     
     stats = {
         'total_jobs': total_jobs,
@@ -197,153 +443,140 @@ def admin_dashboard():
 @app.route('/admin/archive-now', methods=['POST']) #when data sends post request here, the archive_now() is called 
 @login_required #ensures that only logged-in users can access this route
 @admin_required
+@idempotent
 def archive_now():
-    """Manually trigger archiving of completed jobs"""
-    archived_count = auto_archive_old_jobs()
-    
-    if archived_count > 0:
-        flash(f'Successfully archived {archived_count} completed jobs!', 'success')
-    else:
-        flash('No completed jobs to archive at this time.', 'info')
-    
-    return redirect(url_for('admin_dashboard'))
+    """Queue archiving of completed jobs"""
+    return queue_task('archive_jobs')
 
 
 @app.route('/admin/clear-today', methods=['POST'])
 @login_required
 @admin_required
+@idempotent
 def clear_today_data():
-    """Clear today's active jobs (move completed to archive, delete rest)"""
-    start_of_day_utc, end_of_day_utc = get_today_start_end_utc()
-    
-    # Get today's jobs
-    todays_jobs = Car.query.filter(
-        Car.time_in >= start_of_day_utc,
-        Car.time_in <= end_of_day_utc
-    ).all()
-    
-    completed_count = 0
-    deleted_count = 0
-    
-    for job in todays_jobs:
-        if job.status == 'Completed' and job.time_out:
-            # Archive completed jobs
-            duration = job.get_duration()
-            archived = ArchivedJob(
-                original_id=job.id,
-                plate_number=job.plate_number,
-                car_model=job.car_model,
-                customer_name=job.customer_name,
-                customer_phone=job.customer_phone,
-                customer_email=job.customer_email,
-                service_name=job.service.name,
-                service_price=job.service.price,
-                service_duration=job.service.duration,
-                staff_name=job.assigned_user.full_name if job.assigned_user else None,
-                staff_username=job.assigned_user.username if job.assigned_user else None,
-                status=job.status,
-                notes=job.notes,
-                time_in=job.time_in,
-                time_out=job.time_out,
-                duration_minutes=int(duration) if duration else None,
-                archived_at=datetime.utcnow()
-            )
-            db.session.add(archived)
-            completed_count += 1
-        
-        # Delete job from active table
-        db.session.delete(job)
-        deleted_count += 1
-    
-    db.session.commit()
-    flash(f'Cleared {deleted_count} jobs from today ({completed_count} archived, {deleted_count - completed_count} deleted)', 'success')
-    return redirect(url_for('admin_dashboard'))
+    """Queue clearing today's active jobs (move completed to archive, delete rest)"""
+    return queue_task('clear_today', until=datetime.utcnow().isoformat())
 
 
 @app.route('/admin/analytics')
 @login_required
 @admin_required
+@read_replica
 def analytics():
     """Full analytics page with archived data"""
-    # Total archived jobs
-    total_archived = ArchivedJob.query.count()
-    
-    # Total revenue (all time from archives)
-    total_revenue = db.session.query(db.func.sum(ArchivedJob.service_price)).scalar() or 0
+    # Totals, services and staff cover hot rows plus jobs moved to cold storage
+    total_archived, total_revenue = archive_totals()
+    service_stats = archive_service_stats()
     
     # Most popular service
-    popular_services = db.session.query(
-        ArchivedJob.service_name,
-        db.func.count(ArchivedJob.id).label('count'),
-        db.func.sum(ArchivedJob.service_price).label('revenue')
-    ).group_by(ArchivedJob.service_name).order_by(db.desc('count')).limit(10).all()
-    
-    # Top customers (by number of visits)
-    top_customers = db.session.query(
-        ArchivedJob.customer_name,
-        ArchivedJob.customer_phone,
-        db.func.count(ArchivedJob.id).label('visits'),
-        db.func.sum(ArchivedJob.service_price).label('total_spent')
-    ).group_by(ArchivedJob.customer_name, ArchivedJob.customer_phone).order_by(
-        db.desc('visits')
+    popular_services = [(name, jobs, revenue) for name, jobs, revenue, *_ in
+                        sorted(service_stats, key=lambda stats: stats[1], reverse=True)[:10]]
+    
+    # Top customers (by number of visits, kept on the customer row at archive time)
+    top_customers = Customer.query.filter(Customer.visits > 0).order_by(
+        Customer.visits.desc()
     ).limit(10).all()
     
     # Staff performance
-    staff_stats = db.session.query(
-        ArchivedJob.staff_name,
-        db.func.count(ArchivedJob.id).label('jobs_done'),
-        db.func.avg(ArchivedJob.duration_minutes).label('avg_duration')
-    ).filter(ArchivedJob.staff_name != None).group_by(
-        ArchivedJob.staff_name
-    ).order_by(db.desc('jobs_done')).all()
+    staff_stats = archive_staff_stats()
     
     # Average duration per service
-    service_durations = db.session.query(
-        ArchivedJob.service_name,
-        db.func.avg(ArchivedJob.duration_minutes).label('avg_duration'),
-        db.func.min(ArchivedJob.duration_minutes).label('min_duration'),
-        db.func.max(ArchivedJob.duration_minutes).label('max_duration')
-    ).filter(ArchivedJob.duration_minutes != None).group_by(
-        ArchivedJob.service_name
-    ).all()
+    service_durations = [(name, duration_sum / duration_count, low, high)
+                         for name, _, _, duration_sum, duration_count, low, high in service_stats
+                         if duration_count]
     
-    return render_template('analytics.html',
-                         total_archived=total_archived,
-                         total_revenue=total_revenue,
-                         popular_services=popular_services,
-                         top_customers=top_customers,
-                         staff_stats=staff_stats,
-                         service_durations=service_durations)
+    # Duration/revenue percentiles (daily rollups + sketches on SQLite, percentile_cont on Postgres)
+    # and time per stage (stage sketches on the daily rollups), cached until the rollups change
+    rollups_rebuilding = not rollups_ready()
+    service_distribution = staff_distribution = daily_distribution = stages = []
+    if not rollups_rebuilding:
+        stages = stage_stats()
+        service_distribution = distribution_stats('service')[:10]
+        staff_distribution = distribution_stats('staff')
+        daily_distribution = distribution_stats('day', since=(datetime.utcnow() + timedelta(hours=3)).date() - timedelta(days=13))
+    
+    # Expected arrivals for the next 12 hours (hour-of-week profiles)
+    forecast = forecaster.forecast(hours=12)
+    for hour in forecast:
+        hour['hour_display'] = kenya_time(hour['hour'])
+        hour['top_service'] = max(hour['services'], key=hour['services'].get) if hour['services'] else None
+    
+    return stream_page('analytics.html',
+                       total_archived=total_archived,
+                       total_revenue=total_revenue,
+                       popular_services=popular_services,
+                       top_customers=top_customers,
+                       staff_stats=staff_stats,
+                       service_durations=service_durations,
+                       stage_stats=stages,
+                       service_distribution=service_distribution,
+                       staff_distribution=staff_distribution,
+                       daily_distribution=daily_distribution,
+                       rollups_rebuilding=rollups_rebuilding,
+                       forecast=forecast,
+                       cold_storage=cold_storage_summary(),
+                       cold_storage_configured=bool(app.config['COLD_STORAGE_DIR']),
+                       hot_months=app.config['ARCHIVE_HOT_MONTHS'])
+
+
+@app.route('/admin/forecast')
+@login_required
+@admin_required
+@read_replica
+def demand_forecast():
+    """Expected arrivals per hour and service (JSON)"""
+    hours = min(request.args.get('hours', 24, type=int), 24 * 7)
+    
+    return jsonify([{
+        'hour': kenya_time(hour['hour']).strftime('%Y-%m-%d %H:00'),
+        'total': round(hour['total'], 2),
+        'services': {name: round(rate, 2) for name, rate in hour['services'].items()}
+    } for hour in forecaster.forecast(hours=hours)])
 
 
 @app.route('/admin/archived-jobs')
 @login_required
 @admin_required
+@read_replica
 def view_archived_jobs():
     """View all archived jobs with search and pagination"""
     page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '')
     
-    query = ArchivedJob.query
+    # Search and paginate hot rows, continuing into cold storage
+    archived_jobs = search_archived_jobs(search, page=page, per_page=50)
     
-    # Search filter
-    if search:
-        query = query.filter(
-            db.or_(
-                ArchivedJob.plate_number.ilike(f'%{search}%'),
-                ArchivedJob.customer_name.ilike(f'%{search}%'),
-                ArchivedJob.customer_phone.ilike(f'%{search}%')
-            )
-        )
+    return stream_page('archived_jobs.html',
+                       archived_jobs=archived_jobs,
+                       search=search)
+
+
+# Columns of the archived jobs CSV export
+EXPORT_COLUMNS = ('plate_number', 'car_model', 'customer_name', 'customer_phone', 'service_name', 'service_price',
+                  'staff_name', 'time_in', 'time_out', 'duration_minutes', 'archived_at')
+
+
+@app.route('/admin/archived-jobs/export')
+@login_required
+@admin_required
+def export_archived_jobs():
+    """Every archived job matching the search as CSV, sent while the rows are still being read"""
+    search = request.args.get('search', '')
     
-    # Paginate results
-    archived_jobs = query.order_by(ArchivedJob.archived_at.desc()).paginate(
-        page=page, per_page=50, error_out=False
-    )
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()  # the header row goes out before the first query
+        with replica_reads():
+            for batch in iter_archived_jobs(search):
+                buffer.seek(0)
+                buffer.truncate()
+                for job in batch:
+                    writer.writerow([getattr(job, column, None) for column in EXPORT_COLUMNS])
+                yield buffer.getvalue()
     
-    return render_template('archived_jobs.html', 
-                         archived_jobs=archived_jobs,
-                         search=search)
+    return stream_rows(generate(), filename=f"archived-jobs-{datetime.utcnow().strftime('%Y%m%d')}.csv")
 
 
 @app.route('/admin/delete-archive/<int:archive_id>', methods=['POST'])
@@ -354,21 +587,89 @@ def delete_archived_job(archive_id):
     archived = ArchivedJob.query.get_or_404(archive_id)
     plate = archived.plate_number
     db.session.delete(archived)
+    remove_visit(archived)
+    if archived.time_in:
+        db.session.flush()
+        rebuild_rollup_day(kenya_day(archived.time_in))
     db.session.commit()
     flash(f'Archived job for {plate} deleted permanently!', 'success')
     return redirect(url_for('view_archived_jobs'))
 
 
+@app.route('/admin/tier-archives', methods=['POST'])
+@login_required
+@admin_required
+@idempotent
+def tier_archives():
+    """Queue moving archived jobs older than ARCHIVE_HOT_MONTHS to cold storage files"""
+    return queue_task('tier_archives')
+
+
+@app.route('/admin/profiles')
+@login_required
+@admin_required
+def list_profiles_view():
+    """Recent request profiles and a token to profile more"""
+    return render_template('profiles.html',
+                         profiles=list_profiles(app),
+                         token=issue_token(app, current_user),
+                         header=PROFILE_HEADER,
+                         sample_rate=app.config.get('PROFILE_SAMPLE_RATE', 0),
+                         token_minutes=app.config.get('PROFILE_TOKEN_MAX_AGE', 3600) // 60,
+                         kenya_time=kenya_time)
+
+
+@app.route('/admin/profiles/<profile_id>/<fmt>')
+@login_required
+@admin_required
+def download_profile(profile_id, fmt):
+    """Download one profile as speedscope JSON or collapsed stacks"""
+    profile = load_profile(app, profile_id)
+    if profile is None or fmt not in ('speedscope', 'collapsed'):
+        flash('That profile is no longer available.', 'error')
+        return redirect(url_for('list_profiles_view'))
+    
+    if fmt == 'speedscope':
+        body, mimetype, filename = json.dumps(to_speedscope(profile)), 'application/json', f'{profile_id}.speedscope.json'
+    else:
+        body, mimetype, filename = to_collapsed(profile), 'text/plain', f'{profile_id}.collapsed.txt'
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
 @app.route('/admin/clear-all-archives', methods=['POST'])
 @login_required
 @admin_required
+@idempotent
 def clear_all_archives():
-    """Delete ALL archived jobs (with confirmation)"""
-    count = ArchivedJob.query.count()
-    ArchivedJob.query.delete()
-    db.session.commit()
-    flash(f'Permanently deleted {count} archived jobs!', 'warning')
-    return redirect(url_for('analytics'))
+    """Queue deleting ALL archived jobs (with confirmation)"""
+    return queue_task('clear_all_archives')
+
+
+@app.route('/admin/tasks')
+@login_required
+@admin_required
+def list_tasks():
+    """Background tasks of this branch with their progress"""
+    tasks = recent_tasks()
+    usernames = dict(db.session.query(User.id, User.username).filter(
+        User.id.in_({info.user_id for info in tasks if info.user_id})
+    ).all())
+    return render_template('tasks.html', tasks=[
+        dict(task_dict(info), queued_at=kenya_time(info.created_at), queued_by=usernames.get(info.user_id))
+        for info in tasks
+    ])
+
+
+@app.route('/admin/tasks/<int:task_id>')
+@login_required
+@admin_required
+def task_status(task_id):
+    """One background task's progress (JSON, polled by the tasks page)"""
+    info = get_task(task_id)
+    if info is None:
+        return jsonify({'error': 'Task not found'}), 404
+    return jsonify(task_dict(info))
 
 
 
@@ -383,13 +684,13 @@ def staff_dashboard():
     start_of_day_utc, end_of_day_utc = get_today_start_end_utc()
     
     # Get assigned cars that are NOT completed yet
-    assigned_cars = Car.query.filter(
+    assigned_cars = Car.query.options(db.selectinload(Car.service)).filter(
         Car.assigned_user_id == current_user.id,
         Car.status != 'Completed'
     ).order_by(Car.time_in.desc()).all()
     
     # Get completed cars today (based on completion time) - STILL IN DATABASE
-    completed_cars = Car.query.filter(
+    completed_cars = Car.query.options(db.selectinload(Car.service)).filter(
         Car.assigned_user_id == current_user.id,
         Car.status == 'Completed',
         Car.time_out != None,
@@ -398,9 +699,12 @@ def staff_dashboard():
     ).order_by(Car.time_out.desc()).all()
     
     # Convert times to Kenya timezone for display
+    etas = scheduler.etas()
     for car in assigned_cars + completed_cars:
         car.time_in_display = kenya_time(car.time_in)
         car.time_out_display = kenya_time(car.time_out)
+        eta = etas.get(car.id)
+        car.ready_by_display = kenya_time(eta['ready_at']) if eta else None
     
     stats = {
         'assigned': len(assigned_cars),
@@ -414,11 +718,75 @@ def staff_dashboard():
                          completed_cars=completed_cars)
 
 
+@app.route('/staff/app')
+@login_required
+def staff_app():
+    """Offline-capable job list: an app shell the service worker caches, filled by /staff/sync"""
+    return render_template('staff_app.html')
+
+
+@app.route('/staff/sw.js')
+def staff_service_worker():
+    """Service worker, served under /staff/ so it can control the staff app"""
+    response = app.send_static_file('js/staff_sw.js')
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/staff/sync', methods=['GET', 'POST'])
+@login_required
+@idempotent
+def staff_sync():
+    """
+    Delta sync for the staff app
+    GET ?since=<watermark>: jobs changed since the last sync
+    POST {"since": ..., "changes": [...]}: apply status changes queued offline, then the same delta
+    """
+    start_of_day_utc, _ = get_today_start_end_utc()
+    results = []
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        changes = data.get('changes') or []
+        if not isinstance(changes, list):
+            return jsonify({'error': 'changes must be a list'}), 400
+        results = apply_changes(current_user, changes)
+        since = parse_watermark(data.get('since'))
+    else:
+        since = parse_watermark(request.args.get('since'))
+    
+    payload = delta(current_user, since, start_of_day_utc)
+    payload['results'] = results
+    response = jsonify(payload)
+    response.cache_control.no_store = True
+    return response
+
 
 # CAR/JOB MANAGEMENT
+def version_matches(car, submitted):
+    """
+    Whether a form was filled in against the job's current version
+    Forms without a version still get the check between this read and the commit
+    """
+    if submitted in (None, ''):
+        return True
+    try:
+        return int(submitted) == car.version
+    except (TypeError, ValueError):
+        return False
+
+def version_conflict(plate, next_url):
+    """Roll back and tell the user the job was changed by someone else (409 for JSON clients)"""
+    db.session.rollback()
+    message = f'Job for {plate} was just changed by someone else. Please check it and try again.'
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': message}), 409
+    flash(message, 'warning')
+    return redirect(next_url)
+
 @app.route('/cars/add', methods=['GET', 'POST']) #adding  job
 @login_required
 @admin_required
+@idempotent
 def add_car():
     """Add a new car/job"""
     form = AddCarForm()
@@ -427,27 +795,108 @@ def add_car():
     form.assigned_user_id.choices = [(u.id, u.full_name) 
                                      for u in User.query.filter_by(role='staff', is_active=True).all()]
     
+    # Preselect the least-loaded staff member
+    if not form.is_submitted():
+        form.assigned_user_id.data = scheduler.suggest_staff([choice[0] for choice in form.assigned_user_id.choices])
+    
     if form.validate_on_submit():
+        plate_number = form.plate_number.data.upper().strip()
+        customer = find_or_create_customer(form.customer_name.data, form.customer_phone.data,
+                                           form.customer_email.data, plate_number, form.car_model.data)
         car = Car(
-            plate_number=form.plate_number.data.upper().strip(),
+            plate_number=plate_number,
             car_model=form.car_model.data,
             customer_name=form.customer_name.data,
-            customer_phone=form.customer_phone.data,
+            customer_phone=customer.phone if customer else form.customer_phone.data,
             customer_email=form.customer_email.data,
+            customer_id=customer.id if customer else None,
             service_id=form.service_id.data,
             assigned_user_id=form.assigned_user_id.data,
             notes=form.notes.data,
-            status='Waiting',
             time_in=datetime.utcnow()
         )
         db.session.add(car)
+        car.set_status('Waiting', changed_by=current_user, changed_at=car.time_in)
         db.session.commit()
+        scheduler.track(car)
         flash(f'Job for {car.plate_number} added successfully!', 'success')
         return redirect(url_for('admin_dashboard'))
     
     return render_template('add_car.html', form=form)
 
 
+@app.route('/cars/bulk', methods=['GET', 'POST'])
+@login_required
+@admin_required
+@idempotent
+def bulk_add_cars():
+    """
+    Add many cars/jobs at once
+    Accepts a CSV upload from the form, or a JSON array of jobs (or {"jobs": [...], "auto_assign": true,
+    "service_id": 1}) which gets a JSON report back
+    """
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        if isinstance(payload, list):
+            payload = {'jobs': payload}
+        if not isinstance(payload, dict) or not isinstance(payload.get('jobs'), list):
+            return jsonify({'error': 'Expected a JSON array of jobs'}), 400
+        
+        cars, errors = bulk_intake(
+            payload['jobs'],
+            auto_assign=bool(payload.get('auto_assign')),
+            default_service_id=payload.get('service_id'),
+            changed_by=current_user
+        )
+        return jsonify({
+            'created': len(cars),
+            'cars': [{'id': car.id, 'plate_number': car.plate_number,
+                      'assigned_user_id': car.assigned_user_id} for car in cars],
+            'errors': errors
+        }), 201 if cars else 400
+    
+    form = BulkIntakeForm()
+    form.service_id.choices = [(0, '- From CSV -')] + [(s.id, f"{s.name} - KSh {s.price}")
+                                                       for s in Service.query.filter_by(is_active=True).all()]
+    errors = []
+    
+    if form.validate_on_submit():
+        try:
+            rows = parse_csv(form.csv_file.data.stream)
+        except (UnicodeDecodeError, csv.Error) as e:
+            flash(f'Could not read CSV file: {str(e)}', 'error')
+            return render_template('bulk_add_cars.html', form=form, fields=INTAKE_FIELDS, errors=errors)
+        
+        cars, errors = bulk_intake(rows, auto_assign=form.auto_assign.data,
+                                   default_service_id=form.service_id.data or None,
+                                   changed_by=current_user)
+        if cars:
+            flash(f'Imported {len(cars)} jobs.', 'success')
+        if errors:
+            flash(f'{len(errors)} rows were skipped, see below.', 'warning')
+        elif cars:
+            return redirect(url_for('admin_dashboard'))
+    
+    return render_template('bulk_add_cars.html', form=form, fields=INTAKE_FIELDS, errors=errors)
+
+
+@app.route('/customers/lookup')
+@login_required
+@admin_required
+def customer_lookup():
+    """Returning-customer autocomplete for the intake form (prefix of phone or name)"""
+    customers = search_customers(request.args.get('q', ''))
+    return jsonify([{
+        'id': customer.id,
+        'name': customer.name,
+        'phone': customer.phone,
+        'email': customer.email,
+        'plate_number': customer.last_plate,
+        'car_model': customer.last_car_model,
+        'visits': customer.visits
+    } for customer in customers])
+
+
 @app.route('/cars/edit/<int:car_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -461,20 +910,36 @@ def edit_car(car_id):
                                      for u in User.query.filter_by(role='staff', is_active=True).all()]
     
     if form.validate_on_submit():
-        car.customer_name = form.customer_name.data
-        car.customer_phone = form.customer_phone.data
-        car.customer_email = form.customer_email.data
-        car.plate_number = form.plate_number.data.upper().strip()
-        car.car_model = form.car_model.data
-        car.service_id = form.service_id.data
-        car.assigned_user_id = form.assigned_user_id.data
-        car.status = form.status.data
-        car.notes = form.notes.data
+        plate = car.plate_number
+        if not version_matches(car, form.version.data):
+            return version_conflict(plate, url_for('edit_car', car_id=car_id))
         
-        if form.status.data == 'Completed' and not car.time_out:
-            car.time_out = datetime.utcnow()
+        new_plate = form.plate_number.data.upper().strip()
+        if new_plate != plate and Car.query.filter_by(plate_number=new_plate).first():
+            flash('This plate number is already registered at this branch.', 'error')
+            return redirect(url_for('edit_car', car_id=car_id))
         
-        db.session.commit()
+        try:
+            car.customer_name = form.customer_name.data
+            car.customer_phone = form.customer_phone.data
+            car.customer_email = form.customer_email.data
+            car.plate_number = new_plate
+            car.car_model = form.car_model.data
+            customer = find_or_create_customer(car.customer_name, car.customer_phone, car.customer_email,
+                                               car.plate_number, car.car_model)
+            if customer:
+                car.customer_phone = customer.phone
+                car.customer_id = customer.id
+            car.service_id = form.service_id.data
+            car.assigned_user_id = form.assigned_user_id.data
+            car.set_status(form.status.data, changed_by=current_user)
+            car.notes = form.notes.data
+            
+            # UPDATE ... WHERE id = ? AND version = ?; no row lock is held while the form is open
+            db.session.commit()
+        except StaleDataError:
+            return version_conflict(plate, url_for('edit_car', car_id=car_id))
+        scheduler.track(car)
         flash(f'Job for {car.plate_number} updated successfully!', 'success')
         return redirect(url_for('admin_dashboard'))
     
@@ -492,14 +957,21 @@ def delete_car(car_id):
     """Delete a car/job"""
     car = Car.query.get_or_404(car_id)
     plate = car.plate_number
-    db.session.delete(car)
-    db.session.commit()
+    if not version_matches(car, request.form.get('version')):
+        return version_conflict(plate, url_for('admin_dashboard'))
+    try:
+        db.session.delete(car)
+        db.session.commit()
+    except StaleDataError:
+        return version_conflict(plate, url_for('admin_dashboard'))
+    scheduler.remove(car_id)
     flash(f'Job for {plate} deleted successfully!', 'success')
     return redirect(url_for('admin_dashboard'))
 
 
 @app.route('/cars/update-status/<int:car_id>', methods=['POST'])
 @login_required
+@idempotent
 def update_status(car_id):
     """Update job status"""
     car = Car.query.get_or_404(car_id)
@@ -508,15 +980,26 @@ def update_status(car_id):
         flash('You are not authorized to update this job.', 'error')
         return redirect(url_for('staff_dashboard'))
     
+    dashboard = url_for('admin_dashboard') if current_user.role == 'admin' else url_for('staff_dashboard')
     new_status = request.form.get('status')
+    if new_status and new_status not in Car.STATUSES:
+        message = f'Unknown status "{new_status}".'
+        if request.is_json or request.accept_mimetypes.best == 'application/json':
+            return jsonify({'error': message}), 400
+        flash(message, 'error')
+        return redirect(dashboard)
     if new_status:
         old_status = car.status
-        car.status = new_status
+        if not version_matches(car, request.form.get('version')):
+            return version_conflict(car.plate_number, dashboard)
         
-        if new_status == 'Completed' and not car.time_out:
-            car.time_out = datetime.utcnow()
-        
-        db.session.commit()
+        plate = car.plate_number
+        try:
+            car.set_status(new_status, changed_by=current_user)
+            db.session.commit()
+        except StaleDataError:
+            return version_conflict(plate, dashboard)
+        scheduler.track(car)
         flash(f'Status updated from "{old_status}" to "{new_status}"', 'success')
     
     if request.is_json:
@@ -535,9 +1018,28 @@ def update_status(car_id):
             'revenue': f'{revenue:,.0f}'
         })
     
-    if current_user.role == 'admin':
-        return redirect(url_for('admin_dashboard'))
-    return redirect(url_for('staff_dashboard'))
+    return redirect(dashboard)
+
+
+
+@app.route('/cars/eta/<int:car_id>')
+@login_required
+def car_eta(car_id):
+    """Estimated start/ready time for a job (JSON)"""
+    car = Car.query.get_or_404(car_id)
+    eta = scheduler.eta(car.id)
+    if eta is None:
+        return jsonify({'plate_number': car.plate_number, 'status': car.status, 'eta': None})
+    
+    return jsonify({
+        'plate_number': car.plate_number,
+        'status': car.status,
+        'eta': {
+            'starts_in_minutes': eta['starts_in'],
+            'ready_in_minutes': eta['ready_in'],
+            'ready_at': kenya_time(eta['ready_at']).strftime('%I:%M %p')
+        }
+    })
 
 
 
@@ -570,6 +1072,8 @@ def add_service():
             description=form.description.data,
             price=form.price.data,
             duration=form.duration.data,
+            # Owners can offer a service at every branch (no branch); otherwise it belongs to this branch
+            branch_id=None if current_user.is_owner and form.all_branches.data else g.branch_id,
             is_active=True
         )
         db.session.add(service)
@@ -588,9 +1092,19 @@ def add_service():
 def edit_service(service_id):
     """Edit an existing service"""
     service = Service.query.get_or_404(service_id)
+    if service.branch_id is None and not current_user.is_owner:
+        flash('Services offered at every branch can only be changed by an owner.', 'error')
+        return redirect(url_for('manage_services'))
     form = EditServiceForm()
     if form.validate_on_submit():
-        service.name = form.name.data.strip()
+        name = form.name.data.strip()
+        # Service names are unique across all branches (services all live in the main database)
+        with unscoped():
+            taken = Service.query.filter(Service.name == name, Service.id != service.id).first()
+        if taken:
+            flash('A service with this name already exists.', 'error')
+            return redirect(url_for('manage_services'))
+        service.name = name
         service.description = form.description.data
         service.price = form.price.data
         service.duration = form.duration.data
@@ -609,7 +1123,15 @@ def edit_service(service_id):
 def delete_service(service_id):
     """Delete a service"""
     service = Service.query.get_or_404(service_id)
-    if service.cars.count() > 0:
+    if service.branch_id is None and not current_user.is_owner:
+        flash('Services offered at every branch can only be deleted by an owner.', 'error')
+        return redirect(url_for('manage_services'))
+    # A shared service can be in use at any branch (each possibly in its own database)
+    in_use = False
+    for branch in all_branches() if service.branch_id is None else [get_branch(service.branch_id)]:
+        with branch_scope(branch):
+            in_use = in_use or Car.query.filter_by(service_id=service.id).count() > 0
+    if in_use:
         flash(f'Cannot delete "{service.name}" - it is currently assigned to jobs.', 'error')
         return redirect(url_for('manage_services'))
     service_name = service.name
@@ -646,13 +1168,14 @@ def manage_users():
 def view_profile():
     """View user's own profile"""
     form = UpdateProfileForm()
+    user = db.session.get(User, current_user.id)
     # Pre-fill form with current user data
-    form.full_name.data = current_user.full_name
-    form.email.data = current_user.email
-    if current_user.role == 'admin':
-        form.role.data = current_user.role
+    form.full_name.data = user.full_name
+    form.email.data = user.email
+    if user.role == 'admin':
+        form.role.data = user.role
     
-    return render_template('profile.html', form=form, user=current_user)
+    return render_template('profile.html', form=form, user=user)
 
 
 @app.route('/profile/update', methods=['POST'])
@@ -660,26 +1183,27 @@ def view_profile():
 def update_profile():
     """Update user's own profile"""
     form = UpdateProfileForm()
+    user = db.session.get(User, current_user.id)
     
     # Validate current password
-    if not current_user.check_password(form.current_password.data):
+    if not user.check_password(form.current_password.data):
         flash('Current password is incorrect.', 'error')
         return redirect(url_for('view_profile'))
     
     if form.validate_on_submit():
         # Update basic info
-        current_user.full_name = form.full_name.data
-        current_user.email = form.email.data.strip()
+        user.full_name = form.full_name.data
+        user.email = form.email.data.strip()
         
         # Update password if provided
         if form.new_password.data:
-            current_user.set_password(form.new_password.data)
+            user.set_password(form.new_password.data)
             flash('Password updated successfully!', 'success')
         
         # Admin can change their own role
-        old_role = current_user.role
-        if current_user.role == 'admin' and form.role.data:
-            current_user.role = form.role.data
+        old_role = user.role
+        if user.role == 'admin' and form.role.data:
+            user.role = form.role.data
             
             # If admin changed their own role, they need to logout
             if old_role != form.role.data:
@@ -713,6 +1237,8 @@ def add_user():
             email=form.email.data.strip(),
             phone_number=form.phone_number.data.strip(),
             role=form.role.data,
+            # Staff and branch admins work at the current branch; owners are admins without one
+            branch_id=None if current_user.is_owner and form.owner.data and form.role.data == 'admin' else g.branch_id,
             is_active=form.is_active.data
         )
         user.set_password(form.password.data)
@@ -732,6 +1258,9 @@ def add_user():
 def edit_user(user_id):
     """Edit an existing user"""
     user = User.query.get_or_404(user_id)
+    if user.is_owner and not current_user.is_owner:
+        flash('Only owners can change owner accounts.', 'error')
+        return redirect(url_for('manage_users'))
     form = EditUserForm()
     if form.validate_on_submit():
         user.username = form.username.data.strip()
@@ -760,6 +1289,9 @@ def delete_user(user_id):
     if user.id == current_user.id:
         flash('You cannot delete your own account!', 'error')
         return redirect(url_for('manage_users'))
+    if user.is_owner and not current_user.is_owner:
+        flash('Only owners can delete owner accounts.', 'error')
+        return redirect(url_for('manage_users'))
     if Car.query.filter_by(assigned_user_id=user.id).count() > 0:
         flash(f'Cannot delete "{user.username}" - they have jobs assigned.', 'error')
         return redirect(url_for('manage_users'))
@@ -778,6 +1310,7 @@ def delete_user(user_id):
 @app.route('/reports')
 @login_required
 @admin_required
+@read_replica
 def reports():
     """Reports and analytics page (Today's data)"""
     # Get today's date range in UTC
@@ -799,33 +1332,150 @@ def reports():
     
     daily_revenue = sum([job.service.price for job in completed_jobs_today])
     
-    # Staff performance for today
-    staff_performance = db.session.query(
-        User.full_name,
+    # Staff performance for today (counted on the jobs table, then named: the branch's jobs
+    # may live in a different database from users and services)
+    completed_by_staff = db.session.query(
+        Car.assigned_user_id,
         db.func.count(Car.id).label('jobs_completed')
-    ).join(Car, User.id == Car.assigned_user_id).filter(
-        User.role == 'staff',
+    ).filter(
         Car.status == 'Completed',
         Car.time_out != None,
         Car.time_out >= start_of_day_utc,
         Car.time_out <= end_of_day_utc
-    ).group_by(User.id, User.full_name).all()
+    ).group_by(Car.assigned_user_id).all()
+    staff_names = dict(db.session.query(User.id, User.full_name).filter(
+        User.id.in_([user_id for user_id, _ in completed_by_staff]),
+        User.role == 'staff'
+    ).all())
+    staff_performance = [(staff_names[user_id], jobs) for user_id, jobs in completed_by_staff
+                         if user_id in staff_names]
     
     # Popular services
-    popular_services = db.session.query(
-        Service.name,
+    bookings = db.session.query(
+        Car.service_id,
         db.func.count(Car.id).label('times_booked')
-    ).join(Car).filter(
+    ).filter(
         Car.status == 'Completed'
-    ).group_by(Service.id, Service.name).order_by(
+    ).group_by(Car.service_id).order_by(
         db.desc('times_booked')
     ).limit(5).all()
+    service_names = dict(db.session.query(Service.id, Service.name).filter(
+        Service.id.in_([service_id for service_id, _ in bookings])
+    ).all())
+    popular_services = [(service_names.get(service_id, 'Unknown'), times) for service_id, times in bookings]
     
-    return render_template('reports.html',
-                         daily_jobs=daily_jobs,
-                         daily_revenue=daily_revenue,
-                         staff_performance=staff_performance,
-                         popular_services=popular_services)
+    return stream_page('reports.html',
+                       daily_jobs=daily_jobs,
+                       daily_revenue=daily_revenue,
+                       staff_performance=staff_performance,
+                       popular_services=popular_services)
+
+
+
+# BRANCHES (owners)
+
+
+def today_metrics():
+    """Today's jobs in, jobs in progress, completed jobs and revenue for the current branch"""
+    start_of_day_utc, end_of_day_utc = get_today_start_end_utc()
+    jobs_in = Car.query.filter(Car.time_in >= start_of_day_utc, Car.time_in <= end_of_day_utc).count()
+    in_progress = Car.query.filter(Car.status != 'Completed').count()
+    # Count per service on the jobs table, priced from services (possibly another database)
+    completed = db.session.query(Car.service_id, db.func.count(Car.id)).filter(
+        Car.status == 'Completed',
+        Car.time_out >= start_of_day_utc,
+        Car.time_out <= end_of_day_utc
+    ).group_by(Car.service_id).all()
+    prices = dict(db.session.query(Service.id, Service.price).filter(
+        Service.id.in_([service_id for service_id, _ in completed])
+    ).all())
+    return {
+        'jobs_in': jobs_in,
+        'in_progress': in_progress,
+        'completed': sum(count for _, count in completed),
+        'revenue': sum(prices.get(service_id, 0) * count for service_id, count in completed)
+    }
+
+
+def branch_database_choices():
+    """Databases a new branch can keep its jobs in: the primary or one of BRANCH_DATABASE_URLS"""
+    return [('', 'Primary database')] + [(key, key) for key in sorted(app.config.get('SQLALCHEMY_BINDS') or {})]
+
+
+@app.route('/branches/switch', methods=['POST'])
+@login_required
+@owner_required
+def switch_branch():
+    """Owners pick the branch the other pages work on"""
+    branch = get_branch(request.form.get('branch_id', type=int))
+    if branch is None or not branch.is_active:
+        flash('Unknown branch.', 'error')
+    else:
+        session['branch_id'] = branch.id
+        flash(f'Now working in {branch.name}.', 'success')
+    next_url = request.form.get('next', '')
+    return redirect(next_url if next_url.startswith('/') and not next_url.startswith('//')
+                    else url_for('admin_dashboard'))
+
+
+@app.route('/admin/branches')
+@login_required
+@owner_required
+@read_replica
+def manage_branches():
+    """Every branch side by side: today's numbers and 30-day totals from each branch's rollups"""
+    since = (datetime.utcnow() + timedelta(hours=3)).date() - timedelta(days=29)
+    rows = []
+    for branch in all_branches():
+        if not branch.is_active:
+            continue
+        with branch_scope(branch):
+            rebuilding = not rollups_ready()
+            days = [] if rebuilding else distribution_stats('day', since=since)
+            rows.append({
+                'branch': branch,
+                'today': today_metrics(),
+                'rebuilding': rebuilding,
+                'jobs_30d': sum(day['jobs'] for day in days),
+                'revenue_30d': sum(day['revenue'] for day in days)
+            })
+    
+    totals = {key: sum(row['today'][key] for row in rows) for key in ('jobs_in', 'in_progress', 'completed', 'revenue')}
+    totals['jobs_30d'] = sum(row['jobs_30d'] for row in rows)
+    totals['revenue_30d'] = sum(row['revenue_30d'] for row in rows)
+    
+    form = AddBranchForm()
+    form.bind_key.choices = branch_database_choices()
+    return render_template('manage_branches.html', rows=rows, totals=totals, form=form)
+
+
+@app.route('/admin/branches/add', methods=['POST'])
+@login_required
+@owner_required
+def add_branch():
+    """Add a branch; a branch on its own database gets its job tables created there"""
+    form = AddBranchForm()
+    form.bind_key.choices = branch_database_choices()
+    if form.validate_on_submit():
+        branch = Branch(
+            name=form.name.data.strip(),
+            code=form.code.data.strip().lower(),
+            location=form.location.data,
+            bind_key=form.bind_key.data or None,
+            is_active=True
+        )
+        if branch.bind_key and not create_branch_tables(branch.bind_key):
+            flash(f'Database "{branch.bind_key}" is not available.', 'error')
+            return redirect(url_for('manage_branches'))
+        db.session.add(branch)
+        db.session.commit()
+        invalidate_branches()
+        flash(f'Branch "{branch.name}" added successfully!', 'success')
+    else:
+        for field, errors in form.errors.items():
+            for error in errors:
+                flash(f'{field}: {error}', 'error')
+    return redirect(url_for('manage_branches'))
 
 
 
@@ -0,0 +1,328 @@
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from app import db
+from app.models import Car, Service, User, ArchivedJob, JobStatusChange
+from app.branches import PerBranch, branch_scope, get_branch
+
+# Statuses that keep a staff member busy
+QUEUED_STATUSES = ('Waiting',)
+WORKING_STATUSES = ('Washing', 'Detailing')
+
+
+class StaffQueue:
+    """One staff member's waiting jobs (min-heap by arrival) and jobs in progress"""
+
+    def __init__(self):
+        self.waiting = []      # heap of (time_in, car_id), stale entries skipped lazily (a sorted list is a valid heap)
+        self.working = {}      # car_id -> started_at
+        self.load = 0.0        # expected minutes of all queued + working jobs
+
+
+class JobScheduler:
+    """
+    In-memory queue model per staff member
+    Updated incrementally from status changes; reloaded from the database in a background
+    thread every SCHEDULER_REFRESH_SECONDS so gunicorn workers converge on other workers' writes
+    """
+
+    def __init__(self, branch_id=None):
+        self.branch_id = branch_id
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._refreshing = False
+        self._journal = None       # changes made while a reload is reading the database, replayed onto it
+        self._reset()
+
+    def _reset(self):
+        self.jobs = {}             # car_id -> (staff_id, status, time_in, expected_minutes)
+        self.queues = {}           # staff_id -> StaffQueue
+        self.load_heap = []        # (load, staff_id), stale entries skipped lazily
+        self.expected_minutes = {} # service_id -> expected minutes of work
+
+    # LOADING
+
+    def _ensure_fresh(self):
+        if self._loaded_at is None:
+            self.rebuild()  # first use in this worker: nothing to answer from yet
+            return
+        refresh = current_app.config.get('SCHEDULER_REFRESH_SECONDS', 60)
+        if self._refreshing or time.monotonic() - self._loaded_at <= refresh:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self._journal = []
+        threading.Thread(target=self._refresh, args=(current_app._get_current_object(),),
+                         name='scheduler-refresh', daemon=True).start()
+
+    def _refresh(self, app):
+        """Reload off the request path; requests keep using the current model meanwhile"""
+        try:
+            with app.app_context():
+                with branch_scope(get_branch(self.branch_id)):
+                    self.rebuild()
+        except Exception as e:
+            print(f"[!] Scheduler refresh error: {str(e)}")
+            with self._lock:
+                self._journal = None
+                self._loaded_at = time.monotonic()  # try again after the next interval
+        finally:
+            self._refreshing = False
+
+    def rebuild(self):
+        """Reload expected durations, staff and active jobs from the database"""
+        fresh = JobScheduler(self.branch_id)
+        fresh._load()
+        with self._lock:
+            for args in self._journal or ():
+                fresh._track(*args)
+            self.jobs, self.queues = fresh.jobs, fresh.queues
+            self.load_heap, self.expected_minutes = fresh.load_heap, fresh.expected_minutes
+            self._journal = None
+            self._loaded_at = time.monotonic()
+
+    def _load(self):
+        self.expected_minutes = self._load_expected_minutes()
+
+        for (staff_id,) in db.session.query(User.id).filter_by(role='staff', is_active=True):
+            self._queue(staff_id)
+
+        # Work on a job started when it last moved into Washing/Detailing from another status
+        started = dict(db.session.query(
+            JobStatusChange.car_id, db.func.max(JobStatusChange.changed_at)
+        ).join(Car, Car.id == JobStatusChange.car_id).filter(
+            Car.status.in_(WORKING_STATUSES),
+            JobStatusChange.changed_at >= Car.time_in,
+            JobStatusChange.to_status.in_(WORKING_STATUSES),
+            db.or_(JobStatusChange.from_status == None, JobStatusChange.from_status.notin_(WORKING_STATUSES))
+        ).group_by(JobStatusChange.car_id).all())
+
+        active = db.session.query(
+            Car.id, Car.assigned_user_id, Car.status, Car.time_in, Car.service_id
+        ).filter(Car.status.in_(QUEUED_STATUSES + WORKING_STATUSES))
+        for car_id, staff_id, status, time_in, service_id in active:
+            self._add(car_id, staff_id, status, time_in, service_id, started.get(car_id))
+
+    def _load_expected_minutes(self):
+        """
+        Expected minutes of work per service
+        Historical average of washing + detailing time from the archive, falling back to
+        the whole job duration for jobs archived before stage tracking, then to Service.duration
+        """
+        min_samples = current_app.config.get('SCHEDULER_MIN_SAMPLES', 5)
+        work_minutes = db.case(
+            (ArchivedJob.washing_minutes != None,
+             ArchivedJob.washing_minutes + db.func.coalesce(ArchivedJob.detailing_minutes, 0)),
+            else_=ArchivedJob.duration_minutes
+        )
+        history = {
+            name: (avg, count) for name, avg, count in db.session.query(
+                ArchivedJob.service_name,
+                db.func.avg(work_minutes),
+                db.func.count(work_minutes)
+            ).group_by(ArchivedJob.service_name)
+        }
+
+        expected = {}
+        for service_id, name, duration in db.session.query(Service.id, Service.name, Service.duration):
+            avg, count = history.get(name, (None, 0))
+            expected[service_id] = float(avg) if avg is not None and count >= min_samples else float(duration)
+        return expected
+
+    # INCREMENTAL UPDATES (all O(log n))
+
+    def _queue(self, staff_id):
+        queue = self.queues.get(staff_id)
+        if queue is None:
+            queue = self.queues[staff_id] = StaffQueue()
+            heapq.heappush(self.load_heap, (0.0, staff_id))
+        return queue
+
+    def _set_load(self, staff_id, queue, delta):
+        queue.load = max(0.0, queue.load + delta)
+        heapq.heappush(self.load_heap, (queue.load, staff_id))
+
+    def _add(self, car_id, staff_id, status, time_in, service_id, started_at=None):
+        expected = self.expected_minutes.get(service_id, 30.0)
+        queue = self._queue(staff_id)
+        self.jobs[car_id] = (staff_id, status, time_in, expected)
+        if status in QUEUED_STATUSES:
+            heapq.heappush(queue.waiting, (time_in, car_id))
+        else:
+            # No status log (jobs from before it existed): assume work began on arrival
+            queue.working[car_id] = started_at or time_in
+        self._set_load(staff_id, queue, expected)
+
+    def _discard(self, car_id):
+        job = self.jobs.pop(car_id, None)
+        if job is None:
+            return
+        staff_id, status, _, expected = job
+        queue = self.queues[staff_id]
+        queue.working.pop(car_id, None)
+        self._set_load(staff_id, queue, -expected)
+
+        # Drop stale heap heads; anything deeper is cleared by the next rebuild
+        while queue.waiting and self._is_stale(queue.waiting[0]):
+            heapq.heappop(queue.waiting)
+
+    def _is_stale(self, entry):
+        time_in, car_id = entry
+        job = self.jobs.get(car_id)
+        return job is None or job[1] not in QUEUED_STATUSES or job[2] != time_in
+
+    def track(self, car):
+        """Record a job's current status/assignment after it was added or changed"""
+        self._ensure_fresh()
+        with self._lock:
+            args = (car.id, car.assigned_user_id, car.status, car.time_in, car.service_id, datetime.utcnow())
+            if self._journal is not None:
+                self._journal.append(args)
+            self._track(*args)
+
+    def _track(self, car_id, staff_id, status, time_in, service_id, now):
+        current = self.jobs.get(car_id)
+        if current and current[0] == staff_id and current[1] == status:
+            return
+        # Washing -> Detailing is the same stretch of work: keep when it started
+        started_at = now
+        if current and current[1] in WORKING_STATUSES:
+            started_at = self.queues[current[0]].working.get(car_id, now)
+        # Waiting -> Washing keeps the job's load, it just moves to the working set
+        self._discard(car_id)
+        if status in QUEUED_STATUSES + WORKING_STATUSES:
+            self._add(car_id, staff_id, status, time_in, service_id, started_at)
+
+    def remove(self, car_id):
+        """Forget a deleted or archived job"""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((car_id, None, None, None, None, None))  # no status: replays as a removal
+            self._discard(car_id)
+
+    # QUERIES
+
+    def suggest_staff(self, candidate_ids):
+        """
+        Least-loaded staff member among `candidate_ids` (e.g. active staff for the intake form)
+
+        Returns:
+            Staff user id, or None if there are no candidates
+        """
+        self._ensure_fresh()
+        candidates = set(candidate_ids)
+        if not candidates:
+            return None
+
+        with self._lock:
+            # Staff the scheduler hasn't seen yet have nothing assigned
+            for staff_id in candidates:
+                if staff_id not in self.queues:
+                    return staff_id
+
+            while self.load_heap:
+                load, staff_id = self.load_heap[0]
+                if self.queues[staff_id].load != load:
+                    heapq.heappop(self.load_heap)
+                    continue
+                if staff_id in candidates:
+                    return staff_id
+                break
+
+            return min(candidates, key=lambda staff_id: self.queues[staff_id].load)
+
+    def plan_assignments(self, candidate_ids, service_ids):
+        """
+        Least-loaded staff member for each of several new jobs, in order
+        Each pick adds that job's expected minutes before the next one, so a batch spreads out
+
+        Returns:
+            List of staff user ids (empty if there are no candidates)
+        """
+        self._ensure_fresh()
+        if not candidate_ids:
+            return []
+
+        with self._lock:
+            heap = [(self.queues[staff_id].load if staff_id in self.queues else 0.0, staff_id)
+                    for staff_id in set(candidate_ids)]
+        heapq.heapify(heap)
+
+        assignments = []
+        for service_id in service_ids:
+            load, staff_id = heapq.heappop(heap)
+            assignments.append(staff_id)
+            heapq.heappush(heap, (load + self.expected_minutes.get(service_id, 30.0), staff_id))
+        return assignments
+
+    def eta(self, car_id, now=None):
+        """
+        Estimated start and ready times for an active job
+
+        Returns:
+            Dictionary with starts_in / ready_in (minutes) and ready_at (UTC), or None if not queued
+        """
+        self._ensure_fresh()
+        now = now or datetime.utcnow()
+
+        with self._lock:
+            job = self.jobs.get(car_id)
+            if job is None:
+                return None
+            return self._queue_etas(self.queues[job[0]], now).get(car_id)
+
+    def etas(self, now=None):
+        """
+        ETAs of every active job (see eta()), one pass over each staff queue
+        Use this when rendering a list of jobs rather than calling eta() per job
+
+        Returns:
+            Dictionary of car_id -> ETA
+        """
+        self._ensure_fresh()
+        now = now or datetime.utcnow()
+
+        result = {}
+        with self._lock:
+            for queue in self.queues.values():
+                result.update(self._queue_etas(queue, now))
+        return result
+
+    def _queue_etas(self, queue, now):
+        """ETAs of one staff member's jobs: remaining work in progress, then waiting jobs by arrival"""
+        etas = {}
+        busy = 0.0
+        for working_id, started_at in queue.working.items():
+            elapsed = (now - started_at).total_seconds() / 60
+            remaining = max(0.0, self.jobs[working_id][3] - elapsed)
+            etas[working_id] = self._eta_result(now, 0.0, remaining)
+            busy += remaining
+
+        # Sorting also drops stale and duplicate entries; the sorted list is kept as the heap
+        live = []
+        for entry in sorted(queue.waiting):
+            if entry[1] in etas or self._is_stale(entry):
+                continue
+            expected = self.jobs[entry[1]][3]
+            etas[entry[1]] = self._eta_result(now, busy, expected)
+            busy += expected
+            live.append(entry)
+        queue.waiting = live
+        return etas
+
+    @staticmethod
+    def _eta_result(now, starts_in, work):
+        ready_in = starts_in + work
+        return {
+            'starts_in': int(round(starts_in)),
+            'ready_in': int(round(ready_in)),
+            'ready_at': now + timedelta(minutes=ready_in)
+        }
+
+
+# One queue model per branch (queries inside it are scoped to the request's branch)
+scheduler = PerBranch(JobScheduler)
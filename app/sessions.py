@@ -0,0 +1,294 @@
+"""
+Spot - Server-side sessions
+The session cookie only carries a random id; the session data lives in a store picked by
+SESSION_BACKEND: 'database' (the app database, shared by every host; the default with
+DATABASE_URL), 'sqlite' (a local file shared by the workers on one host, for development)
+or 'cookie' (Flask's signed cookie, no store).
+Stored sessions cache the signed-in user's principal (id, names, role, branch, active flag),
+so requests don't read the users table. Changing a user bumps User.session_version and
+marks their sessions stale; deactivating or deleting a user deletes their sessions.
+"""
+
+import hashlib
+import random
+import secrets
+import time
+import sqlalchemy as sa
+from flask import current_app, has_app_context, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from flask_login import UserMixin, user_logged_in, user_logged_out
+from app import db
+from app.models import ServerSession, User
+from app.replica import RoutingSession
+
+PRINCIPAL_KEY = '_principal'
+# User columns a principal is built from; changing any of them (or the password) bumps session_version
+PRINCIPAL_ATTRS = ('username', 'full_name', 'role', 'branch_id', 'is_active')
+CLEANUP_PROBABILITY = 0.01  # share of new sessions that also purge expired ones
+
+serializer = TaggedJSONSerializer()
+
+
+class Principal(UserMixin):
+    """The signed-in user as cached in the session: enough for templates, decorators and scoping"""
+
+    def __init__(self, id, username, full_name, role, branch_id, active, version):
+        self.id = id
+        self.username = username
+        self.full_name = full_name
+        self.role = role
+        self.branch_id = branch_id
+        self.active = active
+        self.version = version
+
+    @property
+    def is_active(self):
+        return self.active
+
+    @property
+    def is_owner(self):
+        return self.role == 'admin' and self.branch_id is None
+
+    def to_dict(self):
+        return {'id': self.id, 'username': self.username, 'full_name': self.full_name, 'role': self.role,
+                'branch_id': self.branch_id, 'active': self.active, 'version': self.version}
+
+    def __repr__(self):
+        return f'<Principal {self.username}>'
+
+
+def _principal_row(user_id):
+    """The principal's columns only (no password hash), across all branches"""
+    from app.branches import unscoped
+    with unscoped():
+        row = db.session.execute(sa.select(
+            User.id, User.username, User.full_name, User.role, User.branch_id, User.is_active, User.session_version
+        ).where(User.id == user_id)).first()
+    return Principal(*row) if row is not None else None
+
+
+def load_principal(user_id):
+    """
+    Flask-Login user loader: the principal cached in the server-side session, or one
+    lean users query (cached for the next requests) when there is none or it went stale
+    """
+    store = get_store()
+    cached = session.get(PRINCIPAL_KEY) if store is not None else None
+    if cached is not None and cached.get('id') == user_id:
+        return Principal(**cached)
+
+    principal = _principal_row(user_id)
+    if principal is not None and store is not None:
+        session[PRINCIPAL_KEY] = principal.to_dict()
+    return principal
+
+
+# STORE
+
+
+def _key(sid):
+    return hashlib.sha256(sid.encode()).hexdigest()
+
+
+class SessionStore:
+    """Session records in the server_sessions table of `engine` (the app database or a local SQLite file)"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = ServerSession.__table__
+
+    def load(self, key, now):
+        with self.engine.connect() as connection:
+            return connection.execute(sa.select(self.table).where(
+                self.table.c.key == key, self.table.c.expires_at > now)).first()
+
+    def insert(self, key, user_id, user_version, data, expires_at):
+        with self.engine.begin() as connection:
+            connection.execute(sa.insert(self.table).values(
+                key=key, user_id=user_id, user_version=user_version, data=data, expires_at=expires_at))
+
+    def update(self, key, data, expires_at):
+        """Returns False if the session is gone (logged out elsewhere, user deactivated)"""
+        with self.engine.begin() as connection:
+            return connection.execute(sa.update(self.table).where(self.table.c.key == key).values(
+                data=data, expires_at=expires_at)).rowcount > 0
+
+    def delete(self, key):
+        with self.engine.begin() as connection:
+            connection.execute(sa.delete(self.table).where(self.table.c.key == key))
+
+    def invalidate_user(self, user_id, version=None):
+        """Mark a user's sessions stale at `version`, or delete them all (version None)"""
+        with self.engine.begin() as connection:
+            if version is None:
+                connection.execute(sa.delete(self.table).where(self.table.c.user_id == user_id))
+            else:
+                connection.execute(sa.update(self.table).where(self.table.c.user_id == user_id).values(
+                    user_version=version))
+
+    def cleanup(self, now):
+        with self.engine.begin() as connection:
+            connection.execute(sa.delete(self.table).where(self.table.c.expires_at <= now))
+
+
+def _local_engine(path):
+    """SQLite file for the 'sqlite' backend; WAL so workers read while another writes"""
+    engine = sa.create_engine(f'sqlite:///{path}', connect_args={'timeout': 10})
+
+    @sa.event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    ServerSession.__table__.create(engine, checkfirst=True)
+    return engine
+
+
+def get_store():
+    """SessionStore of the current app, or None with the cookie backend"""
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('session_store')
+
+
+# SESSION INTERFACE
+
+
+class StoredSession(SecureCookieSession):
+    """Session dict that remembers its id and the user it was opened for"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.opened_user_id = self.get('_user_id')
+        self.accessed = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps session data in a SessionStore; the cookie holds only the random session id"""
+
+    def __init__(self, store, touch_seconds):
+        self.store = store
+        self.touch_seconds = touch_seconds
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            record = self.store.load(_key(sid), time.time())
+            if record is not None:
+                stored = StoredSession(serializer.loads(record.data), sid=sid, expires_at=record.expires_at)
+                principal = stored.get(PRINCIPAL_KEY)
+                if principal is not None and principal.get('version') != record.user_version:
+                    del stored[PRINCIPAL_KEY]  # the user changed since it was cached
+                stored.accessed = False
+                return stored
+        return StoredSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.sid is not None:
+                self.store.delete(_key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        user_id = session.get('_user_id')
+        data = serializer.dumps(dict(session))
+        if session.sid is None or user_id != session.opened_user_id:
+            # New session, or signed in as someone else: a fresh id, so an id planted
+            # before login (session fixation) is worthless afterwards
+            if session.sid is not None:
+                self.store.delete(_key(session.sid))
+            session.sid = secrets.token_urlsafe(32)
+            principal = session.get(PRINCIPAL_KEY)
+            self.store.insert(_key(session.sid), int(user_id) if user_id else None,
+                              principal['version'] if principal else 0, data, now + lifetime)
+            if random.random() < CLEANUP_PROBABILITY:
+                self.store.cleanup(now)
+        elif session.modified or session.expires_at - now < lifetime - self.touch_seconds:
+            if not self.store.update(_key(session.sid), data, now + lifetime):
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+                return
+        else:
+            return
+
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=httponly, domain=domain, path=path, secure=secure, samesite=samesite)
+
+
+# INVALIDATION
+
+
+@sa.event.listens_for(User, 'before_update')
+def _bump_session_version(mapper, connection, target):
+    state = sa.inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in PRINCIPAL_ATTRS + ('password_hash',)):
+        target.session_version = (target.session_version or 1) + 1
+        # Deactivated users are signed out everywhere; anyone else just gets a fresh principal
+        version = target.session_version if target.is_active else None
+        sa.orm.object_session(target).info.setdefault('changed_users', {})[target.id] = version
+
+
+@sa.event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    sa.orm.object_session(target).info.setdefault('changed_users', {})[target.id] = None
+
+
+@sa.event.listens_for(RoutingSession, 'after_commit')
+def _invalidate_sessions(db_session):
+    changed = db_session.info.pop('changed_users', None)
+    store = get_store()
+    if changed and store is not None:
+        for user_id, version in changed.items():
+            store.invalidate_user(user_id, version)
+
+
+@sa.event.listens_for(RoutingSession, 'after_rollback')
+def _discard_changes(db_session):
+    db_session.info.pop('changed_users', None)
+
+
+def _cache_principal(app, user):
+    if get_store() is not None:
+        session[PRINCIPAL_KEY] = Principal(user.id, user.username, user.full_name, user.role, user.branch_id,
+                                           user.is_active, user.session_version).to_dict()
+
+
+def _forget_principal(app, user):
+    session.pop(PRINCIPAL_KEY, None)
+
+
+def init_sessions(app):
+    """Install the server-side session interface for SESSION_BACKEND ('cookie' keeps Flask's default)"""
+    backend = app.config.get('SESSION_BACKEND', 'database')
+    if backend == 'cookie':
+        return
+    if backend == 'sqlite':
+        engine = _local_engine(app.config['SESSION_SQLITE_PATH'])
+    elif backend == 'database':
+        engine = db.engine
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND '{backend}' (use 'sqlite', 'database' or 'cookie')")
+
+    store = SessionStore(engine)
+    app.extensions['session_store'] = store
+    app.session_interface = ServerSessionInterface(store, app.config.get('SESSION_TOUCH_SECONDS', 300))
+    user_logged_in.connect(_cache_principal, app)
+    user_logged_out.connect(_forget_principal, app)
+    print(f"[OK] Server-side sessions ({backend})")
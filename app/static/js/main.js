@@ -157,7 +157,7 @@ document.addEventListener('DOMContentLoaded', function () {
 // ===============================
 // Dynamic status update with confirmation
 // ===============================
-function updateStatus(carId, newStatus) {
+function updateStatus(carId, newStatus, version) {
     const message = `Are you sure you want to change status to "${newStatus}"?`;
 
     if (confirm(message)) {
@@ -171,6 +171,15 @@ function updateStatus(carId, newStatus) {
         statusInput.value = newStatus;
         form.appendChild(statusInput);
 
+        // Version the page was rendered with, so a concurrent change is reported instead of overwritten
+        if (version !== undefined) {
+            const versionInput = document.createElement('input');
+            versionInput.type = 'hidden';
+            versionInput.name = 'version';
+            versionInput.value = version;
+            form.appendChild(versionInput);
+        }
+
         const csrfToken = document.querySelector('input[name="csrf_token"]');
         if (csrfToken) {
             form.appendChild(csrfToken.cloneNode());
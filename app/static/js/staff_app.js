@@ -0,0 +1,349 @@
+// ===============================
+// Staff app: offline job list with delta sync
+// The job list is kept in localStorage and refreshed from /staff/sync with only the rows
+// changed since the last watermark. Status changes made offline are queued and sent as one
+// batch (with an Idempotency-Key, so a retried upload is applied once); the server settles
+// conflicts and returns each job's current row.
+// ===============================
+(function () {
+    const root = document.getElementById('staff-app');
+    if (!root) {
+        return;
+    }
+
+    const STATUSES = ['Waiting', 'Washing', 'Detailing', 'Ready for Pickup', 'Completed'];
+    const POLL_INTERVAL = 10000; // 10 seconds
+    const STORE_KEY = `spot.staff.${root.dataset.user}.jobs`;
+    const QUEUE_KEY = `spot.staff.${root.dataset.user}.queue`;
+    const syncUrl = root.dataset.syncUrl;
+
+    function load(key, fallback) {
+        try {
+            return JSON.parse(localStorage.getItem(key)) || fallback;
+        } catch (e) {
+            return fallback;
+        }
+    }
+
+    // store: last synced server state; queue: changes not yet confirmed by the server
+    let store = load(STORE_KEY, { watermark: null, jobs: {}, etas: {}, syncedAt: null });
+    let queue = load(QUEUE_KEY, { inflight: null, pending: [] });
+    let syncing = false;
+
+    function save() {
+        localStorage.setItem(STORE_KEY, JSON.stringify(store));
+        localStorage.setItem(QUEUE_KEY, JSON.stringify(queue));
+    }
+
+    function newKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+
+    function queuedChanges() {
+        return (queue.inflight ? queue.inflight.changes : []).concat(queue.pending);
+    }
+
+    function lastChange(carId) {
+        const changes = queuedChanges().filter(change => change.car_id === carId);
+        return changes.length ? changes[changes.length - 1] : null;
+    }
+
+    // ===============================
+    // Rendering
+    // ===============================
+    function formatTime(iso) {
+        if (!iso) {
+            return '-';
+        }
+        return new Date(iso).toLocaleTimeString('en-KE', {
+            hour: '2-digit', minute: '2-digit', hour12: true, timeZone: 'Africa/Nairobi'
+        });
+    }
+
+    function cell(row, text, strong) {
+        const td = document.createElement('td');
+        if (strong) {
+            const b = document.createElement('strong');
+            b.textContent = text;
+            td.appendChild(b);
+        } else {
+            td.textContent = text;
+        }
+        row.appendChild(td);
+        return td;
+    }
+
+    function statusBadge(td, status, pending) {
+        const badge = document.createElement('span');
+        badge.className = 'badge badge-' + status.toLowerCase().replace(/ /g, '-');
+        badge.textContent = status;
+        td.appendChild(badge);
+        if (pending) {
+            const note = document.createElement('small');
+            note.textContent = ' not synced';
+            note.style.color = 'var(--text-light)';
+            td.appendChild(note);
+        }
+    }
+
+    function statusControl(td, job, status) {
+        const select = document.createElement('select');
+        select.className = 'form-control';
+        select.style.width = 'auto';
+        select.style.minWidth = '150px';
+        const prompt = new Option('Update status...', '', true, true);
+        prompt.disabled = true;
+        select.add(prompt);
+        STATUSES.forEach(function (name) {
+            const option = new Option(name, name);
+            option.disabled = name === status;
+            select.add(option);
+        });
+
+        const button = document.createElement('button');
+        button.type = 'button';
+        button.className = 'btn btn-sm btn-primary';
+        button.textContent = 'Update';
+        button.addEventListener('click', function () {
+            if (select.value) {
+                queueChange(job, select.value);
+            }
+        });
+
+        td.style.display = 'flex';
+        td.style.gap = '8px';
+        td.style.alignItems = 'center';
+        td.appendChild(select);
+        td.appendChild(button);
+    }
+
+    function render() {
+        const assigned = [];
+        const completed = [];
+        Object.values(store.jobs).forEach(function (job) {
+            const change = lastChange(job.id);
+            const view = Object.assign({}, job, {
+                status: change ? change.status : job.status,
+                time_out: job.time_out || (change && change.status === 'Completed' ? change.changed_at : null),
+                pending: Boolean(change)
+            });
+            (view.status === 'Completed' ? completed : assigned).push(view);
+        });
+        assigned.sort((a, b) => b.time_in.localeCompare(a.time_in));
+        completed.sort((a, b) => (b.time_out || '').localeCompare(a.time_out || ''));
+
+        const assignedBody = document.getElementById('assigned-jobs');
+        assignedBody.replaceChildren();
+        assigned.forEach(function (job) {
+            const row = document.createElement('tr');
+            cell(row, job.plate_number, true);
+            cell(row, job.customer_name);
+            cell(row, job.customer_phone);
+            cell(row, job.service_name);
+            statusBadge(cell(row, ''), job.status, job.pending);
+            cell(row, formatTime(job.time_in));
+            cell(row, job.pending ? '-' : formatTime(store.etas[job.id]));
+            statusControl(cell(row, ''), store.jobs[job.id], job.status);
+            assignedBody.appendChild(row);
+        });
+
+        const completedBody = document.getElementById('completed-jobs');
+        completedBody.replaceChildren();
+        completed.forEach(function (job) {
+            const row = document.createElement('tr');
+            cell(row, job.plate_number, true);
+            cell(row, job.customer_name);
+            cell(row, job.service_name);
+            cell(row, formatTime(job.time_in));
+            cell(row, formatTime(job.time_out));
+            const minutes = job.time_out ? Math.floor((new Date(job.time_out) - new Date(job.time_in)) / 60000) : null;
+            cell(row, minutes === null ? '-' : `${minutes} mins`);
+            completedBody.appendChild(row);
+        });
+
+        document.getElementById('assigned-empty').hidden = assigned.length > 0;
+        document.getElementById('completed-empty').hidden = completed.length > 0;
+        document.getElementById('stat-assigned').textContent = assigned.length;
+        document.getElementById('stat-in-progress').textContent =
+            assigned.filter(job => job.status === 'Washing' || job.status === 'Detailing').length;
+        document.getElementById('stat-completed').textContent = completed.length;
+    }
+
+    function setState(text) {
+        document.getElementById('sync-state').textContent = text;
+    }
+
+    function showNotice(message) {
+        const container = document.querySelector('.flash-container') || (function () {
+            const div = document.createElement('div');
+            div.className = 'flash-container';
+            document.body.appendChild(div);
+            return div;
+        })();
+        const flash = document.createElement('div');
+        flash.className = 'flash-message flash-warning';
+        flash.textContent = message;
+        container.appendChild(flash);
+        setTimeout(() => flash.remove(), 8000);
+    }
+
+    // ===============================
+    // Sync
+    // ===============================
+    function queueChange(job, status) {
+        // Each queued change expects the version the previous one will produce
+        const previous = lastChange(job.id);
+        queue.pending.push({
+            op_id: newKey(),
+            car_id: job.id,
+            status: status,
+            version: previous ? previous.version + 1 : job.version,
+            changed_at: new Date().toISOString()
+        });
+        save();
+        render();
+        sync();
+    }
+
+    function keep(job) {
+        const current = store.jobs[job.id];
+        if (!current || job.version >= current.version) {
+            store.jobs[job.id] = job;
+        }
+    }
+
+    function applyDelta(payload) {
+        if (payload.full) {
+            store.jobs = {};
+        }
+        payload.jobs.forEach(keep);
+        payload.results.forEach(function (result) {
+            if (result.job) {
+                keep(result.job);
+            }
+            if (result.message) {
+                showNotice(result.message);
+            }
+        });
+
+        // Anything the server no longer lists was archived, deleted or reassigned
+        const visible = new Set(payload.ids);
+        Object.keys(store.jobs).forEach(function (id) {
+            if (!visible.has(Number(id))) {
+                delete store.jobs[id];
+            }
+        });
+        store.etas = payload.etas;
+        store.watermark = payload.watermark;
+        store.syncedAt = Date.now();
+    }
+
+    function describeState(prefix) {
+        const count = queuedChanges().length;
+        const queued = count ? ` - ${count} change${count === 1 ? '' : 's'} waiting to sync` : '';
+        const synced = store.syncedAt ? ` - last synced ${new Date(store.syncedAt).toLocaleTimeString()}` : '';
+        setState(prefix + synced + queued);
+    }
+
+    async function sync() {
+        if (syncing) {
+            return;
+        }
+        syncing = true;
+        try {
+            if (!queue.inflight && queue.pending.length) {
+                queue.inflight = { key: newKey(), since: store.watermark, changes: queue.pending };
+                queue.pending = [];
+                save();
+            }
+
+            let response;
+            if (queue.inflight) {
+                response = await fetch(syncUrl, {
+                    method: 'POST',
+                    credentials: 'same-origin',
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'Accept': 'application/json',
+                        'Idempotency-Key': queue.inflight.key
+                    },
+                    body: JSON.stringify({ since: queue.inflight.since, changes: queue.inflight.changes })
+                });
+            } else {
+                const since = store.watermark ? '?since=' + encodeURIComponent(store.watermark) : '';
+                response = await fetch(syncUrl + since, {
+                    credentials: 'same-origin',
+                    headers: { 'Accept': 'application/json' }
+                });
+            }
+
+            if (response.redirected || response.status === 401) {
+                describeState('Signed out - log in again to sync');
+                return;
+            }
+            if (response.status === 422 && queue.inflight) {
+                queue.inflight.key = newKey(); // key clash; resend the batch under a fresh key
+                save();
+            }
+            if (!response.ok) {
+                describeState(`Sync failed (${response.status}), retrying`);
+                return;
+            }
+
+            const payload = await response.json();
+            queue.inflight = null;
+            applyDelta(payload);
+            save();
+            render();
+            describeState('Online');
+        } catch (e) {
+            describeState('Offline');
+        } finally {
+            syncing = false;
+        }
+
+        if (queue.pending.length && navigator.onLine) {
+            setTimeout(sync, 0);
+        }
+    }
+
+    // ===============================
+    // Start
+    // ===============================
+    render();
+    describeState(navigator.onLine ? 'Connecting' : 'Offline');
+    sync();
+
+    setInterval(function () {
+        if (!document.hidden) {
+            sync();
+        }
+    }, POLL_INTERVAL);
+    window.addEventListener('online', sync);
+    window.addEventListener('offline', () => describeState('Offline'));
+    document.addEventListener('visibilitychange', function () {
+        if (!document.hidden) {
+            sync();
+        }
+    });
+    document.getElementById('sync-now').addEventListener('click', sync);
+
+    // Logging out clears this device's copy, including changes that never reached the server
+    document.querySelectorAll('a[href$="/logout"]').forEach(function (link) {
+        link.addEventListener('click', function (e) {
+            const count = queuedChanges().length;
+            if (count && !confirm(`${count} status change(s) have not synced yet and will be lost. Log out anyway?`)) {
+                e.preventDefault();
+            }
+        });
+    });
+
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register(root.dataset.swUrl, { scope: '/staff/' }).catch(function (e) {
+            console.log('Offline mode unavailable:', e);
+        });
+    }
+})();
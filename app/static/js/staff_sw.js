@@ -0,0 +1,84 @@
+// ===============================
+// Staff app service worker (served as /staff/sw.js, scope /staff/)
+// Caches the /staff/app shell and its static assets so the job list opens offline.
+// Job data lives in localStorage (staff_app.js); /staff/sync always goes to the network.
+// ===============================
+const CACHE_NAME = 'spot-staff-v1';
+const SHELL_URL = '/staff/app';
+const ASSET_PATTERN = /(?:href|src)="(\/static\/[^"]+)"/g;
+
+async function cacheShell(response) {
+    // A redirect means the session expired (login page): never cache that as the shell
+    if (!response.ok || response.redirected) {
+        return;
+    }
+    const cache = await caches.open(CACHE_NAME);
+    const html = await response.clone().text();
+    await cache.put(SHELL_URL, response);
+
+    const assets = Array.from(html.matchAll(ASSET_PATTERN), match => match[1]);
+    await Promise.all(assets.map(url =>
+        cache.match(url).then(hit => hit || cache.add(url)).catch(() => null)
+    ));
+}
+
+self.addEventListener('install', function (event) {
+    event.waitUntil(
+        fetch(SHELL_URL, { credentials: 'same-origin' })
+            .then(cacheShell)
+            .catch(() => null)
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', function (event) {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names.filter(name => name !== CACHE_NAME).map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', function (event) {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET' || url.origin !== self.location.origin) {
+        return;
+    }
+
+    // App shell: network first (fresh nav bar, session check), cached copy when offline
+    if (url.pathname === SHELL_URL && request.mode === 'navigate') {
+        event.respondWith(
+            fetch(request)
+                .then(response => {
+                    event.waitUntil(cacheShell(response.clone()));
+                    return response;
+                })
+                .catch(() => caches.match(SHELL_URL))
+        );
+        return;
+    }
+
+    if (url.pathname.startsWith('/static/')) {
+        event.respondWith(caches.open(CACHE_NAME).then(cache =>
+            cache.match(request).then(hit => {
+                // Fingerprinted files never change: serve them from cache without revalidating
+                if (hit && url.pathname.startsWith('/static/dist/')) {
+                    return hit;
+                }
+                // Anything else: cached copy now, refreshed in the background
+                const network = fetch(request).then(response => {
+                    if (response.ok) {
+                        cache.put(request, response.clone());
+                    }
+                    return response;
+                });
+                if (hit) {
+                    event.waitUntil(network.catch(() => null));
+                    return hit;
+                }
+                return network;
+            })
+        ));
+    }
+});
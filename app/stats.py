@@ -0,0 +1,389 @@
+import json
+import math
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+import numpy as np
+from flask import g, has_app_context
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models import ArchivedJob, DailyRollup, ColdArchiveFile
+
+QUANTILES = (0.5, 0.9, 0.99)
+# Days per IN (...) when locking rollup rows: stays well under the bound-parameter limits
+# (65,535 on Postgres, 32,766 on SQLite) however many days one archive batch touches
+ROLLUP_CHUNK_SIZE = 1000
+# Archived job columns the rollups are built from
+ROLLUP_COLUMNS = ('id', 'branch_id', 'time_in', 'service_name', 'staff_name', 'service_price',
+                  'duration_minutes') + tuple(ArchivedJob.STAGE_COLUMNS.values())
+# Merged results kept per worker (see _cached)
+STATS_CACHE_SIZE = 64
+
+# Rollup dimension -> how to get its key from an archived job
+DIMENSIONS = {
+    'service': lambda job: job.service_name or 'Unknown',
+    'staff': lambda job: job.staff_name or 'Unassigned',
+    'day': lambda job: 'all',
+}
+
+
+class DDSketch:
+    """
+    Mergeable quantile sketch with relative accuracy `alpha`
+    Values fall into log-spaced buckets; merging two sketches just adds bucket counts
+    """
+
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = defaultdict(int)
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add_many(self, values):
+        """Add an array of non-negative values (vectorized)"""
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        positive = values[values > 0]
+        self.zero_count += int(len(values) - len(positive))
+        self.count += int(len(values))
+        if len(values):
+            self.total += float(values.sum())
+            self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+        if len(positive):
+            indexes, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64),
+                                        return_counts=True)
+            for index, count in zip(indexes.tolist(), counts.tolist()):
+                self.buckets[index] += count
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] += count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        if other.max is not None:
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'a': self.alpha, 'z': self.zero_count, 'b': self.buckets, 's': self.total, 'm': self.max}
+
+    @classmethod
+    def from_dict(cls, raw):
+        if not raw:
+            return cls()
+        sketch = cls(raw['a'])
+        sketch.zero_count = raw['z']
+        sketch.buckets.update({int(index): count for index, count in raw['b'].items()})
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        # Sketches stored before the sum and maximum were tracked lack them
+        sketch.total = raw.get('s', 0.0)
+        sketch.max = raw.get('m')
+        return sketch
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_dict(json.loads(data) if data else None)
+
+
+def kenya_day(dt):
+    return (dt + timedelta(hours=3)).date()
+
+
+def _insert(dialect_name):
+    return (postgresql if dialect_name == 'postgresql' else sqlite).insert(DailyRollup)
+
+
+def record_archived_jobs(jobs):
+    """
+    Fold newly archived jobs into their branch's daily rollups (caller commits)
+    Missing rollup rows are created first (ON CONFLICT DO NOTHING, as a concurrent archive run
+    may create the same ones), then every affected row is read with a row lock, so concurrent
+    runs wait for each other instead of overwriting each other's totals. On SQLite the insert
+    already holds the database's write lock for the rest of the transaction.
+    The 'day' rows also carry a sketch of the minutes spent in each stage (see stage_stats).
+    """
+    groups = defaultdict(list)
+    for job in jobs:
+        if job.time_in is None:
+            continue
+        day = kenya_day(job.time_in)
+        for dimension, key_for in DIMENSIONS.items():
+            groups[(job.branch_id, day, dimension, key_for(job))].append(job)
+    if not groups:
+        return
+
+    dialect_name = db.session.get_bind(mapper=DailyRollup.__mapper__).dialect.name
+    keys = list(groups)
+    # executemany: one cached statement, sent in driver-sized batches whatever the group count
+    db.session.execute(
+        _insert(dialect_name).on_conflict_do_nothing(index_elements=['branch_id', 'dimension', 'day', 'key']),
+        [{'branch_id': branch_id, 'day': day, 'dimension': dimension, 'key': key,
+          'jobs': 0, 'revenue': 0.0, 'duration_sum': 0,
+          'stage_sketches': '{}' if dimension == 'day' else None}
+         for branch_id, day, dimension, key in keys]
+    )
+
+    existing = {}
+    days = sorted({day for _, day, _, _ in keys})
+    for offset in range(0, len(days), ROLLUP_CHUNK_SIZE):
+        existing.update(
+            ((rollup.branch_id, rollup.day, rollup.dimension, rollup.key), rollup)
+            for rollup in DailyRollup.query.filter(
+                DailyRollup.day.in_(days[offset:offset + ROLLUP_CHUNK_SIZE])
+            ).populate_existing().with_for_update()
+        )
+
+    for group_key, group_jobs in groups.items():
+        rollup = existing[group_key]
+
+        durations = [job.duration_minutes for job in group_jobs if job.duration_minutes is not None]
+        prices = [job.service_price or 0.0 for job in group_jobs]
+
+        duration_sketch = DDSketch.from_json(rollup.duration_sketch)
+        duration_sketch.add_many(durations)
+        revenue_sketch = DDSketch.from_json(rollup.revenue_sketch)
+        revenue_sketch.add_many(prices)
+
+        rollup.jobs += len(group_jobs)
+        rollup.revenue += sum(prices)
+        rollup.duration_sum += sum(durations)
+        rollup.duration_sketch = duration_sketch.to_json()
+        rollup.revenue_sketch = revenue_sketch.to_json()
+
+        if rollup.dimension == 'day':
+            stages = json.loads(rollup.stage_sketches or '{}')
+            for stage, column in ArchivedJob.STAGE_COLUMNS.items():
+                minutes = [getattr(job, column) for job in group_jobs if getattr(job, column) is not None]
+                if minutes:
+                    sketch = DDSketch.from_dict(stages.get(stage))
+                    sketch.add_many(minutes)
+                    stages[stage] = sketch.to_dict()
+            rollup.stage_sketches = json.dumps(stages, separators=(',', ':'))
+
+
+def rebuild_daily_rollups(progress=None, batch_size=10000):
+    """
+    Recompute all daily rollups from the archive: hot rows (only the columns rollups need,
+    a batch per transaction) and then the cold storage files. Slow on a large archive, so it
+    runs as the 'rebuild_rollups' background task; `progress` is its TaskProgress.
+    """
+    from app.cold_storage import iter_cold_jobs
+
+    columns = [getattr(ArchivedJob, name) for name in ROLLUP_COLUMNS]
+    if progress is not None:
+        cold_rows = db.session.query(db.func.sum(ColdArchiveFile.row_count)).scalar() or 0
+        progress.update(total=ArchivedJob.query.count() + cold_rows)
+
+    # Jobs archived once the old rollups are gone fold themselves in; stop short of them
+    DailyRollup.query.delete()
+    max_id = db.session.query(db.func.max(ArchivedJob.id)).scalar() or 0
+    db.session.commit()
+    last_id = 0
+    while True:
+        batch = db.session.query(*columns).filter(ArchivedJob.id > last_id, ArchivedJob.id <= max_id) \
+            .order_by(ArchivedJob.id).limit(batch_size).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        record_archived_jobs(batch)
+        db.session.commit()
+        if progress is not None:
+            progress.advance(len(batch))
+
+    for batch in iter_cold_jobs(ROLLUP_COLUMNS, batch_size):
+        record_archived_jobs(batch)
+        db.session.commit()
+        if progress is not None:
+            progress.advance(len(batch))
+    print(f"[OK] Rebuilt daily rollups up to archived job {last_id}")
+
+
+def rollups_missing():
+    """
+    No rollups although there are archived jobs (fresh install, or the table was recreated),
+    or rollups built before they carried stage sketches
+    """
+    if DailyRollup.query.filter(DailyRollup.dimension == 'day', DailyRollup.stage_sketches == None).first():
+        return True
+    return DailyRollup.query.first() is None and (
+        ArchivedJob.query.first() is not None or ColdArchiveFile.query.first() is not None)
+
+
+def rebuild_rollup_day(day):
+    """Recompute one day's rollups, e.g. after an archived job was deleted (caller commits)"""
+    DailyRollup.query.filter_by(day=day).delete()
+    start = datetime.combine(day, datetime.min.time()) - timedelta(hours=3)
+    record_archived_jobs(ArchivedJob.query.filter(
+        ArchivedJob.time_in >= start,
+        ArchivedJob.time_in < start + timedelta(days=1)
+    ).all())
+
+
+def _summary(key, jobs, revenue, duration, revenue_q):
+    return {
+        'key': key,
+        'jobs': jobs,
+        'revenue': revenue or 0.0,
+        'duration': dict(zip(('p50', 'p90', 'p99'), duration)),
+        'revenue_per_job': dict(zip(('p50', 'p90', 'p99'), revenue_q)),
+    }
+
+
+_stats_cache = {}
+_stats_cache_lock = threading.Lock()
+
+
+def _cached(name, compute):
+    """
+    Result of `compute` for the current branch, reused by this worker while its rollups are
+    unchanged. Archiving, deleting or rebuilding always changes the rollup totals, so one
+    small aggregate over daily_rollups tells whether the merged result is still current.
+    """
+    fingerprint = tuple(db.session.query(
+        db.func.count(DailyRollup.id),
+        db.func.sum(DailyRollup.jobs),
+        db.func.sum(DailyRollup.revenue),
+        db.func.sum(DailyRollup.duration_sum)
+    ).one())
+    key = (g.get('branch_id') if has_app_context() else None, name)
+    with _stats_cache_lock:
+        cached = _stats_cache.get(key)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    result = compute()
+    with _stats_cache_lock:
+        if len(_stats_cache) >= STATS_CACHE_SIZE:
+            _stats_cache.clear()
+        _stats_cache[key] = (fingerprint, result)
+    return result
+
+
+def distribution_stats(dimension, since=None):
+    """
+    p50/p90/p99 job duration and revenue per job, grouped by 'service', 'staff' or 'day'
+    Postgres computes exact percentiles with percentile_cont over the hot rows; SQLite, and
+    Postgres when cold files overlap the range, merge the DDSketches stored in the daily
+    rollups instead (they also cover jobs moved to cold storage). Either way the result is
+    cached until the rollups change.
+
+    Args:
+        dimension: 'service', 'staff' or 'day'
+        since: Optional first Kenya-local date to include
+
+    Returns:
+        List of summaries ordered by job count (or by day, newest first)
+    """
+    return _cached(('distribution', dimension, since), lambda: _distribution_stats(dimension, since))
+
+
+def _distribution_stats(dimension, since):
+    if db.engine.dialect.name == 'postgresql' and not _cold_overlaps(since):
+        return _distribution_stats_postgres(dimension, since)
+
+    query = db.session.query(
+        DailyRollup.day, DailyRollup.key, DailyRollup.jobs, DailyRollup.revenue,
+        DailyRollup.duration_sketch, DailyRollup.revenue_sketch
+    ).filter(DailyRollup.dimension == dimension)
+    if since:
+        query = query.filter(DailyRollup.day >= since)
+
+    merged = {}
+    for day, key, jobs, revenue, duration_sketch, revenue_sketch in query:
+        key = day.isoformat() if dimension == 'day' else key
+        if key not in merged:
+            merged[key] = [0, 0.0, DDSketch(), DDSketch()]
+        totals = merged[key]
+        totals[0] += jobs
+        totals[1] += revenue
+        totals[2].merge(DDSketch.from_json(duration_sketch))
+        totals[3].merge(DDSketch.from_json(revenue_sketch))
+
+    results = [
+        _summary(key, jobs, revenue,
+                 [duration.quantile(q) for q in QUANTILES],
+                 [revenue_sketch.quantile(q) for q in QUANTILES])
+        for key, (jobs, revenue, duration, revenue_sketch) in merged.items()
+    ]
+    return _ordered(dimension, results)
+
+
+def stage_stats():
+    """
+    Jobs, average, p50, p90 and longest minutes per stage (in STAGE_COLUMNS order), merged
+    from the stage sketches on the 'day' rollups and cached like distribution_stats
+    """
+    def compute():
+        merged = defaultdict(DDSketch)
+        for (data,) in db.session.query(DailyRollup.stage_sketches).filter(
+                DailyRollup.dimension == 'day', DailyRollup.stage_sketches != None):
+            for stage, raw in json.loads(data).items():
+                merged[stage].merge(DDSketch.from_dict(raw))
+        return [{
+            'stage': stage,
+            'jobs': merged[stage].count,
+            'avg_minutes': merged[stage].total / merged[stage].count,
+            'p50_minutes': merged[stage].quantile(0.5),
+            'p90_minutes': merged[stage].quantile(0.9),
+            'max_minutes': merged[stage].max
+        } for stage in ArchivedJob.STAGE_COLUMNS if merged[stage].count]
+
+    return _cached('stages', compute)
+
+
+def _cold_overlaps(since):
+    """Whether any cold storage file holds jobs from `since` (a Kenya-local date) onwards"""
+    query = db.session.query(ColdArchiveFile.id)
+    if since:
+        query = query.filter(
+            ColdArchiveFile.max_time_in >= datetime.combine(since, datetime.min.time()) - timedelta(hours=3))
+    return query.first() is not None
+
+
+def _distribution_stats_postgres(dimension, since):
+    if dimension == 'service':
+        key = db.func.coalesce(ArchivedJob.service_name, 'Unknown')
+    elif dimension == 'staff':
+        key = db.func.coalesce(ArchivedJob.staff_name, 'Unassigned')
+    else:
+        key = db.cast(db.func.date(ArchivedJob.time_in + timedelta(hours=3)), db.String)
+
+    columns = [key, db.func.count(ArchivedJob.id), db.func.sum(ArchivedJob.service_price)]
+    columns += [db.func.percentile_cont(q).within_group(ArchivedJob.duration_minutes) for q in QUANTILES]
+    columns += [db.func.percentile_cont(q).within_group(ArchivedJob.service_price) for q in QUANTILES]
+
+    query = db.session.query(*columns).filter(ArchivedJob.time_in != None)
+    if since:
+        query = query.filter(ArchivedJob.time_in >= datetime.combine(since, datetime.min.time()) - timedelta(hours=3))
+
+    results = [
+        _summary(row[0], row[1], row[2], row[3:6], row[6:9])
+        for row in query.group_by(key)
+    ]
+    return _ordered(dimension, results)
+
+
+def _ordered(dimension, results):
+    if dimension == 'day':
+        return sorted(results, key=lambda summary: summary['key'], reverse=True)
+    return sorted(results, key=lambda summary: summary['jobs'], reverse=True)
@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta, timezone
+import sqlalchemy as sa
+from sqlalchemy.orm.exc import StaleDataError
+from app import db
+from app.models import Car, Service, JobStatusChange
+from app.scheduler import scheduler
+
+# Delta reads reach back this far before the client's watermark, so a transaction that
+# committed late (with an older updated_at) is still picked up; the client keeps the higher version
+SYNC_OVERLAP_SECONDS = 10
+MAX_CHANGES = 200
+
+# Pipeline order; an offline change that moves a job forward wins over a concurrent edit
+STATUS_ORDER = ['Waiting', 'Washing', 'Detailing', 'Ready for Pickup', 'Completed']
+
+JOB_COLUMNS = (Car.id, Car.plate_number, Car.car_model, Car.customer_name, Car.customer_phone,
+               Car.service_id, Car.status, Car.time_in, Car.time_out, Car.version)
+
+
+def _iso(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def parse_watermark(value):
+    """Client watermark (ISO string from a previous sync) -> naive UTC datetime, or None for a full sync"""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def _visible(user, day_start):
+    """The staff member's unfinished jobs plus the ones they completed today"""
+    return sa.and_(Car.assigned_user_id == user.id,
+                   sa.or_(Car.status != 'Completed', Car.time_out >= day_start))
+
+
+def _job_rows(*criteria):
+    rows = db.session.execute(sa.select(*JOB_COLUMNS).where(*criteria)).all()
+    # Service names in a second query: a branch's jobs may live in a different database from services
+    service_ids = {row.service_id for row in rows}
+    service_names = dict(db.session.execute(
+        sa.select(Service.id, Service.name).where(Service.id.in_(service_ids))
+    ).all()) if service_ids else {}
+    return [{
+        'id': row.id,
+        'plate_number': row.plate_number,
+        'car_model': row.car_model,
+        'customer_name': row.customer_name,
+        'customer_phone': row.customer_phone,
+        'service_name': service_names.get(row.service_id),
+        'status': row.status,
+        'time_in': _iso(row.time_in),
+        'time_out': _iso(row.time_out),
+        'version': row.version
+    } for row in rows]
+
+
+def delta(user, since, day_start):
+    """
+    Jobs changed since the client's watermark
+
+    Returns:
+        Dictionary with the new watermark, changed job rows, the ids of every job the client
+        should still show (anything else was archived, deleted or reassigned) and ETAs
+    """
+    watermark = datetime.utcnow()
+    visible = _visible(user, day_start)
+
+    ids = db.session.execute(sa.select(Car.id, Car.status).where(visible)).all()
+    criteria = [visible]
+    if since is not None:
+        criteria.append(Car.updated_at >= since - timedelta(seconds=SYNC_OVERLAP_SECONDS))
+
+    all_etas = scheduler.etas()
+    etas = {car_id: _iso(all_etas[car_id]['ready_at']) for car_id, _ in ids if car_id in all_etas}
+
+    return {
+        'watermark': _iso(watermark),
+        'full': since is None,
+        'jobs': _job_rows(*criteria),
+        'ids': [car_id for car_id, _ in ids],
+        'etas': etas
+    }
+
+
+def _change_time(car, submitted):
+    """When an offline change happened, kept between the job's last transition and now"""
+    now = datetime.utcnow()
+    changed_at = parse_watermark(submitted)
+    if changed_at is None:
+        return now
+    last_change = db.session.query(sa.func.max(JobStatusChange.changed_at)).filter(
+        JobStatusChange.car_id == car.id).scalar()
+    return min(now, max(changed_at, last_change or car.time_in))
+
+
+def _apply_change(user, change):
+    """
+    Apply one queued status change
+
+    Returns:
+        (result, message): 'applied', 'merged' (applied over a concurrent change) or 'rejected'
+    """
+    status = change.get('status')
+    if status not in STATUS_ORDER:
+        return 'rejected', f"Unknown status '{status}'"
+
+    car = db.session.get(Car, change.get('car_id'))
+    if car is None or car.assigned_user_id != user.id:
+        return 'rejected', 'This job was removed or reassigned'
+    if car.status == status:
+        return 'applied', None
+
+    if str(change.get('version')) == str(car.version):
+        result, message = 'applied', None
+    elif STATUS_ORDER.index(status) > STATUS_ORDER.index(car.status):
+        result, message = 'merged', f'{car.plate_number} was also changed by someone else; kept your "{status}"'
+    else:
+        return 'rejected', f'{car.plate_number} was changed to "{car.status}" by someone else'
+
+    plate = car.plate_number
+    try:
+        car.set_status(status, changed_by=user, changed_at=_change_time(car, change.get('changed_at')))
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return 'rejected', f'{plate} was changed by someone else while syncing'
+    scheduler.track(car)
+    return result, message
+
+
+def apply_changes(user, changes):
+    """
+    Apply status changes queued offline, oldest first, each in its own transaction
+
+    Returns:
+        List of per-change results with the job's current row, so the client can settle its copy
+    """
+    results = []
+    for change in changes[:MAX_CHANGES]:
+        if not isinstance(change, dict) or not isinstance(change.get('car_id'), int):
+            continue
+        result, message = _apply_change(user, change)
+        rows = _job_rows(Car.id == change.get('car_id'), Car.assigned_user_id == user.id)
+        results.append({
+            'op_id': change.get('op_id'),
+            'car_id': change.get('car_id'),
+            'result': result,
+            'message': message,
+            'job': rows[0] if rows else None
+        })
+    if results:
+        print(f"[*] Synced {len(results)} offline change(s) for {user.username}: "
+              f"{sum(r['result'] != 'rejected' for r in results)} applied")
+    return results
@@ -0,0 +1,405 @@
+"""
+Spot - Background tasks
+Heavy admin actions (archiving, clearing data, moving archives to cold storage) run outside
+the HTTP request: the route queues a task and returns at once, a worker thread runs it in
+batches with a commit after each one, and /admin/tasks shows its progress.
+TASK_BACKEND 'database' (default) keeps tasks in the background_tasks table, so a task queued
+by one gunicorn worker can be run by any of them and survives a restart of the worker that
+queued it; 'local' keeps them in this process's memory (one worker, development).
+"""
+
+import itertools
+import json
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+import sqlalchemy as sa
+from flask import current_app, g
+from app import db
+from app.models import BackgroundTask
+from app.branches import branch_scope, get_branch
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+TaskInfo = namedtuple('TaskInfo', 'id name params status done total message user_id branch_id worker '
+                                  'created_at started_at finished_at heartbeat_at')
+
+# name -> (function, title), filled in by @task
+TASKS = {}
+
+
+def task(name, title):
+    """
+    Register a background task
+    The function is called as func(progress, **params) in an app context scoped to the branch
+    the task was queued in; it commits its own work and returns a short result message
+    """
+    def register(func):
+        TASKS[name] = (func, title)
+        return func
+    return register
+
+
+def task_title(name):
+    return TASKS[name][1] if name in TASKS else name
+
+
+class TaskProgress:
+    """Handed to a running task to report how far it got"""
+
+    def __init__(self, store, task_id):
+        self.store = store
+        self.task_id = task_id
+        self.done = 0
+        self.total = None
+
+    def update(self, done=None, total=None, message=None):
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        self.store.progress(self.task_id, self.done, self.total, message)
+
+    def advance(self, count, message=None):
+        self.update(self.done + count, message=message)
+
+
+# STORES
+
+
+class DatabaseTaskStore:
+    """Tasks in the background_tasks table, shared by every worker using the database"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = BackgroundTask.__table__
+
+    def add(self, name, params, user_id, branch_id):
+        with self.engine.begin() as connection:
+            return connection.execute(sa.insert(self.table).values(
+                name=name, params=json.dumps(params), status='queued', done=0, user_id=user_id,
+                branch_id=branch_id, created_at=datetime.utcnow())).inserted_primary_key[0]
+
+    def get(self, task_id):
+        with self.engine.connect() as connection:
+            row = connection.execute(sa.select(self.table).where(self.table.c.id == task_id)).first()
+        return TaskInfo(**row._mapping) if row is not None else None
+
+    def active(self, name, branch_id):
+        with self.engine.connect() as connection:
+            row = connection.execute(sa.select(self.table).where(
+                self.table.c.name == name, self.table.c.branch_id == branch_id,
+                self.table.c.status.in_(ACTIVE_STATUSES)).limit(1)).first()
+        return TaskInfo(**row._mapping) if row is not None else None
+
+    def recent(self, branch_id, limit):
+        with self.engine.connect() as connection:
+            rows = connection.execute(sa.select(self.table).where(self.table.c.branch_id == branch_id)
+                                      .order_by(self.table.c.id.desc()).limit(limit)).all()
+        return [TaskInfo(**row._mapping) for row in rows]
+
+    def claim(self, worker):
+        """
+        Take the oldest queued task with one conditional UPDATE, so exactly one worker gets it
+        `worker` names a single thread, which then reads back the row it just claimed
+        """
+        oldest = sa.select(self.table.c.id).where(self.table.c.status == 'queued') \
+            .order_by(self.table.c.id).limit(1).scalar_subquery()
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            claimed = connection.execute(sa.update(self.table).where(
+                self.table.c.id == oldest, self.table.c.status == 'queued'
+            ).values(status='running', worker=worker, started_at=now, heartbeat_at=now)).rowcount
+            if not claimed:
+                return None
+            row = connection.execute(sa.select(self.table).where(
+                self.table.c.status == 'running', self.table.c.worker == worker,
+                self.table.c.started_at == now)).first()
+        return TaskInfo(**row._mapping)
+
+    def progress(self, task_id, done, total, message=None):
+        values = {'done': done, 'total': total, 'heartbeat_at': datetime.utcnow()}
+        if message is not None:
+            values['message'] = message[:300]
+        with self.engine.begin() as connection:
+            connection.execute(sa.update(self.table).where(self.table.c.id == task_id).values(**values))
+
+    def finish(self, task_id, status, message):
+        with self.engine.begin() as connection:
+            connection.execute(sa.update(self.table).where(self.table.c.id == task_id).values(
+                status=status, message=(message or '')[:300], finished_at=datetime.utcnow()))
+
+    def heartbeat(self, task_ids):
+        with self.engine.begin() as connection:
+            connection.execute(sa.update(self.table).where(self.table.c.id.in_(task_ids)).values(
+                heartbeat_at=datetime.utcnow()))
+
+    def sweep(self, stale_seconds, retention_days):
+        """Fail tasks whose worker stopped heartbeating, and forget finished tasks past retention"""
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            interrupted = connection.execute(sa.update(self.table).where(
+                self.table.c.status == 'running',
+                self.table.c.heartbeat_at < now - timedelta(seconds=stale_seconds)
+            ).values(status='failed', finished_at=now,
+                     message='Interrupted: the worker running it stopped. Run it again.')).rowcount
+            connection.execute(sa.delete(self.table).where(
+                self.table.c.status.notin_(ACTIVE_STATUSES),
+                self.table.c.finished_at < now - timedelta(days=retention_days)))
+        if interrupted:
+            print(f"[!] Marked {interrupted} interrupted background tasks as failed")
+
+
+class LocalTaskStore:
+    """Tasks in this process's memory; other workers never see them and a restart loses them"""
+
+    def __init__(self):
+        self._tasks = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _set(self, task_id, **values):
+        with self._lock:
+            self._tasks[task_id] = self._tasks[task_id]._replace(**values)
+
+    def add(self, name, params, user_id, branch_id):
+        with self._lock:
+            task_id = next(self._ids)
+            self._tasks[task_id] = TaskInfo(task_id, name, json.dumps(params), 'queued', 0, None, None, user_id,
+                                            branch_id, None, datetime.utcnow(), None, None, None)
+        return task_id
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def active(self, name, branch_id):
+        with self._lock:
+            return next((info for info in self._tasks.values() if info.name == name
+                         and info.branch_id == branch_id and info.status in ACTIVE_STATUSES), None)
+
+    def recent(self, branch_id, limit):
+        with self._lock:
+            tasks = [info for info in self._tasks.values() if info.branch_id == branch_id]
+        return sorted(tasks, key=lambda info: info.id, reverse=True)[:limit]
+
+    def claim(self, worker):
+        with self._lock:
+            queued = [info for info in self._tasks.values() if info.status == 'queued']
+            if not queued:
+                return None
+            now = datetime.utcnow()
+            info = min(queued, key=lambda info: info.id)._replace(
+                status='running', worker=worker, started_at=now, heartbeat_at=now)
+            self._tasks[info.id] = info
+            return info
+
+    def progress(self, task_id, done, total, message=None):
+        values = {'done': done, 'total': total, 'heartbeat_at': datetime.utcnow()}
+        if message is not None:
+            values['message'] = message[:300]
+        self._set(task_id, **values)
+
+    def finish(self, task_id, status, message):
+        self._set(task_id, status=status, message=(message or '')[:300], finished_at=datetime.utcnow())
+
+    def heartbeat(self, task_ids):
+        pass  # tasks die with the process that holds them
+
+    def sweep(self, stale_seconds, retention_days):
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        with self._lock:
+            for task_id in [info.id for info in self._tasks.values()
+                            if info.status not in ACTIVE_STATUSES and info.finished_at < cutoff]:
+                del self._tasks[task_id]
+
+
+# RUNNER
+
+
+class TaskRunner:
+    """Worker threads in each app process that claim queued tasks and run them"""
+
+    def __init__(self, app, store, threads=1, poll_seconds=2, stale_seconds=300, retention_days=7):
+        self.app = app
+        self.store = store
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.stale_seconds = stale_seconds
+        self.retention_days = retention_days
+        self.worker = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._running = set()
+
+    def ensure_started(self):
+        """Start the worker threads in this process (again in a forked worker: threads don't survive a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.worker = f'{socket.gethostname()}:{self._pid}'
+            self._wake = threading.Event()
+            self._running = set()
+            for index in range(self.threads):
+                threading.Thread(target=self._work, args=(f'{self.worker}/{index}',),
+                                 name=f'task-worker-{index}', daemon=True).start()
+            threading.Thread(target=self._heartbeat, name='task-heartbeat', daemon=True).start()
+        print(f"[*] Background task workers started ({self.threads} thread(s) in {self.worker})")
+
+    def wake(self):
+        self._wake.set()
+
+    def _work(self, worker):
+        while True:
+            try:
+                info = self.store.claim(worker)
+            except Exception as e:
+                print(f"[!] Background task queue error: {str(e)}")
+                info = None
+            if info is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+            self._run(info)
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(max(1, self.stale_seconds // 3))
+            try:
+                if self._running:
+                    self.store.heartbeat(list(self._running))
+                self.store.sweep(self.stale_seconds, self.retention_days)
+            except Exception as e:
+                print(f"[!] Background task heartbeat error: {str(e)}")
+
+    def _run(self, info):
+        func, title = TASKS.get(info.name, (None, info.name))
+        self._running.add(info.id)
+        started = time.perf_counter()
+        try:
+            if func is None:
+                raise RuntimeError(f"Unknown task '{info.name}'")
+            with self.app.app_context():
+                with branch_scope(get_branch(info.branch_id)):
+                    result = func(TaskProgress(self.store, info.id), **json.loads(info.params or '{}'))
+            self.store.finish(info.id, 'succeeded', result)
+            print(f"[OK] Task {info.id} ({title}) finished in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            self.store.finish(info.id, 'failed', str(e))
+            print(f"[ERROR] Task {info.id} ({title}) failed: {str(e)}")
+        finally:
+            self._running.discard(info.id)
+
+
+def _runner():
+    return current_app.extensions['task_runner']
+
+
+# API
+
+
+def enqueue(name, user=None, **params):
+    """
+    Queue a task in the current branch
+    A task of the same name already queued or running there is returned instead of a second one
+
+    Returns:
+        (task id, True if newly queued)
+    """
+    if name not in TASKS:
+        raise ValueError(f"Unknown task '{name}'")
+    runner = _runner()
+    branch_id = g.get('branch_id')
+    existing = runner.store.active(name, branch_id)
+    if existing is not None:
+        return existing.id, False
+    task_id = runner.store.add(name, params, user.id if user else None, branch_id)
+    runner.ensure_started()
+    runner.wake()
+    return task_id, True
+
+
+def get_task(task_id):
+    """A task of the current branch, or None"""
+    info = _runner().store.get(task_id)
+    return info if info is not None and info.branch_id == g.get('branch_id') else None
+
+
+def active_task(name):
+    """The current branch's queued or running task of this name, or None"""
+    return _runner().store.active(name, g.get('branch_id'))
+
+
+def recent_tasks(limit=50):
+    """The current branch's latest tasks, newest first"""
+    return _runner().store.recent(g.get('branch_id'), limit)
+
+
+def task_dict(info):
+    """JSON-ready view of a task for the status page"""
+    return {
+        'id': info.id,
+        'name': info.name,
+        'title': task_title(info.name),
+        'status': info.status,
+        'done': info.done,
+        'total': info.total,
+        'percent': min(100, round(info.done * 100 / info.total)) if info.total else None,
+        'message': info.message,
+        'created_at': info.created_at.isoformat() + 'Z' if info.created_at else None,
+        'started_at': info.started_at.isoformat() + 'Z' if info.started_at else None,
+        'finished_at': info.finished_at.isoformat() + 'Z' if info.finished_at else None,
+    }
+
+
+def delete_in_batches(query, progress=None, batch_size=None):
+    """
+    Delete the rows an ORM query selects, batch_size at a time with a commit after each batch,
+    so no single transaction locks the table (or holds a worker) for long
+
+    Returns:
+        Number of rows deleted
+    """
+    batch_size = batch_size or current_app.config.get('TASK_BATCH_SIZE', 1000)
+    model = query.column_descriptions[0]['entity']
+    # The mapped attribute, not the table column: a bare column select gets no branch criteria
+    mapper = sa.inspect(model)
+    key = mapper.get_property_by_column(mapper.primary_key[0]).class_attribute
+    deleted = 0
+    while True:
+        ids = [row[0] for row in query.with_entities(key).order_by(key).limit(batch_size)]
+        if not ids:
+            return deleted
+        model.query.filter(key.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        if progress is not None:
+            progress.advance(len(ids))
+
+
+def init_tasks(app):
+    """Set up the TASK_BACKEND queue; worker threads start with the first request in each process"""
+    backend = app.config.get('TASK_BACKEND', 'database')
+    if backend == 'database':
+        store = DatabaseTaskStore(db.engine)
+    elif backend == 'local':
+        store = LocalTaskStore()
+    else:
+        raise ValueError(f"Unknown TASK_BACKEND '{backend}' (use 'database' or 'local')")
+
+    runner = TaskRunner(app, store,
+                        threads=app.config.get('TASK_WORKER_THREADS', 1),
+                        poll_seconds=app.config.get('TASK_POLL_SECONDS', 2),
+                        stale_seconds=app.config.get('TASK_STALE_SECONDS', 300),
+                        retention_days=app.config.get('TASK_RETENTION_DAYS', 7))
+    app.extensions['task_runner'] = runner
+
+    @app.before_request
+    def start_task_workers():
+        runner.ensure_started()
@@ -22,6 +22,25 @@ def admin_required(f):
     return decorated_function
 
 
+def owner_required(f):
+    """
+    Decorator to require an owner (admin not tied to a branch) for a route
+    Usage: @owner_required
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not current_user.is_authenticated:
+            flash('Please log in to access this page.', 'error')
+            return redirect(url_for('login'))
+        
+        if not current_user.is_owner:
+            flash('Only owners can manage branches.', 'error')
+            return redirect(url_for('admin_dashboard' if current_user.role == 'admin' else 'staff_dashboard'))
+        
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def send_notification(car, status):
     """
     Send SMS/Email notification to customer
@@ -0,0 +1,525 @@
+"""
+Spot - Benchmarks
+Run with: python benchmark.py <name> [options]
+
+Each benchmark builds its own throwaway SQLite database, so it never touches app.db
+(`load` can instead target a database filled by seed_data.py via --database).
+"""
+
+import argparse
+import csv
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from config import Config
+
+
+def make_app(db_path):
+    """Create an app bound to a scratch database"""
+    from app import create_app
+
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + db_path
+        WTF_CSRF_ENABLED = False
+
+    return create_app(BenchmarkConfig)
+
+
+def timed(label, func, *args, **kwargs):
+    """Run func once and print how long it took"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {elapsed * 1000:>10.1f} ms")
+    return result, elapsed
+
+
+# LOGIN
+
+
+def bench_login(args):
+    """Login requests/sec for one worker: valid, unknown-user and throttled attempts"""
+    from app import db
+    from app.models import User
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench_login.db')
+    app = make_app(db_path)
+    app.config['PASSWORD_HASH_METHOD'] = args.method
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+
+    with app.app_context():
+        user = User(username='benchuser', full_name='Bench User', email='bench@example.com', role='staff')
+        user.set_password('benchpass')
+        db.session.add(user)
+        db.session.commit()
+
+    def run(label, username, password, count):
+        start = time.perf_counter()
+        statuses = {}
+        for _ in range(count):
+            with app.test_client() as client:
+                response = client.post('/login', data={'username': username, 'password': password})
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        elapsed = time.perf_counter() - start
+        print(f"{label:<40} {count / elapsed:>10.1f} req/s   {statuses}")
+
+    print(f"Hash method: {args.method}")
+    run('valid credentials', 'benchuser', 'benchpass', args.requests)
+    run('wrong password', 'benchuser', 'nope', args.requests)
+    run('unknown username', 'nobody', 'nope', args.requests)
+
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = True
+    run('burst from one IP (throttled)', 'benchuser', 'nope', args.requests * 10)
+
+
+# BULK INTAKE
+
+
+def bench_intake(args):
+    """Importing N cars: one form POST per car vs. one bulk JSON request vs. one CSV upload"""
+    import io
+    from app import db
+    from app.models import Car
+    from seed_data import seed, CustomerPool, random_plate
+
+    app = make_app(os.path.join(tempfile.mkdtemp(), 'bench_intake.db'))
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    seed(app, archived_jobs=0, staff=args.staff, cars=0, notifications=0)
+    admin_password = os.environ.get('DEFAULT_ADMIN_PASSWORD', 'crystalclean2025')
+
+    with app.app_context():
+        from app.models import Service, User
+        service_ids = [s.id for s in Service.query.all()]
+        staff_ids = [u.id for u in User.query.filter_by(role='staff', is_active=True)]
+
+    rng = random.Random(42)
+    pool = CustomerPool(rng, args.rows)
+
+    def make_rows(count):
+        rows, plates = [], set()
+        while len(rows) < count:
+            name, phone, email, _, model = pool.pick()
+            plate = random_plate(rng)
+            if plate in plates:
+                continue
+            plates.add(plate)
+            rows.append({'customer_name': name, 'customer_phone': phone, 'customer_email': email or '',
+                         'plate_number': plate, 'car_model': model, 'service': str(rng.choice(service_ids))})
+        return rows
+
+    def clear(client):
+        with app.app_context():
+            Car.query.delete()
+            db.session.commit()
+        with client.session_transaction() as session:
+            session.pop('_flashes', None)
+
+    with app.test_client() as client:
+        client.post('/login', data={'username': 'Mark', 'password': admin_password})
+
+        rows = make_rows(args.rows)
+        start = time.perf_counter()
+        for row in rows:
+            client.post('/cars/add', data={**row, 'service_id': row['service'],
+                                           'assigned_user_id': rng.choice(staff_ids)})
+        single = time.perf_counter() - start
+        print(f"{'one form POST per car':<40} {single * 1000:>10.1f} ms   {args.rows / single:>8.0f} rows/s")
+        clear(client)
+
+        rows = make_rows(args.rows)
+        start = time.perf_counter()
+        response = client.post('/cars/bulk', json={'jobs': rows, 'auto_assign': True})
+        bulk = time.perf_counter() - start
+        print(f"{'bulk JSON (auto-assign)':<40} {bulk * 1000:>10.1f} ms   {args.rows / bulk:>8.0f} rows/s   "
+              f"created={response.json['created']} errors={len(response.json['errors'])}")
+        clear(client)
+
+        rows = make_rows(args.rows)
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+        start = time.perf_counter()
+        client.post('/cars/bulk', data={'csv_file': (io.BytesIO(buffer.getvalue().encode()), 'fleet.csv'),
+                                        'service_id': 0, 'auto_assign': 'y'},
+                    content_type='multipart/form-data')
+        upload = time.perf_counter() - start
+        with app.app_context():
+            created = Car.query.count()
+        print(f"{'CSV upload (auto-assign)':<40} {upload * 1000:>10.1f} ms   {args.rows / upload:>8.0f} rows/s   "
+              f"created={created}")
+
+    print(f"Speedup (bulk JSON vs per-car): {single / bulk:.1f}x")
+
+
+# CONTENDED STATUS UPDATES
+
+
+def bench_contention(args):
+    """Many threads updating one job: optimistic version checks, throughput and lost-update checks"""
+    from app import db
+    from app.models import Car, Service, User, JobStatusChange
+
+    app = make_app(os.path.join(tempfile.mkdtemp(), 'bench_contention.db'))
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    admin_password = os.environ.get('DEFAULT_ADMIN_PASSWORD', 'crystalclean2025')
+    cycle = ['Waiting', 'Washing', 'Detailing', 'Ready for Pickup']
+
+    with app.app_context():
+        service = Service(name='Contention Wash', price=500, duration=30, is_active=True)
+        db.session.add(service)
+        db.session.flush()
+        car = Car(customer_name='Race Car', customer_phone='+254700000000', plate_number='KRACE1',
+                  service_id=service.id, assigned_user_id=User.query.filter_by(role='staff').first().id,
+                  status='Waiting')
+        db.session.add(car)
+        db.session.commit()
+        car_id = car.id
+
+    def read_job():
+        with app.app_context():
+            return db.session.query(Car.version, Car.status).filter_by(id=car_id).one()
+
+    def post_status(client, status, version):
+        return client.post(f'/cars/update-status/{car_id}', data={'status': status, 'version': version},
+                           headers={'Accept': 'application/json'}).status_code
+
+    clients = []
+    for _ in range(args.threads):
+        client = app.test_client()
+        client.post('/login', data={'username': 'Mark', 'password': admin_password})
+        clients.append(client)
+
+    results = {'ok': 0, 'conflict': 0, 'other': 0}
+    lock = threading.Lock()
+
+    def record(code):
+        key = 'ok' if code == 302 else 'conflict' if code == 409 else 'other'
+        with lock:
+            results[key] += 1
+
+    # Phase 1: every thread keeps moving the job to the next status from what it last read
+    def hammer(client):
+        for _ in range(args.rounds):
+            version, status = read_job()
+            record(post_status(client, cycle[(cycle.index(status) + 1) % len(cycle)], version))
+
+    threads = [threading.Thread(target=hammer, args=(client,)) for client in clients]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    attempts = args.threads * args.rounds
+    print(f"{'contended status updates':<40} {attempts / elapsed:>10.1f} req/s   {results}")
+    phase1_ok = results['ok']
+
+    # Phase 2: all threads try to complete the job from the same version at once
+    version, _ = read_job()
+    barrier = threading.Barrier(args.threads)
+    results.update(ok=0, conflict=0, other=0)
+
+    def complete(client):
+        barrier.wait()
+        record(post_status(client, 'Completed', version))
+
+    threads = [threading.Thread(target=complete, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"{'simultaneous Completed from one version':<40} {results}")
+
+    failures = []
+    with app.app_context():
+        car = db.session.get(Car, car_id)
+        changes = JobStatusChange.query.filter_by(car_id=car_id).order_by(JobStatusChange.id).all()
+        if results['ok'] != 1:
+            failures.append(f"{results['ok']} requests completed the job (expected exactly 1)")
+        if results['other']:
+            failures.append(f"{results['other']} requests failed with unexpected status codes")
+        if len(changes) != phase1_ok + 1:
+            failures.append(f"{len(changes)} status changes logged for {phase1_ok + 1} successful updates")
+        if car.version != 1 + phase1_ok + 1:
+            failures.append(f"version {car.version}, expected {1 + phase1_ok + 1}")
+        previous = 'Waiting'
+        for change in changes:
+            if change.from_status != previous:
+                failures.append(f"lost update: change {change.id} went {change.from_status} -> {change.to_status} "
+                                f"after {previous}")
+                break
+            previous = change.to_status
+        if car.status != 'Completed' or car.time_out is None:
+            failures.append('job is not completed')
+
+    if failures:
+        for failure in failures:
+            print(f"[ERROR] {failure}")
+        raise SystemExit(1)
+    print(f"[OK] No lost updates: {phase1_ok + 1} transitions logged in order, time_out set once")
+
+
+# END-TO-END LOAD TEST
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def bench_load(args):
+    """Scripted admin/staff sessions against a seeded database; per-route throughput and latency"""
+    from app import db
+    from app.models import User, Car
+    from seed_data import seed
+
+    if args.database:
+        from app import create_app
+
+        class LoadConfig(Config):
+            SQLALCHEMY_DATABASE_URI = args.database
+            WTF_CSRF_ENABLED = False
+
+        app = create_app(LoadConfig)
+    else:
+        app = make_app(os.path.join(tempfile.mkdtemp(), 'bench_load.db'))
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+
+    if not args.database:
+        print(f"Seeding {args.archived_jobs:,} archived jobs, {args.staff} staff, {args.cars} cars...")
+        seed(app, archived_jobs=args.archived_jobs, staff=args.staff, cars=args.cars,
+             notifications=args.archived_jobs // 10)
+
+    with app.app_context():
+        staff_jobs = {}
+        for car_id, username in db.session.query(Car.id, User.username).join(
+                User, User.id == Car.assigned_user_id).filter(Car.status != 'Completed'):
+            staff_jobs.setdefault(username, []).append(car_id)
+        staff_usernames = list(staff_jobs)
+
+    admin_password = os.environ.get('DEFAULT_ADMIN_PASSWORD', 'crystalclean2025')
+    next_status = {'Waiting': 'Washing', 'Washing': 'Detailing', 'Detailing': 'Ready for Pickup',
+                   'Ready for Pickup': 'Completed', 'Completed': 'Completed'}
+    latencies = {}
+    lock = threading.Lock()
+
+    def hit(client, label, method, url, **kwargs):
+        start = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.setdefault(label, []).append(elapsed)
+            if response.status_code >= 400:
+                errors[label] = errors.get(label, 0) + 1
+        return response
+
+    errors = {}
+
+    def admin_session(rng):
+        with app.test_client() as client:
+            hit(client, 'POST /login (admin)', 'POST', '/login',
+                data={'username': 'Mark', 'password': admin_password})
+            for i in range(args.iterations):
+                hit(client, 'GET /admin/dashboard', 'GET', '/admin/dashboard')
+                hit(client, 'GET /admin/analytics', 'GET', '/admin/analytics')
+                hit(client, 'GET /admin/archived-jobs?search', 'GET',
+                    f'/admin/archived-jobs?search=K{rng.choice("ABCD")}&page={rng.randint(1, 5)}')
+                if i % 5 == 0:
+                    hit(client, 'POST /admin/archive-now', 'POST', '/admin/archive-now')
+
+    def staff_session(rng):
+        username = rng.choice(staff_usernames)
+        with app.test_client() as client:
+            hit(client, 'POST /login (staff)', 'POST', '/login',
+                data={'username': username, 'password': 'loadtest'})
+            statuses = {}
+            for _ in range(args.iterations):
+                hit(client, 'GET /staff/dashboard', 'GET', '/staff/dashboard')
+                car_id = rng.choice(staff_jobs[username])
+                statuses[car_id] = next_status[statuses.get(car_id, 'Waiting')]
+                hit(client, 'POST /cars/update-status', 'POST', f'/cars/update-status/{car_id}',
+                    data={'status': statuses[car_id]})
+
+    def worker(index):
+        rng = random.Random(index)
+        for session in range(args.sessions):
+            (admin_session if (index + session) % 4 == 0 else staff_session)(rng)
+
+    print(f"Running {args.concurrency} workers x {args.sessions} sessions x {args.iterations} iterations...")
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    print(f"\n{'route':<34} {'count':>6} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>6}")
+    for label, values in sorted(latencies.items()):
+        values.sort()
+        print(f"{label:<34} {len(values):>6} {len(values) / wall:>8.1f} "
+              f"{percentile(values, 50) * 1000:>8.1f} {percentile(values, 90) * 1000:>8.1f} "
+              f"{percentile(values, 99) * 1000:>8.1f} {values[-1] * 1000:>8.1f} {errors.get(label, 0):>6}")
+    total = sum(len(v) for v in latencies.values())
+    print(f"\nTotal: {total} requests in {wall:.1f}s ({total / wall:.1f} req/s)")
+
+
+# API LATENCY
+
+
+def bench_api(args):
+    """Per-endpoint /api/v1 latency (cold, field-selected, paginated, conditional) vs the HTML dashboard"""
+    from app import db
+    from app.models import Car
+    from seed_data import seed
+
+    app = make_app(os.path.join(tempfile.mkdtemp(), 'bench_api.db'))
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    print(f"Seeding {args.archived_jobs:,} archived jobs, {args.staff} staff, {args.cars} cars...")
+    seed(app, archived_jobs=args.archived_jobs, staff=args.staff, cars=args.cars,
+         notifications=args.archived_jobs // 10)
+
+    admin_password = os.environ.get('DEFAULT_ADMIN_PASSWORD', 'crystalclean2025')
+    client = app.test_client()
+    token = client.post('/api/v1/tokens', json={'username': 'Mark', 'password': admin_password}).get_json()['token']
+    auth = {'Authorization': f'Bearer {token}'}
+    with app.app_context():
+        job_id = db.session.query(db.func.max(Car.id)).scalar()
+    first_page = client.get('/api/v1/jobs', headers=auth)
+    cursor = first_page.get_json()['next_cursor'] or ''
+
+    cases = [
+        ('GET /api/v1/jobs', '/api/v1/jobs', auth),
+        ('GET /api/v1/jobs (If-None-Match)', '/api/v1/jobs', {**auth, 'If-None-Match': first_page.headers['ETag']}),
+        ('GET /api/v1/jobs?fields=id,status', '/api/v1/jobs?fields=id,status', auth),
+        ('GET /api/v1/jobs?limit=200', '/api/v1/jobs?limit=200', auth),
+        ('GET /api/v1/jobs?after=<cursor>', f'/api/v1/jobs?after={cursor}', auth),
+        ('GET /api/v1/jobs?status=Waiting', '/api/v1/jobs?status=Waiting', auth),
+        ('GET /api/v1/jobs/<id>', f'/api/v1/jobs/{job_id}', auth),
+        ('GET /api/v1/services', '/api/v1/services', auth),
+        ('GET /api/v1/staff', '/api/v1/staff', auth),
+        ('GET /api/v1/stats', '/api/v1/stats', auth),
+    ]
+
+    browser = app.test_client()
+    browser.post('/login', data={'username': 'Mark', 'password': admin_password})
+
+    print(f"\n{'endpoint':<38} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'bytes':>8} {'status':>6}")
+    for label, url, headers in cases + [('GET /admin/dashboard (HTML)', '/admin/dashboard', None)]:
+        target = browser if headers is None else client
+        timings = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            response = target.get(url, headers=headers)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{label:<38} {percentile(timings, 50) * 1000:>8.2f} {percentile(timings, 90) * 1000:>8.2f} "
+              f"{percentile(timings, 99) * 1000:>8.2f} {len(response.get_data()):>8} {response.status_code:>6}")
+
+
+# COMPRESSION AND STREAMING
+
+
+def bench_compression(args):
+    """Bytes on the wire and time to first byte per page, uncompressed vs gzip vs brotli"""
+    from seed_data import seed
+
+    app = make_app(os.path.join(tempfile.mkdtemp(), 'bench_compression.db'))
+    app.config['LOGIN_RATE_LIMIT_ENABLED'] = False
+    print(f"Seeding {args.archived_jobs:,} archived jobs, {args.staff} staff, {args.cars} cars...")
+    seed(app, archived_jobs=args.archived_jobs, staff=args.staff, cars=args.cars,
+         notifications=args.archived_jobs // 10)
+
+    admin_password = os.environ.get('DEFAULT_ADMIN_PASSWORD', 'crystalclean2025')
+    client = app.test_client()
+    client.post('/login', data={'username': 'Mark', 'password': admin_password})
+    pages = ['/admin/dashboard', '/admin/analytics', '/admin/archived-jobs', '/admin/archived-jobs?page=5',
+             '/reports', '/admin/archived-jobs/export']
+
+    def fetch(url, encoding):
+        """(bytes received, seconds to first chunk, seconds to last chunk)"""
+        start = time.perf_counter()
+        response = client.get(url, headers={'Accept-Encoding': encoding}, buffered=False)
+        received, first = 0, None
+        for chunk in response.response:
+            if first is None and chunk:
+                first = time.perf_counter() - start
+            received += len(chunk)
+        response.close()
+        total = time.perf_counter() - start
+        return received, first if first is not None else total, total
+
+    # Before streaming the first byte could only leave once the whole page was rendered,
+    # so 'identity' total time is the old time to first byte
+    print(f"\n{'page':<30} {'encoding':<9} {'bytes':>10} {'ratio':>6} {'TTFB ms':>9} {'total ms':>9}")
+    for url in pages:
+        baseline = None
+        for encoding in ('identity', 'gzip', 'br'):
+            runs = sorted((fetch(url, encoding) for _ in range(args.requests)), key=lambda run: run[2])
+            received, first, total = runs[len(runs) // 2]
+            baseline = baseline or received
+            print(f"{url:<30} {encoding:<9} {received:>10,} {received / baseline:>6.2f} "
+                  f"{first * 1000:>9.1f} {total * 1000:>9.1f}")
+
+
+BENCHMARKS = {
+    'login': (bench_login, [
+        ('--requests', 50),
+        ('--method', Config.PASSWORD_HASH_METHOD),
+    ]),
+    'intake': (bench_intake, [
+        ('--rows', 1000),
+        ('--staff', 20),
+    ]),
+    'contention': (bench_contention, [
+        ('--threads', 16),
+        ('--rounds', 25),
+    ]),
+    'load': (bench_load, [
+        ('--database', ''),
+        ('--archived-jobs', 10_000),
+        ('--staff', 20),
+        ('--cars', 200),
+        ('--concurrency', 4),
+        ('--sessions', 5),
+        ('--iterations', 20),
+    ]),
+    'api': (bench_api, [
+        ('--archived-jobs', 5000),
+        ('--staff', 20),
+        ('--cars', 500),
+        ('--requests', 200),
+    ]),
+    'compression': (bench_compression, [
+        ('--archived-jobs', 20_000),
+        ('--staff', 20),
+        ('--cars', 200),
+        ('--requests', 5),
+    ]),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Spot benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    for name, (func, options) in BENCHMARKS.items():
+        sub = subparsers.add_parser(name, help=func.__doc__)
+        for flag, default in options:
+            sub.add_argument(flag, type=type(default), default=default)
+        sub.set_defaults(func=func)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Spot - Static Asset Build
+Run with: python build_assets.py (on deploy, after pip install)
+
+Minifies CSS/JS, content-hashes every file under app/static and writes gzip/brotli
+copies next to them in app/static/dist, plus dist/manifest.json mapping
+'css/style.css' -> 'css/style.<hash>.css'. The app serves manifest entries with
+Cache-Control: immutable; without a build it falls back to the plain files.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+
+try:
+    import rcssmin
+    import rjsmin
+    MINIFY_AVAILABLE = True
+except ImportError:
+    MINIFY_AVAILABLE = False
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+STATIC_DIR = os.path.join(basedir, 'app', 'static')
+DIST = 'dist'
+SKIP_DIRS = (DIST, 'uploads')  # build output and user uploads
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.json', '.txt', '.map')
+MIN_COMPRESS_SIZE = 256
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def find_assets(static_dir):
+    """Logical paths ('css/style.css') of every asset, CSS last so it can point at hashed files"""
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        relative_root = os.path.relpath(root, static_dir)
+        if relative_root == '.':
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+        for name in files:
+            paths.append(posixpath.normpath(posixpath.join(relative_root.replace(os.sep, '/'), name)))
+    return sorted(paths, key=lambda path: (path.endswith('.css'), path))
+
+
+def minify(path, data):
+    if not MINIFY_AVAILABLE or '.min.' in path:
+        return data
+    if path.endswith('.css'):
+        return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+    if path.endswith('.js'):
+        return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+def rewrite_css_urls(path, data, manifest):
+    """Point url(...) references at the hashed files (relative paths keep working inside dist/)"""
+    css_dir = posixpath.dirname(path)
+
+    def replace(match):
+        quote, url = match.group(1), match.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return match.group(0)
+        target, _, suffix = url.partition('?')
+        target = posixpath.normpath(posixpath.join(css_dir, target))
+        hashed = manifest.get(target)
+        if hashed is None:
+            return match.group(0)
+        return f'url({quote}{posixpath.relpath(hashed, css_dir or ".")}{quote})'
+
+    return CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def hashed_name(path, data):
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    stem, ext = posixpath.splitext(path)
+    return f'{stem}.{digest}{ext}'
+
+
+def write_compressed(out_path, data):
+    """Write .gz (and .br) copies when they are smaller; returns (gzip bytes, brotli bytes)"""
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    gz_size = br_size = len(data)
+    if len(gz) < len(data):
+        with open(out_path + '.gz', 'wb') as f:
+            f.write(gz)
+        gz_size = len(gz)
+    if BROTLI_AVAILABLE:
+        br = brotli.compress(data, quality=11)
+        if len(br) < len(data):
+            with open(out_path + '.br', 'wb') as f:
+                f.write(br)
+            br_size = len(br)
+    return gz_size, br_size
+
+
+def build(static_dir=STATIC_DIR):
+    """
+    Rebuild app/static/dist from scratch
+
+    Returns:
+        Manifest dictionary of logical path -> hashed path
+    """
+    dist_dir = os.path.join(static_dir, DIST)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    manifest = {}
+    totals = {'source': 0, 'built': 0, 'gzip': 0, 'brotli': 0}
+    for path in find_assets(static_dir):
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            data = f.read()
+        totals['source'] += len(data)
+
+        data = minify(path, data)
+        if path.endswith('.css'):
+            data = rewrite_css_urls(path, data, manifest)
+
+        manifest[path] = hashed_name(path, data)
+        out_path = os.path.join(dist_dir, manifest[path])
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path, 'wb') as f:
+            f.write(data)
+
+        gz_size = br_size = len(data)
+        if path.endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_SIZE:
+            gz_size, br_size = write_compressed(out_path, data)
+        totals['built'] += len(data)
+        totals['gzip'] += gz_size
+        totals['brotli'] += br_size
+
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    if not MINIFY_AVAILABLE:
+        print("[!] rcssmin/rjsmin not installed, CSS and JS were not minified")
+    if not BROTLI_AVAILABLE:
+        print("[!] brotli not installed, only gzip copies were written")
+    print(f"[OK] Built {len(manifest)} assets: {totals['source'] / 1024:,.0f} KB source, "
+          f"{totals['built'] / 1024:,.0f} KB minified, {totals['gzip'] / 1024:,.0f} KB gzip, "
+          f"{totals['brotli'] / 1024:,.0f} KB brotli")
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build fingerprinted, precompressed static assets')
+    parser.add_argument('--static-dir', default=STATIC_DIR, help='Static folder to build (default: app/static)')
+    args = parser.parse_args()
+    build(args.static_dir)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from datetime import timedelta
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -13,15 +14,111 @@ class Config:
     SQLALCHEMY_DATABASE_URI = database_url or 'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Optional read replica for reporting pages (@read_replica routes); a second SQLite file works for testing
+    replica_url = os.environ.get('DATABASE_REPLICA_URL')
+    if replica_url and replica_url.startswith('postgres://'):
+        replica_url = replica_url.replace('postgres://', 'postgresql://', 1)
+    SQLALCHEMY_REPLICA_URI = replica_url
+    REPLICA_MAX_LAG_SECONDS = int(os.environ.get('REPLICA_MAX_LAG_SECONDS', 30))
+    REPLICA_HEALTH_CHECK_SECONDS = 10
+    # Read-your-writes: after a request that wrote, keep that user's reads on the primary
+    # for this many seconds (0 = off)
+    REPLICA_READ_YOUR_WRITES_SECONDS = int(os.environ.get('REPLICA_READ_YOUR_WRITES_SECONDS', 0))
+    
+    # Branch databases: "key=url,key=url". A branch created with one of these keys keeps its jobs
+    # (cars, status log, archive, rollups) in that database; users, services and customers stay here
+    SQLALCHEMY_BINDS = {}
+    for entry in filter(None, (os.environ.get('BRANCH_DATABASE_URLS') or '').split(',')):
+        bind_key, _, bind_url = entry.strip().partition('=')
+        if bind_url.startswith('postgres://'):
+            bind_url = bind_url.replace('postgres://', 'postgresql://', 1)
+        SQLALCHEMY_BINDS[bind_key.strip()] = bind_url.strip()
+    
     PERMANENT_SESSION_LIFETIME = timedelta(hours=24)
     SESSION_COOKIE_SECURE = False
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax' 
     
+    # Reverse proxies in front of the app (Render's router is one). Their X-Forwarded-For/-Proto
+    # give the client address and scheme; 0 trusts none, so clients can't spoof them when serving directly.
+    PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 1 if os.environ.get('RENDER') else 0))
+    
+    # Where session data lives: 'database' (the app database, shared by every host and kept across
+    # restarts), 'sqlite' (a local file shared by this host's workers; the default only without
+    # DATABASE_URL, for development) or 'cookie' (signed cookie, no server-side store)
+    SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'database' if database_url else 'sqlite')
+    SESSION_SQLITE_PATH = os.environ.get('SESSION_SQLITE_PATH') or os.path.join(
+        tempfile.gettempdir(), 'spot-sessions.db')
+    # Unchanged sessions get their expiry extended at most this often
+    SESSION_TOUCH_SECONDS = int(os.environ.get('SESSION_TOUCH_SECONDS', 300))
+    
     UPLOAD_FOLDER = os.path.join(basedir, 'app/static/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
     
     ITEMS_PER_PAGE = 20
     
     TIMEZONE = 'Africa/Nairobi'
-
+    
+    # Password hashing: werkzeug method string with explicit cost parameters.
+    # Changing it rehashes each user's password on their next successful login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    
+    # Login throttling: (burst, seconds to refill) token buckets per client IP and per (IP, username).
+    # 'memory' is per worker; 'database' shares buckets across gunicorn workers.
+    LOGIN_RATE_LIMIT_ENABLED = True
+    LOGIN_RATE_LIMIT_BACKEND = os.environ.get('LOGIN_RATE_LIMIT_BACKEND', 'memory')
+    LOGIN_RATE_LIMIT_PER_IP = (20, 60)
+    LOGIN_RATE_LIMIT_PER_USERNAME = (5, 60)
+    
+    # Cold storage: archived jobs older than ARCHIVE_HOT_MONTHS are moved to monthly Parquet files.
+    # No default: the directory must be persistent storage (e.g. a Render disk), since the files
+    # are the only copy of those jobs. Tiering is refused while it is unset.
+    COLD_STORAGE_DIR = os.environ.get('COLD_STORAGE_DIR')
+    ARCHIVE_HOT_MONTHS = int(os.environ.get('ARCHIVE_HOT_MONTHS', 12))
+    
+    # Prometheus /metrics (set METRICS_TOKEN to require 'Authorization: Bearer <token>' on scrapes)
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() != 'false'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    
+    # Request profiling: a signed token from /admin/profiles (X-Profile header or ?_profile=) profiles
+    # one request; PROFILE_SAMPLE_RATE profiles that fraction of all requests. The newest
+    # PROFILE_BUFFER_SIZE profiles are kept in PROFILE_DIR (shared by gunicorn workers).
+    PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'true').lower() != 'false'
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_INTERVAL_MS = 2
+    PROFILE_BUFFER_SIZE = 50
+    PROFILE_TOKEN_MAX_AGE = 3600
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'spot-profiles')
+    
+    # Dashboard job rows are cached as HTML per (car, version) in each worker; compiled
+    # templates are cached on disk so restarted workers don't recompile them
+    FRAGMENT_CACHE_SIZE = 2000
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(
+        tempfile.gettempdir(), 'spot-jinja-cache')
+    
+    # Response compression: brotli or gzip by Accept-Encoding; buffered responses smaller than
+    # COMPRESS_MIN_SIZE bytes aren't worth it. Streamed pages and exports are always compressed.
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', 'true').lower() != 'false'
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_GZIP_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 5
+    
+    # Idempotency keys: stored responses are replayed to retries for this long; an unfinished
+    # claim older than IDEMPOTENCY_LOCK_SECONDS is treated as abandoned (worker died mid-request)
+    IDEMPOTENCY_TTL_HOURS = 24
+    IDEMPOTENCY_LOCK_SECONDS = 60
+    
+    # Background tasks for heavy admin actions: 'database' shares the queue between workers through
+    # background_tasks, 'local' keeps it in one process. Deletes and archiving commit every
+    # TASK_BATCH_SIZE rows; a running task that misses heartbeats for TASK_STALE_SECONDS is failed.
+    TASK_BACKEND = os.environ.get('TASK_BACKEND', 'database')
+    TASK_WORKER_THREADS = int(os.environ.get('TASK_WORKER_THREADS', 1))
+    TASK_BATCH_SIZE = 1000
+    TASK_POLL_SECONDS = 2
+    TASK_STALE_SECONDS = 300
+    TASK_RETENTION_DAYS = 7
+    
+    # Queue scheduler: how often each worker resyncs its in-memory queues from the database,
+    # and how many archived jobs a service needs before its historical average replaces Service.duration
+    SCHEDULER_REFRESH_SECONDS = 60
+    SCHEDULER_MIN_SAMPLES = 5
@@ -0,0 +1,23 @@
+"""
+Gunicorn settings (picked up automatically by `gunicorn run:app`)
+Sets up Prometheus multiprocess mode so /metrics reports all workers, not just the one scraped
+"""
+import os
+import shutil
+import tempfile
+
+# Must be set before the workers import prometheus_client
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'spot-prometheus'))
+
+
+def on_starting(server):
+    # Samples left by a previous run would be merged into the new one
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Drop the dead worker's live gauges (requests in progress, connections in use)
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,5 +1,6 @@
 from app import create_app, db
 from app.models import User, Service, Car, Notification
+from app.customers import link_customers
 
 app = create_app()
 
@@ -13,6 +14,11 @@ def make_shell_context():
         'Notification': Notification
     }
 
+@app.cli.command('link-customers')
+def link_customers_command():
+    """Link jobs recorded before the customers table existed to their customers"""
+    link_customers()
+
 # Auto-create all tables on startup
 with app.app_context():
     db.create_all()
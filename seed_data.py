@@ -0,0 +1,262 @@
+"""
+Spot - Synthetic Data Generator
+Fills services, users, cars, archived_jobs and notifications with realistic data
+
+Usage:
+    python seed_data.py --archived-jobs 100000 --staff 50
+    python seed_data.py --database sqlite:////tmp/load.db --archived-jobs 1000000 --staff 300
+
+All generated staff share the password given by --password (default: loadtest).
+"""
+
+import argparse
+import math
+import random
+import string
+import time
+from datetime import datetime, timedelta
+
+from config import Config
+
+SERVICES = [
+    # name, price, duration (minutes), relative popularity
+    ('Exterior Wash', 300, 20, 30),
+    ('Full Wash', 500, 35, 25),
+    ('Interior Cleaning', 400, 30, 12),
+    ('Engine Wash', 600, 40, 6),
+    ('Wax & Polish', 1500, 60, 5),
+    ('Full Detailing', 3500, 150, 3),
+    ('Upholstery Shampoo', 2500, 120, 3),
+    ('Underbody Wash', 450, 25, 6),
+    ('Motorbike Wash', 150, 15, 8),
+    ('Truck Wash', 1200, 60, 2),
+]
+
+# Relative arrivals per hour of the day (Kenya time): morning and after-work peaks
+HOURLY_ARRIVALS = [0, 0, 0, 0, 0, 0, 1, 4, 8, 9, 7, 6, 6, 7, 6, 6, 8, 10, 9, 5, 2, 1, 0, 0]
+
+FIRST_NAMES = ['John', 'Mary', 'Peter', 'Grace', 'James', 'Faith', 'David', 'Mercy', 'Brian', 'Ann',
+               'Kevin', 'Joy', 'Samuel', 'Esther', 'Daniel', 'Lucy', 'Paul', 'Ruth', 'Joseph', 'Susan']
+LAST_NAMES = ['Otieno', 'Wanjiku', 'Kamau', 'Mwangi', 'Achieng', 'Kiprop', 'Njoroge', 'Mutua', 'Wambui',
+              'Odhiambo', 'Chebet', 'Kariuki', 'Omondi', 'Njeri', 'Kiptoo', 'Muthoni', 'Ouma', 'Kirui']
+CAR_MODELS = ['Toyota Corolla', 'Toyota Vitz', 'Nissan Note', 'Mazda Demio', 'Subaru Forester',
+              'Toyota Prado', 'Honda Fit', 'Mitsubishi Outlander', 'Toyota Probox', 'Mercedes C200']
+ACTIVE_STATUSES = [('Waiting', 4), ('Washing', 3), ('Detailing', 1), ('Ready for Pickup', 2), ('Completed', 3)]
+
+BATCH_SIZE = 10000
+
+
+def random_plate(rng):
+    """Plate like 'KDA 123B'"""
+    letters = 'K' + rng.choice('ABCD') + rng.choice(string.ascii_uppercase)
+    return f"{letters} {rng.randint(0, 999):03d}{rng.choice(string.ascii_uppercase)}"
+
+
+def random_phone(rng):
+    return f"07{rng.randint(10000000, 99999999)}"
+
+
+class CustomerPool:
+    """
+    Customers with heavy-tailed visit frequency
+    A small share of regulars accounts for most visits, like a real wash bay
+    """
+
+    def __init__(self, rng, size):
+        self.rng = rng
+        self.customers = []
+        for _ in range(size):
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            email = f"{name.lower().replace(' ', '.')}{rng.randint(1, 999)}@example.com" if rng.random() < 0.4 else None
+            self.customers.append((name, random_phone(rng), email, random_plate(rng), rng.choice(CAR_MODELS)))
+        self.weights = [1 / (i + 1) ** 0.8 for i in range(size)]
+        self.cumulative = []
+        total = 0
+        for w in self.weights:
+            total += w
+            self.cumulative.append(total)
+
+    def pick(self):
+        return self.rng.choices(self.customers, cum_weights=self.cumulative)[0]
+
+
+def random_time_in(rng, days_back):
+    """Arrival time (UTC) following the hourly profile, within the last `days_back` days"""
+    day = datetime.utcnow().date() - timedelta(days=rng.randint(1, days_back))
+    hour = rng.choices(range(24), weights=HOURLY_ARRIVALS)[0]
+    local = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour, minutes=rng.randint(0, 59))
+    return local - timedelta(hours=3)
+
+
+def random_duration(rng, expected):
+    """Actual minutes taken: lognormal around the service duration with a long tail"""
+    return max(5, int(expected * math.exp(rng.gauss(0.05, 0.35))))
+
+
+def seed(app, archived_jobs=10000, staff=20, cars=200, notifications=5000, customers=None,
+         days=365, password='loadtest', seed_value=42):
+    """Populate the database bound to `app`; returns a dict of row counts inserted"""
+    from werkzeug.security import generate_password_hash
+    from app import db
+    from app.models import User, Service, Car, Customer, Notification, ArchivedJob
+
+    rng = random.Random(seed_value)
+    counts = {}
+
+    with app.app_context():
+        # Services
+        existing = {s.name for s in Service.query.all()}
+        new_services = [{'name': name, 'description': f'{name} service', 'price': price,
+                         'duration': duration, 'is_active': True}
+                        for name, price, duration, _ in SERVICES if name not in existing]
+        if new_services:
+            db.session.execute(db.insert(Service), new_services)
+        services = {s.name: s for s in Service.query.all()}
+        service_choices = [services[name] for name, _, _, _ in SERVICES]
+        service_weights = [weight for _, _, _, weight in SERVICES]
+        counts['services'] = len(new_services)
+
+        # Staff (one hash shared by everyone keeps seeding fast)
+        password_hash = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+        start_index = User.query.filter(User.username.like('staff%')).count()
+        staff_rows = [{
+            'username': f'staff{i:04d}',
+            'full_name': f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            'email': f'staff{i:04d}@crystalclean.com',
+            'phone_number': random_phone(rng),
+            'password_hash': password_hash,
+            'role': 'staff',
+            'is_active': rng.random() > 0.05
+        } for i in range(start_index, start_index + staff)]
+        if staff_rows:
+            db.session.execute(db.insert(User), staff_rows)
+        staff_users = User.query.filter_by(role='staff', is_active=True).all()
+        counts['users'] = staff
+
+        pool = CustomerPool(rng, customers or max(100, archived_jobs // 6))
+
+        # Archived jobs
+        started = time.perf_counter()
+        for offset in range(0, archived_jobs, BATCH_SIZE):
+            rows = []
+            for _ in range(min(BATCH_SIZE, archived_jobs - offset)):
+                name, phone, email, plate, model = pool.pick()
+                service = rng.choices(service_choices, weights=service_weights)[0]
+                user = rng.choice(staff_users)
+                time_in = random_time_in(rng, days)
+                waiting = random_duration(rng, 12)
+                work = random_duration(rng, service.duration)
+                ready = random_duration(rng, 20)
+                detailing = work // 3 if service.duration >= 60 else None
+                duration = waiting + work + ready
+                time_out = time_in + timedelta(minutes=duration)
+                rows.append({
+                    'original_id': rng.randint(1, 10 ** 9),
+                    'customer_name': name,
+                    'customer_phone': phone,
+                    'customer_email': email,
+                    'plate_number': plate,
+                    'car_model': model,
+                    'service_name': service.name,
+                    'service_price': service.price,
+                    'service_duration': service.duration,
+                    'staff_name': user.full_name,
+                    'staff_username': user.username,
+                    'status': 'Completed',
+                    'time_in': time_in,
+                    'time_out': time_out,
+                    'duration_minutes': duration,
+                    'waiting_minutes': waiting,
+                    'washing_minutes': work - (detailing or 0),
+                    'detailing_minutes': detailing,
+                    'ready_minutes': ready,
+                    'archived_at': time_out + timedelta(hours=rng.randint(24, 48))
+                })
+            db.session.execute(db.insert(ArchivedJob), rows)
+            db.session.commit()
+            print(f"[*] Archived jobs: {offset + len(rows):,}/{archived_jobs:,} "
+                  f"({time.perf_counter() - started:.1f}s)")
+        counts['archived_jobs'] = archived_jobs
+        if archived_jobs and db.engine.dialect.name != 'postgresql':
+            # Bulk inserts bypass the archive hooks, so refresh the percentile rollups
+            from app.stats import rebuild_daily_rollups
+            rebuild_daily_rollups()
+
+        # Active cars for today
+        taken = {p for (p,) in db.session.query(Car.plate_number).all()}
+        now = datetime.utcnow()
+        car_rows = []
+        while len(car_rows) < cars:
+            name, phone, email, plate, model = pool.pick()
+            if plate in taken:
+                plate = random_plate(rng)
+                if plate in taken:
+                    continue
+            taken.add(plate)
+            service = rng.choices(service_choices, weights=service_weights)[0]
+            status = rng.choices([s for s, _ in ACTIVE_STATUSES], weights=[w for _, w in ACTIVE_STATUSES])[0]
+            time_in = now - timedelta(minutes=rng.randint(5, 8 * 60))
+            car_rows.append({
+                'customer_name': name,
+                'customer_phone': phone,
+                'customer_email': email,
+                'plate_number': plate,
+                'car_model': model,
+                'service_id': service.id,
+                'assigned_user_id': rng.choice(staff_users).id,
+                'status': status,
+                'time_in': time_in,
+                'time_out': time_in + timedelta(minutes=random_duration(rng, service.duration)) if status == 'Completed' else None
+            })
+        if car_rows:
+            db.session.execute(db.insert(Car), car_rows)
+        counts['cars'] = len(car_rows)
+
+        # Notifications
+        for offset in range(0, notifications, BATCH_SIZE):
+            db.session.execute(db.insert(Notification), [{
+                'user_id': rng.choice(staff_users).id,
+                'message': f'Job {random_plate(rng)} assigned to you',
+                'is_read': rng.random() < 0.8,
+                'created_at': now - timedelta(minutes=rng.randint(0, days * 24 * 60))
+            } for _ in range(min(BATCH_SIZE, notifications - offset))])
+        counts['notifications'] = notifications
+
+        db.session.commit()
+
+        # Bulk inserts skip customer linking; do it the same way as an upgrade would
+        from app.customers import link_customers
+        link_customers()
+        counts['customers'] = Customer.query.count()
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic Spot data')
+    parser.add_argument('--database', help='SQLAlchemy URL (defaults to DATABASE_URL / app.db)')
+    parser.add_argument('--archived-jobs', type=int, default=10000)
+    parser.add_argument('--staff', type=int, default=20)
+    parser.add_argument('--cars', type=int, default=200)
+    parser.add_argument('--notifications', type=int, default=5000)
+    parser.add_argument('--customers', type=int, help='Distinct customers (default: archived jobs / 6)')
+    parser.add_argument('--days', type=int, default=365, help='How far back archived jobs go')
+    parser.add_argument('--password', default='loadtest', help='Password for generated staff')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    from app import create_app
+
+    class SeedConfig(Config):
+        SQLALCHEMY_DATABASE_URI = args.database or Config.SQLALCHEMY_DATABASE_URI
+
+    app = create_app(SeedConfig)
+    started = time.perf_counter()
+    counts = seed(app, archived_jobs=args.archived_jobs, staff=args.staff, cars=args.cars,
+                  notifications=args.notifications, customers=args.customers, days=args.days,
+                  password=args.password, seed_value=args.seed)
+    print(f"[OK] Inserted {counts} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()